@@ -1,30 +1,105 @@
 import json
 import os
-import psycopg2
+import time
 from typing import Dict, Any
-from datetime import datetime, timedelta
+from datetime import datetime
+
+from db import connection
+from telegram_api import message_payload, send_many
 
 SCHEMA = 't_p39739760_garbage_bot_service'
 
-def send_telegram_message(chat_id: int, text: str):
-    '''Отправка сообщения через Telegram Bot API'''
-    import requests
-    
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        return
-    
-    url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
-    data = {
-        'chat_id': chat_id,
-        'text': text,
-        'parse_mode': 'HTML'
-    }
-    
-    try:
-        requests.post(url, json=data, timeout=5)
-    except Exception:
-        pass
+PAYMENT_TIMEOUT_MINUTES = 30
+CANCEL_BATCH_SIZE = 500
+TIME_BUDGET_SECONDS = 20
+NOTIFY_BUDGET_SECONDS = 25
+# Telegram пропускает около 30 сообщений в секунду: за бюджет рассылки с запасом уходит не больше
+NOTICES_PER_RUN = 600
+
+def cancel_expired_orders(conn, deadline: float) -> int:
+    '''
+    Отмена просроченных заказов порциями: одна порция - один UPDATE и один коммит.
+    SKIP LOCKED пропускает строки, занятые параллельным запуском или webhook оплаты,
+    поэтому перекрывающиеся запуски не обрабатывают заказ дважды и не ждут друг друга.
+    Уведомление клиенту ставится в очередь флагом cancel_notice_pending.
+    '''
+    cancelled = 0
+    cursor = conn.cursor()
+
+    while time.monotonic() < deadline:
+        cursor.execute(
+            "WITH expired AS ("
+            f"    SELECT id FROM {SCHEMA}.orders "
+            "    WHERE status = 'pending' AND payment_status = 'pending' "
+            "    AND detailed_status = 'waiting_payment' "
+            "    AND created_at < LOCALTIMESTAMP - make_interval(mins => %s) "
+            "    ORDER BY created_at "
+            "    LIMIT %s "
+            "    FOR UPDATE SKIP LOCKED"
+            ") "
+            f"UPDATE {SCHEMA}.orders o SET status = 'cancelled', detailed_status = 'cancelled', cancel_notice_pending = TRUE "
+            "FROM expired e WHERE o.id = e.id "
+            "RETURNING o.id",
+            (PAYMENT_TIMEOUT_MINUTES, CANCEL_BATCH_SIZE)
+        )
+        batch = cursor.fetchall()
+        conn.commit()
+
+        cancelled += len(batch)
+        if len(batch) < CANCEL_BATCH_SIZE:
+            break
+
+    cursor.close()
+    return cancelled
+
+def send_cancel_notices(conn, deadline: float) -> Dict[str, int]:
+    '''
+    Уведомления об отмене, ещё не доставленные клиентам, - не больше NOTICES_PER_RUN за запуск.
+    Флаг снимается, когда Telegram ответил: доставлено или отказ (например, бот заблокирован);
+    пропущенные по бюджету и сетевые сбои остаются на следующий запуск.
+    '''
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT id, client_id, address, bag_count, price FROM {SCHEMA}.orders "
+        "WHERE cancel_notice_pending AND status = 'cancelled' "
+        "ORDER BY id LIMIT %s",
+        (NOTICES_PER_RUN,)
+    )
+    pending = cursor.fetchall()
+    conn.commit()
+
+    messages = []
+    for order_id, client_id, address, bag_count, price in pending:
+        message = (
+            f"❌ <b>Заказ #{order_id} отменён</b>\n\n"
+            f"📍 Адрес: {address}\n"
+            f"📦 Мешков: {bag_count}\n"
+            f"💰 Сумма: {price} ₽\n\n"
+            "Причина: не поступила оплата в течение 30 минут.\n\n"
+            "Вы можете создать новый заказ в любое время."
+        )
+        messages.append(message_payload(client_id, message))
+
+    outcomes = send_many(messages, deadline=deadline)
+
+    counters = {'delivered': 0, 'failed': 0, 'skipped': 0}
+    settled = []
+    for (order_id, *_), outcome in zip(pending, outcomes):
+        counters[outcome['status']] += 1
+        error_code = outcome.get('error_code') or 0
+        if outcome['status'] == 'delivered' or 400 <= error_code < 500 and error_code != 429:
+            settled.append(order_id)
+
+    if settled:
+        cursor.execute(
+            f"UPDATE {SCHEMA}.orders SET cancel_notice_pending = FALSE WHERE id = ANY(%s)",
+            (settled,)
+        )
+        conn.commit()
+
+    cursor.close()
+    counters['pending'] = len(pending) - len(settled)
+    return counters
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -32,7 +107,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     Вызывается по расписанию или вручную
     '''
     method: str = event.get('httpMethod', 'POST')
-    
+
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
@@ -45,7 +120,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': '',
             'isBase64Encoded': False
         }
-    
+
     try:
         dsn = os.environ.get('DATABASE_URL')
         if not dsn:
@@ -55,57 +130,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'body': json.dumps({'error': 'Database not configured'}),
                 'isBase64Encoded': False
             }
-        
-        conn = psycopg2.connect(dsn)
-        cursor = conn.cursor()
-        
-        cutoff_time = datetime.now() - timedelta(minutes=30)
-        
-        cursor.execute(
-            f"SELECT id, client_id, address, bag_count, price FROM {SCHEMA}.orders "
-            "WHERE payment_status = %s AND detailed_status = %s "
-            "AND created_at < %s AND status = %s",
-            ('pending', 'waiting_payment', cutoff_time, 'pending')
-        )
-        expired_orders = cursor.fetchall()
-        
-        cancelled_count = 0
-        for order in expired_orders:
-            order_id, client_id, address, bag_count, price = order
-            
-            cursor.execute(
-                f"UPDATE {SCHEMA}.orders SET status = %s, detailed_status = %s "
-                "WHERE id = %s",
-                ('cancelled', 'cancelled', order_id)
-            )
-            
-            message = (
-                f"❌ <b>Заказ #{order_id} отменён</b>\n\n"
-                f"📍 Адрес: {address}\n"
-                f"📦 Мешков: {bag_count}\n"
-                f"💰 Сумма: {price} ₽\n\n"
-                "Причина: не поступила оплата в течение 30 минут.\n\n"
-                "Вы можете создать новый заказ в любое время."
-            )
-            
-            send_telegram_message(client_id, message)
-            cancelled_count += 1
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
+
+        with connection() as conn:
+            cancelled = cancel_expired_orders(conn, time.monotonic() + TIME_BUDGET_SECONDS)
+            notifications = send_cancel_notices(conn, time.monotonic() + NOTIFY_BUDGET_SECONDS)
+
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json'},
             'body': json.dumps({
                 'status': 'success',
-                'cancelled_orders': cancelled_count,
+                'cancelled_orders': cancelled,
+                'notifications': notifications,
                 'timestamp': datetime.now().isoformat()
             }),
             'isBase64Encoded': False
         }
-        
+
     except Exception as e:
         return {
             'statusCode': 500,
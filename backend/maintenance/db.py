@@ -0,0 +1,176 @@
+import os
+import select
+import time
+from contextlib import contextmanager
+from threading import Lock, local
+from typing import Dict, Iterator, List, Tuple
+
+import psycopg2
+from psycopg2 import extensions
+
+POOL_SIZE = 2
+PING_AFTER_IDLE = 30
+
+_idle: List[Tuple[extensions.connection, float]] = []
+_lock = Lock()
+
+_stats = local()
+
+# Команды, после которых транзакция что-то изменила; statusmessage курсора начинается с них
+WRITE_COMMANDS = ('INSERT', 'UPDATE', 'DELETE')
+
+def reset_stats() -> None:
+    '''Обнуление счётчиков запросов текущего потока - в начале обработки одного вызова'''
+    _stats.statements = 0
+    _stats.seconds = 0.0
+    _stats.reused = None
+    _stats.writes = 0
+
+def stats() -> Dict:
+    '''
+    Число и время запросов (включая COMMIT) потока с последнего reset_stats, взято ли из пула
+    первое соединение и сколько зафиксировано транзакций с INSERT/UPDATE/DELETE
+    '''
+    return {
+        'statements': getattr(_stats, 'statements', 0),
+        'seconds': getattr(_stats, 'seconds', 0.0),
+        'reused': getattr(_stats, 'reused', None),
+        'writes': getattr(_stats, 'writes', 0)
+    }
+
+def _record(started: float) -> None:
+    _stats.statements = getattr(_stats, 'statements', 0) + 1
+    _stats.seconds = getattr(_stats, 'seconds', 0.0) + time.perf_counter() - started
+
+class TimedCursor(extensions.cursor):
+    '''Курсор, который учитывает свои запросы в счётчиках потока'''
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+            self._mark_write()
+            return result
+        finally:
+            _record(started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            result = super().executemany(query, vars_list)
+            self._mark_write()
+            return result
+        finally:
+            _record(started)
+
+    def _mark_write(self) -> None:
+        if (self.statusmessage or '').startswith(WRITE_COMMANDS):
+            self.connection.has_writes = True
+
+class TimedConnection(extensions.connection):
+    '''Соединение с TimedCursor по умолчанию; COMMIT тоже поход в базу и тоже учитывается'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TimedCursor
+        self.has_writes = False
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+            if self.has_writes:
+                _stats.writes = getattr(_stats, 'writes', 0) + 1
+        finally:
+            self.has_writes = False
+            _record(started)
+
+    def rollback(self):
+        self.has_writes = False
+        return super().rollback()
+
+def _close_quietly(conn: extensions.connection) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def _is_usable(conn: extensions.connection, idle_for: float) -> bool:
+    '''Дешёвая проверка соединения перед повторным использованием'''
+    if conn.closed:
+        return False
+
+    try:
+        readable, _, _ = select.select([conn.fileno()], [], [], 0)
+    except (OSError, ValueError, psycopg2.Error):
+        return False
+
+    if readable:
+        # Простаивающему соединению сервер пишет только при разрыве (рестарт, idle timeout)
+        return False
+
+    if idle_for < PING_AFTER_IDLE:
+        return True
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _mark_reused(reused: bool) -> None:
+    # Учитывается первое соединение вызова: служебные соединения после него (снятие отметки апдейта) метрику не перетирают
+    if getattr(_stats, 'reused', None) is None:
+        _stats.reused = reused
+
+def get_connection() -> extensions.connection:
+    '''Соединение из пула тёплого инстанса или новое, если в пуле нет живых'''
+    while True:
+        with _lock:
+            if not _idle:
+                break
+            conn, released_at = _idle.pop()
+
+        if _is_usable(conn, time.monotonic() - released_at):
+            _mark_reused(True)
+            return conn
+
+        _close_quietly(conn)
+
+    _mark_reused(False)
+    return psycopg2.connect(os.environ.get('DATABASE_URL'), connection_factory=TimedConnection)
+
+def release_connection(conn: extensions.connection, broken: bool = False) -> None:
+    '''Возврат соединения в пул со сбросом транзакции и настроек сессии'''
+    if conn.closed:
+        return
+
+    if not broken:
+        try:
+            conn.reset()
+        except psycopg2.Error:
+            broken = True
+
+    if not broken:
+        with _lock:
+            if len(_idle) < POOL_SIZE:
+                _idle.append((conn, time.monotonic()))
+                return
+
+    _close_quietly(conn)
+
+@contextmanager
+def connection() -> Iterator[extensions.connection]:
+    conn = get_connection()
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        release_connection(conn, broken=True)
+        raise
+    except BaseException:
+        release_connection(conn)
+        raise
+    else:
+        release_connection(conn)
@@ -0,0 +1,147 @@
+import json
+import time
+from typing import Dict, Any
+
+from db import connection
+
+SCHEMA = 't_p39739760_garbage_bot_service'
+
+ARCHIVE_AFTER_DAYS = 7
+ARCHIVE_SCAN_CHUNK = 500
+# У каждой задачи свой бюджет, чтобы долгая архивация не съедала время очистки
+ARCHIVE_BUDGET_SECONDS = 14
+PURGE_BUDGET_SECONDS = 6
+
+PROCESSED_UPDATES_TTL_HOURS = 48
+PURGE_BATCH_SIZE = 5000
+
+def archive_closed_chats(conn, deadline: float) -> Dict[str, int]:
+    '''
+    Перенос переписки завершённых и отменённых заказов в order_chat_archive порциями.
+    Кандидаты берутся из самой order_chat: рекурсивный запрос перешагивает по индексу
+    (order_id, created_at, id) к следующему order_id, поэтому порция читает не больше
+    ARCHIVE_SCAN_CHUNK заказов с перепиской, и стоимость прохода зависит от объёма живой
+    переписки, а не от всей истории заказов.
+    '''
+    archived_messages = 0
+    archived_orders = 0
+    last_id = 0
+    cursor = conn.cursor()
+
+    while time.monotonic() < deadline:
+        cursor.execute(
+            "WITH RECURSIVE chats (order_id, depth) AS ("
+            f"    (SELECT order_id, 1 FROM {SCHEMA}.order_chat WHERE order_id > %s ORDER BY order_id LIMIT 1) "
+            "    UNION ALL "
+            f"    SELECT (SELECT oc.order_id FROM {SCHEMA}.order_chat oc "
+            "            WHERE oc.order_id > c.order_id ORDER BY oc.order_id LIMIT 1), c.depth + 1 "
+            "    FROM chats c WHERE c.order_id IS NOT NULL AND c.depth < %s"
+            ") "
+            "SELECT c.order_id, COALESCE(o.status IN ('completed', 'cancelled') "
+            "    AND COALESCE(o.completed_at, o.created_at) < LOCALTIMESTAMP - make_interval(days => %s), FALSE) "
+            "FROM chats c "
+            f"LEFT JOIN {SCHEMA}.orders o ON o.id = c.order_id "
+            "WHERE c.order_id IS NOT NULL "
+            "ORDER BY c.order_id",
+            (last_id, ARCHIVE_SCAN_CHUNK, ARCHIVE_AFTER_DAYS)
+        )
+        scanned = cursor.fetchall()
+        conn.commit()
+
+        if not scanned:
+            break
+
+        order_ids = [order_id for order_id, archivable in scanned if archivable]
+        if order_ids:
+            cursor.execute(
+                "WITH moved AS ("
+                f"    DELETE FROM {SCHEMA}.order_chat "
+                "    WHERE order_id = ANY(%s) "
+                "    RETURNING id, order_id, sender_id, message, created_at"
+                ") "
+                f"INSERT INTO {SCHEMA}.order_chat_archive (id, order_id, sender_id, message, created_at) "
+                "SELECT id, order_id, sender_id, message, created_at FROM moved "
+                "RETURNING order_id",
+                (order_ids,)
+            )
+            moved = cursor.fetchall()
+            conn.commit()
+
+            archived_messages += len(moved)
+            archived_orders += len({row[0] for row in moved})
+
+        last_id = scanned[-1][0]
+        if len(scanned) < ARCHIVE_SCAN_CHUNK:
+            break
+
+    cursor.close()
+    return {'archived_messages': archived_messages, 'archived_orders': archived_orders}
+
+def purge_processed_updates(conn, deadline: float) -> int:
+    '''Удаление отметок о принятых апдейтах Telegram старше TTL; Telegram столько их не передоставляет'''
+    purged = 0
+    cursor = conn.cursor()
+
+    while time.monotonic() < deadline:
+        cursor.execute(
+            f"DELETE FROM {SCHEMA}.processed_updates WHERE update_id IN ("
+            f"    SELECT update_id FROM {SCHEMA}.processed_updates "
+            "    WHERE received_at < LOCALTIMESTAMP - make_interval(hours => %s) "
+            "    LIMIT %s"
+            ")",
+            (PROCESSED_UPDATES_TTL_HOURS, PURGE_BATCH_SIZE)
+        )
+        deleted = cursor.rowcount
+        conn.commit()
+        purged += deleted
+
+        if deleted < PURGE_BATCH_SIZE:
+            break
+
+    cursor.close()
+    return purged
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Плановое обслуживание базы бота: архивация переписки закрытых заказов
+    и очистка отметок о принятых апдейтах Telegram
+    Вызывается по расписанию или вручную
+    '''
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    try:
+        with connection() as conn:
+            archive_result = archive_closed_chats(conn, time.monotonic() + ARCHIVE_BUDGET_SECONDS)
+            purged_updates = purge_processed_updates(conn, time.monotonic() + PURGE_BUDGET_SECONDS)
+
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({
+                'status': 'success',
+                **archive_result,
+                'purged_updates': purged_updates
+            }),
+            'isBase64Encoded': False
+        }
+
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
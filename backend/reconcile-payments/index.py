@@ -0,0 +1,303 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Any, Iterator, List, Tuple
+
+import yookassa
+from db import connection
+from telegram_api import broadcast, message_payload
+
+SCHEMA = 't_p39739760_garbage_bot_service'
+
+PAGE_SIZE = 200
+LOOKUP_WORKERS = 8
+SETTLE_AFTER_MINUTES = 5
+RECONCILE_WINDOW_DAYS = 3
+TIME_BUDGET_SECONDS = 20
+NOTIFY_BUDGET_SECONDS = 25
+
+def pending_pages(conn, table: str, columns: str, deadline: float) -> Iterator[List[Tuple]]:
+    '''
+    Строки с созданным, но не подтверждённым платежом, страницами по id.
+    Свежие платежи пропускаются - по ним ещё может прийти webhook; слишком старые уже не сверяются.
+    '''
+    after_id = 0
+    cursor = conn.cursor()
+
+    while time.monotonic() < deadline:
+        cursor.execute(
+            f"SELECT id, payment_id, {columns} FROM {SCHEMA}.{table} "
+            "WHERE payment_status = 'pending' AND payment_id IS NOT NULL AND id > %s "
+            "AND created_at < LOCALTIMESTAMP - make_interval(mins => %s) "
+            "AND created_at > LOCALTIMESTAMP - make_interval(days => %s) "
+            "ORDER BY id LIMIT %s",
+            (after_id, SETTLE_AFTER_MINUTES, RECONCILE_WINDOW_DAYS, PAGE_SIZE)
+        )
+        page = cursor.fetchall()
+        conn.commit()
+
+        if not page:
+            break
+
+        yield page
+
+        if len(page) < PAGE_SIZE:
+            break
+        after_id = page[-1][0]
+
+    cursor.close()
+
+def lookup_statuses(payment_ids: List[str], deadline: float) -> Dict[str, str]:
+    '''Статусы платежей в ЮKassa, не больше LOOKUP_WORKERS запросов одновременно; неудачные запросы пропускаются'''
+    def lookup(payment_id: str):
+        if time.monotonic() >= deadline:
+            return None
+        try:
+            return yookassa.get_payment(payment_id)['status']
+        except Exception as e:
+            print(f"Payment lookup error {payment_id}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(LOOKUP_WORKERS, len(payment_ids))) as executor:
+        statuses = executor.map(lookup, payment_ids)
+        return {payment_id: status for payment_id, status in zip(payment_ids, statuses) if status}
+
+def apply_order_payments(conn, changes: List[Tuple[int, str, str]]) -> List[Tuple]:
+    '''
+    Все переходы страницы заказов одним UPDATE. Событие пишется в журнал payment_events,
+    поэтому запоздавший webhook с тем же платежом ничего не повторит; строки, уже
+    обработанные webhook, пропускаются по конфликту в журнале и условию payment_status.
+    Оплаченный заказ, который успела отменить cancel-unpaid-orders, возвращается в поиск курьера.
+    '''
+    if not changes:
+        return []
+
+    order_ids, payment_ids, statuses = (list(column) for column in zip(*changes))
+    cursor = conn.cursor()
+    cursor.execute(
+        "WITH changes AS ("
+        "    SELECT * FROM unnest(%s::bigint[], %s::text[], %s::text[]) AS c(id, payment_id, payment_status)"
+        "), ledger AS ("
+        f"    INSERT INTO {SCHEMA}.payment_events (payment_id, event_type, order_ref, payment_status) "
+        "    SELECT payment_id, 'payment.' || payment_status, id::text, payment_status FROM changes "
+        "    ON CONFLICT (payment_id, event_type) DO NOTHING "
+        "    RETURNING payment_id"
+        ") "
+        f"UPDATE {SCHEMA}.orders o SET "
+        "    payment_status = c.payment_status, "
+        "    paid_at = CASE WHEN c.payment_status = 'succeeded' THEN NOW() ELSE o.paid_at END, "
+        "    status = CASE WHEN c.payment_status = 'succeeded' AND o.status = 'cancelled' THEN 'pending' ELSE o.status END, "
+        "    detailed_status = CASE WHEN c.payment_status = 'succeeded' AND o.detailed_status IN ('waiting_payment', 'cancelled') "
+        "        THEN 'searching_courier' ELSE o.detailed_status END, "
+        "    cancel_notice_pending = CASE WHEN c.payment_status = 'succeeded' THEN FALSE ELSE o.cancel_notice_pending END "
+        "FROM changes c JOIN ledger l ON l.payment_id = c.payment_id "
+        "WHERE o.id = c.id AND o.payment_id = c.payment_id AND o.payment_status = 'pending' "
+        "RETURNING o.id, o.client_id, o.address, o.bag_count, o.price, c.payment_status",
+        (order_ids, payment_ids, statuses)
+    )
+    applied = cursor.fetchall()
+    conn.commit()
+    cursor.close()
+    return applied
+
+def apply_subscription_payments(conn, changes: List[Tuple[int, str, str]]) -> List[Tuple]:
+    '''Переходы страницы подписок одним UPDATE, с той же записью в журнал, что и у заказов'''
+    if not changes:
+        return []
+
+    subscription_ids, payment_ids, statuses = (list(column) for column in zip(*changes))
+    cursor = conn.cursor()
+    cursor.execute(
+        "WITH changes AS ("
+        "    SELECT * FROM unnest(%s::bigint[], %s::text[], %s::text[]) AS c(id, payment_id, payment_status)"
+        "), ledger AS ("
+        f"    INSERT INTO {SCHEMA}.payment_events (payment_id, event_type, order_ref, payment_status) "
+        "    SELECT payment_id, 'payment.' || payment_status, 'sub_' || id, payment_status FROM changes "
+        "    ON CONFLICT (payment_id, event_type) DO NOTHING "
+        "    RETURNING payment_id"
+        ") "
+        f"UPDATE {SCHEMA}.subscriptions s SET "
+        "    payment_status = c.payment_status, "
+        "    paid_at = CASE WHEN c.payment_status = 'succeeded' THEN NOW() ELSE s.paid_at END, "
+        "    is_active = s.is_active OR c.payment_status = 'succeeded' "
+        "FROM changes c JOIN ledger l ON l.payment_id = c.payment_id "
+        "WHERE s.id = c.id AND s.payment_id = c.payment_id AND s.payment_status = 'pending' "
+        "RETURNING s.id, s.client_id, s.type, s.end_date, c.payment_status",
+        (subscription_ids, payment_ids, statuses)
+    )
+    applied = cursor.fetchall()
+    conn.commit()
+    cursor.close()
+    return applied
+
+def reconcile_orders(conn, deadline: float) -> Tuple[int, List[Tuple], List[int]]:
+    '''
+    Сверка заказов. Отменённый в ЮKassa платёж фиксируется только у уже отменённого заказа:
+    живой заказ по таймауту отменит cancel-unpaid-orders, которая отбирает payment_status = 'pending'.
+    Возвращает (число проверенных, применённые строки, id восстановленных заказов).
+    '''
+    checked = 0
+    applied = []
+    revived = []
+
+    for page in pending_pages(conn, 'orders', 'status', deadline):
+        statuses = lookup_statuses([row[1] for row in page], deadline)
+        checked += len(statuses)
+
+        changes = []
+        for order_id, payment_id, order_status in page:
+            status = statuses.get(payment_id)
+            if status == 'succeeded' or (status == 'canceled' and order_status == 'cancelled'):
+                changes.append((order_id, payment_id, status))
+                if status == 'succeeded' and order_status == 'cancelled':
+                    revived.append(order_id)
+
+        applied.extend(apply_order_payments(conn, changes))
+
+    applied_ids = {row[0] for row in applied}
+    return checked, applied, [order_id for order_id in revived if order_id in applied_ids]
+
+def reconcile_subscriptions(conn, deadline: float) -> Tuple[int, List[Tuple]]:
+    checked = 0
+    applied = []
+
+    for page in pending_pages(conn, 'subscriptions', 'NULL', deadline):
+        statuses = lookup_statuses([row[1] for row in page], deadline)
+        checked += len(statuses)
+
+        changes = [
+            (subscription_id, payment_id, statuses[payment_id])
+            for subscription_id, payment_id, _ in page
+            if statuses.get(payment_id) in ('succeeded', 'canceled')
+        ]
+        applied.extend(apply_subscription_payments(conn, changes))
+
+    return checked, applied
+
+def build_notifications(conn, paid_orders: List[Tuple], revived: List[int], paid_subscriptions: List[Tuple]) -> List[Dict]:
+    '''Те же сообщения, что рассылает webhook оплаты: клиенту и всем курьерам о новом заказе'''
+    messages = []
+
+    for order_id, client_id, address, bag_count, price, _ in paid_orders:
+        if order_id in revived:
+            message = (
+                f"✅ <b>Оплата заказа #{order_id} получена</b>\n\n"
+                "Заказ был отменён по таймауту, но платёж прошёл, поэтому заказ восстановлен.\n\n"
+                f"🗑 Мешков: {bag_count}\n"
+                f"📍 Адрес: {address}\n\n"
+                "Курьер скоро свяжется с вами для согласования времени вывоза."
+            )
+        else:
+            message = (
+                f"✅ <b>Оплата прошла успешно!</b>\n\n"
+                f"📦 Заказ #{order_id}\n"
+                f"🗑 Мешков: {bag_count}\n"
+                f"📍 Адрес: {address}\n\n"
+                "Курьер скоро свяжется с вами для согласования времени вывоза."
+            )
+        keyboard = {
+            'inline_keyboard': [
+                [{'text': '📦 Мои заказы', 'callback_data': 'client_active_orders'}],
+                [{'text': '⬅️ Главное меню', 'callback_data': 'client_menu'}]
+            ]
+        }
+        messages.append(message_payload(client_id, message, keyboard))
+
+    for subscription_id, client_id, sub_type, end_date, _ in paid_subscriptions:
+        sub_name = "Ежедневно" if sub_type == 'daily' else "Через день"
+        message = (
+            f"✅ <b>Подписка активирована!</b>\n\n"
+            f"⭐ Тип: {sub_name}\n"
+            f"📅 Действует до: {end_date.strftime('%d.%m.%Y')}\n\n"
+            "Теперь вы можете заказывать вывоз до 2 пакетов без доплаты!"
+        )
+        keyboard = {
+            'inline_keyboard': [
+                [{'text': '➕ Новый заказ', 'callback_data': 'client_new_order'}],
+                [{'text': '⬅️ Главное меню', 'callback_data': 'client_menu'}]
+            ]
+        }
+        messages.append(message_payload(client_id, message, keyboard))
+
+    if paid_orders:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT telegram_id FROM {SCHEMA}.users WHERE role = %s", ('courier',))
+        couriers = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+
+        for order_id, _, address, bag_count, price, _ in paid_orders:
+            keyboard = {
+                'inline_keyboard': [
+                    [{'text': '✅ Принять', 'callback_data': f'accept_order_{order_id}'}]
+                ]
+            }
+            text = f"🆕 Новый заказ #{order_id}\n📍 {address}\n📦 {bag_count} мешков\n💰 {price} ₽"
+            messages.extend(message_payload(courier_id, text, keyboard) for courier_id in couriers)
+
+    return messages
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Сверка неподтверждённых платежей заказов и подписок с ЮKassa на случай потерянного webhook
+    Вызывается по расписанию или вручную
+    '''
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if not yookassa.is_configured():
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'status': 'not_configured'}),
+            'isBase64Encoded': False
+        }
+
+    deadline = time.monotonic() + TIME_BUDGET_SECONDS
+
+    try:
+        with connection() as conn:
+            checked_orders, applied_orders, revived = reconcile_orders(conn, deadline)
+            checked_subscriptions, applied_subscriptions = reconcile_subscriptions(conn, deadline)
+
+            paid_orders = [row for row in applied_orders if row[5] == 'succeeded']
+            paid_subscriptions = [row for row in applied_subscriptions if row[4] == 'succeeded']
+            messages = build_notifications(conn, paid_orders, revived, paid_subscriptions)
+
+        notifications = broadcast(messages, deadline=time.monotonic() + NOTIFY_BUDGET_SECONDS)
+
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({
+                'status': 'success',
+                'checked_payments': checked_orders + checked_subscriptions,
+                'paid_orders': len(paid_orders),
+                'revived_orders': len(revived),
+                'paid_subscriptions': len(paid_subscriptions),
+                'canceled_payments': len(applied_orders) - len(paid_orders) + len(applied_subscriptions) - len(paid_subscriptions),
+                'notifications': notifications,
+                'timestamp': datetime.now().isoformat()
+            }),
+            'isBase64Encoded': False
+        }
+
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
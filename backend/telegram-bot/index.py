@@ -2,29 +2,89 @@
 Business: Telegram bot for garbage collection courier service with roles
 Args: event - webhook from Telegram with updates
       context - cloud function context with request_id
-Returns: HTTP response with statusCode 200
+Returns: HTTP response with statusCode 200, body may carry one Bot API method call as the webhook reply
 """
 
 import json
-import os
-import psycopg2
-from typing import Dict, Any, Optional, List
-from datetime import datetime
-from threading import local
-
-TELEGRAM_API = "https://api.telegram.org/bot{token}/{method}"
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
+from dataclasses import dataclass
+from datetime import date, datetime
+from itertools import count
+from threading import Lock, local
+
+import db
+import notifier
+import telegram_api
+import yookassa
+from db import connection
+from notifier import notify
+from pagination import NEXT, PAGE_SIZE, PREV, encode_cursor, fit_entries, keyset, nav_row, parse_page, split_page
+from router import Router
+from telegram_api import message_payload
 
 _context = local()
 
 MAX_BAGS_QUICK_SELECT = 10
 
-def get_setting(conn, key: str, default: str = '0') -> str:
-    '''Получение значения настройки из базы данных'''
+CHAT_PAGE_SIZE = 20
+
+YOOMONEY_FUNCTION_URL = 'https://functions.poehali.dev/b0e9d993-5a3b-4a63-892c-1148d0d2b71f'
+PAYMENT_REUSE_MINUTES = 30
+
+UPDATE_BUDGET_SECONDS = 20
+# Сводка по маршрутам callback_data пишется в лог раз в столько апдейтов инстанса
+ROUTE_STATS_EVERY = 500
+
+ROLE_CACHE_TTL = 60
+ROLE_CACHE_SIZE = 1024
+
+_role_cache: 'OrderedDict[int, Tuple[str, float]]' = OrderedDict()
+_role_cache_lock = Lock()
+
+SEEN_UPDATES_SIZE = 4096
+UPDATE_LEASE_SECONDS = 60
+
+_seen_updates: 'OrderedDict[int, None]' = OrderedDict()
+_seen_updates_lock = Lock()
+
+_settings_values: Dict[str, str] = {}
+_settings_version: Optional[datetime] = None
+_settings_lock = Lock()
+
+def _load_settings(conn) -> Dict[str, str]:
+    '''Настройки из кэша инстанса; таблица перечитывается целиком, только если сменилась версия max(updated_at)'''
+    global _settings_values, _settings_version
+    
+    snapshot = getattr(_context, 'settings', None)
+    if snapshot is not None:
+        return snapshot
+    
+    with _settings_lock:
+        version = _settings_version
+    
     cursor = conn.cursor()
-    cursor.execute(f"SELECT value FROM {SCHEMA}.settings WHERE key = %s", (key,))
-    result = cursor.fetchone()
+    cursor.execute(
+        f"SELECT key, value, MAX(updated_at) OVER () FROM {SCHEMA}.settings "
+        f"WHERE (SELECT MAX(updated_at) FROM {SCHEMA}.settings) IS DISTINCT FROM %s",
+        (version,)
+    )
+    rows = cursor.fetchall()
     cursor.close()
-    return result[0] if result else default
+    
+    with _settings_lock:
+        if rows:
+            _settings_values = {key: value for key, value, _ in rows}
+            _settings_version = rows[0][2]
+        snapshot = _settings_values
+    
+    _context.settings = snapshot
+    return snapshot
+
+def get_setting(conn, key: str, default: str = '0') -> str:
+    '''Получение значения настройки из базы данных'''
+    return _load_settings(conn).get(key, default)
 
 def get_bag_price(conn) -> int:
     return int(get_setting(conn, 'bag_price', '50'))
@@ -45,58 +105,107 @@ ORDER_STATUSES = {
 
 SCHEMA = 't_p39739760_garbage_bot_service'
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url)
+# Переходы заказа: из каких status (и detailed_status, None - любой) в какую пару,
+# кто может выполнить и какие поля проставляются вместе со статусом.
+# actor: unassigned - любой курьер, пока заказ свободен; courier - курьер заказа;
+# client - клиент заказа или персонал; staff - только персонал (роль проверяет роутер).
+ORDER_TRANSITIONS = {
+    'accept': {
+        'from': {'pending': None},
+        'to': ('accepted', 'courier_on_way'),
+        'actor': 'unassigned',
+        'set': "courier_id = %(actor)s, accepted_at = CURRENT_TIMESTAMP"
+    },
+    'start_work': {
+        'from': {'accepted': ('courier_on_way',)},
+        'to': ('accepted', 'courier_working'),
+        'actor': 'courier'
+    },
+    'complete': {
+        'from': {'accepted': ('courier_on_way', 'courier_working')},
+        'to': ('completed', 'completed'),
+        'actor': 'courier',
+        'set': "completed_at = CURRENT_TIMESTAMP"
+    },
+    'cancel': {
+        'from': {'pending': ('waiting_payment', 'searching_courier')},
+        'to': ('cancelled', 'cancelled'),
+        'actor': 'client'
+    }
+}
+
+# Ручная смена статуса оператором: из любого незакрытого статуса
+OPERATOR_STATUS_TARGETS = {
+    'searching_courier': 'pending',
+    'courier_on_way': 'accepted',
+    'courier_working': 'accepted',
+    'completed': 'completed',
+    'cancelled': 'cancelled'
+}
 
-def send_message(chat_id: int, text: str, reply_markup: Optional[Dict] = None) -> None:
-    token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    url = TELEGRAM_API.format(token=token, method='sendMessage')
-    
-    payload = {
-        'chat_id': chat_id,
-        'text': text,
-        'parse_mode': 'HTML'
+ORDER_TRANSITIONS.update({
+    f'set_{detailed}': {
+        'from': {'pending': None, 'accepted': None},
+        'to': (status, detailed),
+        'actor': 'staff',
+        'set': "completed_at = COALESCE(completed_at, CURRENT_TIMESTAMP)" if status == 'completed' else None
     }
+    for detailed, status in OPERATOR_STATUS_TARGETS.items()
+})
+
+_TRANSITION_ACTORS = {
+    'unassigned': "o.courier_id IS NULL",
+    'courier': "o.courier_id = %(actor)s",
+    'client': "(o.client_id = %(actor)s OR %(staff)s)",
+    'staff': "TRUE"
+}
+
+def _dispatch(method: str, payload: Dict, capture: bool = False) -> None:
+    '''Отправка через план ответа: последний экран для чата апдейта уходит в теле ответа webhook'''
+    if payload['chat_id'] == getattr(_context, 'reply_chat_id', None):
+        flush_reply()
+        if capture:
+            _context.reply = dict(payload, method=method)
+            return
     
-    if reply_markup:
-        payload['reply_markup'] = reply_markup
-    
-    import urllib.request
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(payload).encode('utf-8'),
-        headers={'Content-Type': 'application/json'}
-    )
-    try:
-        urllib.request.urlopen(req)
-    except Exception as e:
-        print(f"Error sending message: {e}")
+    telegram_api.call(method, payload, getattr(_context, 'deadline', None))
+
+def begin_update() -> None:
+    '''Сброс состояния, привязанного к одному апдейту; повторы вызовов Telegram укладываются в его бюджет'''
+    _context.deadline = time.monotonic() + UPDATE_BUDGET_SECONDS
+    _context.message_id = None
+    _context.reply_chat_id = None
+    _context.reply = None
+    _context.roles = {}
+    _context.settings = None
+    _context.user = None
+    _context.route = None
+    notifier.discard()
+
+def begin_reply(chat_id: int) -> None:
+    _context.reply_chat_id = chat_id
+    _context.reply = None
+
+def flush_reply() -> None:
+    '''Отправка отложенного ответа по HTTP, чтобы не нарушить порядок сообщений в чате'''
+    reply = getattr(_context, 'reply', None)
+    if reply:
+        _context.reply = None
+        payload = dict(reply)
+        method = payload.pop('method')
+        telegram_api.call(method, payload, getattr(_context, 'deadline', None))
+
+def take_reply() -> Optional[Dict]:
+    reply = getattr(_context, 'reply', None)
+    _context.reply = None
+    _context.reply_chat_id = None
+    return reply
+
+def send_message(chat_id: int, text: str, reply_markup: Optional[Dict] = None) -> None:
+    _dispatch('sendMessage', message_payload(chat_id, text, reply_markup))
 
 def edit_message(chat_id: int, message_id: int, text: str, reply_markup: Optional[Dict] = None) -> None:
-    token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    url = TELEGRAM_API.format(token=token, method='editMessageText')
-    
-    payload = {
-        'chat_id': chat_id,
-        'message_id': message_id,
-        'text': text,
-        'parse_mode': 'HTML'
-    }
-    
-    if reply_markup:
-        payload['reply_markup'] = reply_markup
-    
-    import urllib.request
-    try:
-        req = urllib.request.Request(
-            url,
-            data=json.dumps(payload).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
-        urllib.request.urlopen(req)
-    except:
-        pass
+    _dispatch('editMessageText', message_payload(chat_id, text, reply_markup, message_id), capture=True)
 
 def send_or_edit_message(chat_id: int, text: str, reply_markup: Optional[Dict] = None, message_id: Optional[int] = None) -> None:
     if message_id:
@@ -109,46 +218,98 @@ def smart_send_message(chat_id: int, text: str, reply_markup: Optional[Dict] = N
     if message_id:
         edit_message(chat_id, message_id, text, reply_markup)
     else:
-        send_message(chat_id, text, reply_markup)
+        _dispatch('sendMessage', message_payload(chat_id, text, reply_markup), capture=True)
+
+_ROLE_CASE = (
+    "CASE "
+    "WHEN a.telegram_id IS NOT NULL THEN 'admin' "
+    "WHEN op.telegram_id IS NOT NULL THEN 'operator' "
+    "ELSE COALESCE(u.role, 'client') END"
+)
+
+_ROLE_JOINS = (
+    "FROM (SELECT %s::bigint AS telegram_id) me "
+    f"LEFT JOIN {SCHEMA}.admin_users a ON a.telegram_id = me.telegram_id "
+    f"LEFT JOIN {SCHEMA}.operator_users op ON op.telegram_id = me.telegram_id "
+    f"LEFT JOIN {SCHEMA}.users u ON u.telegram_id = me.telegram_id"
+)
+
+def _load_role(telegram_id: int, conn) -> str:
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {_ROLE_CASE} {_ROLE_JOINS}", (telegram_id,))
+    role = cursor.fetchone()[0]
+    cursor.close()
+    return role
 
-def delete_message(chat_id: int, message_id: int) -> None:
-    token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    url = TELEGRAM_API.format(token=token, method='deleteMessage')
-    
-    payload = {
-        'chat_id': chat_id,
-        'message_id': message_id
-    }
+def _remember_role(telegram_id: int, role: str) -> None:
+    '''Роль, только что прочитанная из базы: в мемо апдейта и в TTL-кэш инстанса'''
+    with _role_cache_lock:
+        _role_cache[telegram_id] = (role, time.monotonic() + ROLE_CACHE_TTL)
+        _role_cache.move_to_end(telegram_id)
+        while len(_role_cache) > ROLE_CACHE_SIZE:
+            _role_cache.popitem(last=False)
     
-    import urllib.request
-    try:
-        req = urllib.request.Request(
-            url,
-            data=json.dumps(payload).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
-        urllib.request.urlopen(req)
-    except:
-        pass
+    roles = getattr(_context, 'roles', None)
+    if roles is None:
+        roles = _context.roles = {}
+    roles[telegram_id] = role
 
 def check_user_role(telegram_id: int, conn) -> str:
+    '''Роль пользователя: мемо в рамках апдейта, затем TTL-кэш инстанса, затем один запрос'''
+    roles = getattr(_context, 'roles', None)
+    if roles is None:
+        roles = _context.roles = {}
+    if telegram_id in roles:
+        return roles[telegram_id]
+    
+    now = time.monotonic()
+    with _role_cache_lock:
+        cached = _role_cache.get(telegram_id)
+        if cached and cached[1] > now:
+            _role_cache.move_to_end(telegram_id)
+            roles[telegram_id] = cached[0]
+            return cached[0]
+    
+    role = _load_role(telegram_id, conn)
+    _remember_role(telegram_id, role)
+    return role
+
+@dataclass
+class UserContext:
+    '''Всё, что нужно для разбора текстового сообщения: роль, открытый чат заказа и черновик заказа'''
+    telegram_id: int
+    role: str
+    chat_order_id: Optional[int] = None
+    chat_client_id: Optional[int] = None
+    chat_courier_id: Optional[int] = None
+    chat_order_status: Optional[str] = None
+    draft_state: Optional[str] = None
+    draft_data: Optional[Dict] = None
+
+def load_user_context(telegram_id: int, conn) -> UserContext:
+    '''Контекст пользователя одним запросом; заодно кладёт роль в мемо апдейта и кэш ролей'''
     cursor = conn.cursor()
-    
-    cursor.execute(f"SELECT 1 FROM {SCHEMA}.admin_users WHERE telegram_id = %s", (telegram_id,))
-    if cursor.fetchone():
-        cursor.close()
-        return 'admin'
-    
-    cursor.execute(f"SELECT 1 FROM {SCHEMA}.operator_users WHERE telegram_id = %s", (telegram_id,))
-    if cursor.fetchone():
-        cursor.close()
-        return 'operator'
-    
-    cursor.execute(f"SELECT role FROM {SCHEMA}.users WHERE telegram_id = %s", (telegram_id,))
-    user = cursor.fetchone()
+    cursor.execute(
+        f"SELECT {_ROLE_CASE}, cs.order_id, o.client_id, o.courier_id, o.status, d.state, d.order_data "
+        f"{_ROLE_JOINS} "
+        f"LEFT JOIN {SCHEMA}.chat_sessions cs ON cs.telegram_id = me.telegram_id "
+        f"LEFT JOIN {SCHEMA}.orders o ON o.id = cs.order_id "
+        f"LEFT JOIN {SCHEMA}.order_draft d ON d.telegram_id = me.telegram_id",
+        (telegram_id,)
+    )
+    row = cursor.fetchone()
     cursor.close()
     
-    return user[0] if user else 'client'
+    user = UserContext(telegram_id, *row)
+    _remember_role(telegram_id, user.role)
+    _context.user = user
+    return user
+
+def invalidate_role(telegram_id: int) -> None:
+    '''Сброс закэшированной роли после её изменения; другие инстансы увидят новую роль по истечении TTL'''
+    with _role_cache_lock:
+        _role_cache.pop(telegram_id, None)
+    getattr(_context, 'roles', {}).pop(telegram_id, None)
 
 def get_main_menu_keyboard(role: str) -> Dict:
     if role == 'admin':
@@ -207,31 +368,6 @@ def get_client_menu_keyboard() -> Dict:
         ]
     }
 
-def archive_old_chats(conn) -> None:
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        f"INSERT INTO {SCHEMA}.order_chat_archive (order_id, sender_id, message, created_at) "
-        f"SELECT oc.order_id, oc.sender_id, oc.message, oc.created_at "
-        f"FROM {SCHEMA}.order_chat oc "
-        f"JOIN {SCHEMA}.orders o ON oc.order_id = o.id "
-        "WHERE o.status IN ('completed', 'cancelled') "
-        "AND o.updated_at < NOW() - INTERVAL '7 days' "
-        "AND oc.is_archived = FALSE"
-    )
-    
-    cursor.execute(
-        f"UPDATE {SCHEMA}.order_chat SET is_archived = TRUE "
-        "WHERE order_id IN ("
-        f"    SELECT o.id FROM {SCHEMA}.orders o "
-        "    WHERE o.status IN ('completed', 'cancelled') "
-        "    AND o.updated_at < NOW() - INTERVAL '7 days'"
-        ")"
-    )
-    
-    conn.commit()
-    cursor.close()
-
 def get_or_create_user(telegram_id: int, username: str, first_name: str, conn) -> Dict:
     cursor = conn.cursor()
     
@@ -269,11 +405,6 @@ def handle_start(chat_id: int, telegram_id: int, username: str, first_name: str,
     get_or_create_user(telegram_id, username, first_name, conn)
     role = check_user_role(telegram_id, conn)
     
-    try:
-        archive_old_chats(conn)
-    except Exception:
-        pass
-    
     if role == 'admin':
         welcome_text = "👑 <b>Админ-панель</b>\n\nДобро пожаловать в панель администратора."
     elif role == 'operator':
@@ -354,43 +485,82 @@ def handle_courier_available_orders(chat_id: int, telegram_id: int, conn) -> Non
     keyboard_buttons.append([{'text': '⬅️ Назад', 'callback_data': 'courier_menu'}])
     smart_send_message(chat_id, text, {'inline_keyboard': keyboard_buttons})
 
-def handle_accept_order(chat_id: int, telegram_id: int, order_id: int, conn) -> None:
+def transition_order(conn, order_id: int, action: str, actor_id: int, staff: bool = False) -> Tuple[str, Optional[Tuple]]:
+    '''
+    Переход заказа по ORDER_TRANSITIONS одним условным UPDATE (compare-and-set), без коммита.
+    Возвращает ('ok', (client_id, courier_id, address, description, price, courier_name))
+    либо ('not_found' | 'forbidden' | 'conflict', None); conflict - заказ уже в другом статусе.
+    '''
+    spec = ORDER_TRANSITIONS[action]
+    status, detailed_status = spec['to']
+    params = {'order_id': order_id, 'actor': actor_id, 'staff': staff, 'status': status, 'detailed_status': detailed_status}
+    
+    allowed = []
+    for index, (from_status, from_detailed) in enumerate(spec['from'].items()):
+        params[f'from_{index}'] = from_status
+        if from_detailed is None:
+            allowed.append(f"o.status = %(from_{index})s")
+        else:
+            params[f'from_detailed_{index}'] = list(from_detailed)
+            allowed.append(f"(o.status = %(from_{index})s AND o.detailed_status = ANY(%(from_detailed_{index})s))")
+    
+    assignments = "status = %(status)s, detailed_status = %(detailed_status)s"
+    if spec.get('set'):
+        assignments += ", " + spec['set']
+    
     cursor = conn.cursor()
+    cursor.execute(
+        "WITH current AS ("
+        f"    SELECT client_id, courier_id FROM {SCHEMA}.orders WHERE id = %(order_id)s"
+        "), changed AS ("
+        f"    UPDATE {SCHEMA}.orders o SET {assignments} "
+        f"    WHERE o.id = %(order_id)s AND ({' OR '.join(allowed)}) AND {_TRANSITION_ACTORS[spec['actor']]} "
+        "    RETURNING o.client_id, o.courier_id, o.address, o.description, o.price"
+        ") "
+        "SELECT c.client_id, c.courier_id, ch.client_id, ch.courier_id, ch.address, ch.description, ch.price, "
+        f"(SELECT first_name FROM {SCHEMA}.users WHERE telegram_id = ch.courier_id) "
+        "FROM current c LEFT JOIN changed ch ON TRUE",
+        params
+    )
+    row = cursor.fetchone()
+    cursor.close()
     
+    if not row:
+        return 'not_found', None
+    
+    current_client_id, current_courier_id = row[0], row[1]
+    if row[2] is not None:
+        return 'ok', row[2:]
+    
+    # Проигравший гонку или чужой заказ: причина по строке, прочитанной в том же запросе
+    if spec['actor'] == 'courier' and current_courier_id != actor_id:
+        return 'forbidden', None
+    if spec['actor'] == 'client' and current_client_id != actor_id and not staff:
+        return 'forbidden', None
+    return 'conflict', None
+
+def handle_accept_order(chat_id: int, telegram_id: int, order_id: int, conn) -> None:
     role = check_user_role(telegram_id, conn)
     if role != 'courier':
         send_message(chat_id, "❌ Только курьеры могут принимать заказы")
-        cursor.close()
         return
     
-    cursor.execute("SELECT status, address, description, price, client_id FROM t_p39739760_garbage_bot_service.orders WHERE id = %s", (order_id,))
-    order = cursor.fetchone()
+    outcome, order = transition_order(conn, order_id, 'accept', telegram_id)
+    conn.commit()
     
-    if not order or order[0] != 'pending':
+    if outcome != 'ok':
         send_message(chat_id, "❌ Заказ недоступен или уже принят")
-        cursor.close()
         return
     
-    status, address, description, price, client_id = order
-    
-    cursor.execute(
-        "UPDATE t_p39739760_garbage_bot_service.orders SET status = %s, courier_id = %s, accepted_at = %s, detailed_status = %s WHERE id = %s",
-        ('accepted', telegram_id, datetime.now(), 'courier_on_way', order_id)
-    )
-    conn.commit()
-    
-    cursor.execute("SELECT first_name FROM t_p39739760_garbage_bot_service.users WHERE telegram_id = %s", (telegram_id,))
-    courier = cursor.fetchone()
-    courier_name = courier[0] if courier else "Курьер"
-    
-    cursor.close()
+    client_id, courier_id, address, description, price, courier_name = order
+    courier_name = courier_name or "Курьер"
     
     keyboard = {
         'inline_keyboard': [
             [{'text': '💬 Написать курьеру', 'callback_data': f'client_chat_{order_id}'}]
         ]
     }
-    send_message(client_id, f"🚗 Курьер {courier_name} едет к вам", keyboard)
+    notify(client_id, f"🚗 Курьер {courier_name} едет к вам", keyboard)
     
     text = f"✅ <b>Заказ #{order_id} принят!</b>\n\n"
     text += f"📍 Адрес: {address}\n"
@@ -447,34 +617,20 @@ def handle_courier_current_orders(chat_id: int, telegram_id: int, conn) -> None:
     send_message(chat_id, text, {'inline_keyboard': keyboard_buttons})
 
 def handle_start_work(chat_id: int, telegram_id: int, order_id: int, conn) -> None:
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT courier_id, address, description, price, client_id FROM t_p39739760_garbage_bot_service.orders WHERE id = %s",
-        (order_id,)
-    )
-    order = cursor.fetchone()
+    outcome, order = transition_order(conn, order_id, 'start_work', telegram_id)
+    conn.commit()
     
-    if not order or order[0] != telegram_id:
-        cursor.close()
+    if outcome in ('not_found', 'forbidden'):
         send_message(chat_id, "❌ Заказ не найден или не принадлежит вам")
         return
+    if outcome == 'conflict':
+        send_message(chat_id, "❌ Работа по заказу уже начата или заказ закрыт")
+        return
     
-    courier_id, address, description, price, client_id = order
-    
-    cursor.execute(
-        "UPDATE t_p39739760_garbage_bot_service.orders SET detailed_status = %s WHERE id = %s AND courier_id = %s",
-        ('courier_working', order_id, telegram_id)
-    )
-    conn.commit()
-    
-    cursor.execute("SELECT first_name FROM t_p39739760_garbage_bot_service.users WHERE telegram_id = %s", (telegram_id,))
-    courier = cursor.fetchone()
-    courier_name = courier[0] if courier else "Курьер"
-    
-    cursor.close()
+    client_id, courier_id, address, description, price, courier_name = order
+    courier_name = courier_name or "Курьер"
     
-    send_message(client_id, f"🛠 {courier_name} начал работу")
+    notify(client_id, f"🛠 {courier_name} начал работу")
     
     text = f"🛠 <b>Работа над заказом #{order_id} начата!</b>\n\n"
     text += f"📍 Адрес: {address}\n"
@@ -492,39 +648,32 @@ def handle_start_work(chat_id: int, telegram_id: int, order_id: int, conn) -> No
     smart_send_message(chat_id, text, keyboard)
 
 def handle_complete_order(chat_id: int, telegram_id: int, order_id: int, conn) -> None:
-    cursor = conn.cursor()
+    outcome, order = transition_order(conn, order_id, 'complete', telegram_id)
     
-    cursor.execute("SELECT courier_id, price FROM t_p39739760_garbage_bot_service.orders WHERE id = %s", (order_id,))
-    order = cursor.fetchone()
-    
-    if not order or order[0] != telegram_id:
-        send_message(chat_id, "❌ Заказ не найден")
-        cursor.close()
+    if outcome != 'ok':
+        conn.commit()
+        if outcome == 'conflict':
+            send_message(chat_id, "❌ Заказ уже завершён или отменён")
+        else:
+            send_message(chat_id, "❌ Заказ не найден")
         return
     
-    price = order[1]
-    
-    cursor.execute(
-        "UPDATE t_p39739760_garbage_bot_service.orders SET status = %s, completed_at = %s, detailed_status = %s WHERE id = %s",
-        ('completed', datetime.now(), 'completed', order_id)
-    )
+    client_id, courier_id, address, description, price, courier_name = order
     
+    # Статистика курьера растёт только у выигравшего переход, повторное нажатие её не задваивает
+    cursor = conn.cursor()
     cursor.execute(
-        f"INSERT INTO {SCHEMA}.courier_stats (courier_id, total_orders, total_earnings) "
-        "VALUES (%s, 1, %s) "
-        f"ON CONFLICT (courier_id) DO UPDATE SET "
-        f"total_orders = {SCHEMA}.courier_stats.total_orders + 1, "
-        f"total_earnings = {SCHEMA}.courier_stats.total_earnings + %s, "
-        "updated_at = %s",
-        (telegram_id, price, price, datetime.now())
+        "WITH stats AS ("
+        f"    INSERT INTO {SCHEMA}.courier_stats (courier_id, total_orders, total_earnings) "
+        "    VALUES (%s, 1, %s) "
+        "    ON CONFLICT (courier_id) DO UPDATE SET "
+        f"    total_orders = {SCHEMA}.courier_stats.total_orders + 1, "
+        f"    total_earnings = {SCHEMA}.courier_stats.total_earnings + EXCLUDED.total_earnings, "
+        "    updated_at = CURRENT_TIMESTAMP"
+        ") "
+        f"DELETE FROM {SCHEMA}.chat_sessions WHERE telegram_id IN (%s, %s)",
+        (telegram_id, price, telegram_id, client_id)
     )
-    
-    cursor.execute("SELECT client_id FROM t_p39739760_garbage_bot_service.orders WHERE id = %s", (order_id,))
-    client = cursor.fetchone()
-    client_id = client[0] if client else None
-    
-    cursor.execute("DELETE FROM t_p39739760_garbage_bot_service.chat_sessions WHERE telegram_id IN (%s, %s)", (telegram_id, client_id))
-    
     conn.commit()
     cursor.close()
     
@@ -534,7 +683,7 @@ def handle_complete_order(chat_id: int, telegram_id: int, order_id: int, conn) -
                 [{'text': '⭐ Оценить курьера', 'callback_data': f'rate_order_{order_id}'}]
             ]
         }
-        send_message(client_id, f"✅ Заказ завершен", keyboard)
+        notify(client_id, f"✅ Заказ завершен", keyboard)
     
     text = f"✅ Заказ #{order_id} завершён!\n\n💰 Заработано: {price} ₽"
     keyboard = {
@@ -604,107 +753,140 @@ def handle_client_new_order(chat_id: int, conn) -> None:
     keyboard = {'inline_keyboard': keyboard_buttons}
     smart_send_message(chat_id, text, keyboard)
 
+def request_payment(amount, description: str, reference: str) -> Optional[Dict]:
+    '''Платёж в ЮKassa прямо из бота; если ключи магазина заданы только у функции yoomoney - через неё'''
+    try:
+        if yookassa.is_configured():
+            return yookassa.create_payment(amount, description, reference)
+        
+        response = yookassa.session().post(
+            YOOMONEY_FUNCTION_URL,
+            json={'amount': amount, 'description': description, 'order_id': reference},
+            timeout=(yookassa.CONNECT_TIMEOUT, yookassa.READ_TIMEOUT)
+        )
+        if response.status_code == 200:
+            return response.json()
+        print(f"Payment error: {response.status_code} {response.text}")
+    except Exception as e:
+        print(f"Payment error: {e}")
+    return None
+
+def show_payment_progress(chat_id: int, text: str) -> None:
+    '''Экран "создаём платёж" уходит сразу, итоговый экран потом заменит его на месте'''
+    smart_send_message(chat_id, text)
+    flush_reply()
+
 def handle_time_selection(chat_id: int, telegram_id: int, time_slot: str, conn) -> None:
     cursor = conn.cursor()
-    cursor.execute(f"SELECT state, order_data FROM {SCHEMA}.order_draft WHERE telegram_id = %s", (telegram_id,))
-    session = cursor.fetchone()
-    
-    if not session or session[0] != 'waiting_time':
+    cursor.execute(
+        f"DELETE FROM {SCHEMA}.order_draft WHERE telegram_id = %s AND state = %s RETURNING order_data",
+        (telegram_id, 'waiting_time')
+    )
+    draft = cursor.fetchone()
+    
+    if not draft:
+        # Повторное нажатие: черновик уже превращён в заказ, показываем его платёж
+        cursor.execute(
+            f"SELECT id, bag_count, address, preferred_time, price, payment_url FROM {SCHEMA}.orders "
+            "WHERE client_id = %s AND status = %s AND detailed_status = %s "
+            "AND created_at > LOCALTIMESTAMP - make_interval(mins => %s) "
+            "ORDER BY created_at DESC LIMIT 1",
+            (telegram_id, 'pending', 'waiting_payment', PAYMENT_REUSE_MINUTES)
+        )
+        pending_order = cursor.fetchone()
         cursor.close()
-        send_message(chat_id, "❌ Сессия истекла. Создайте заказ заново.")
-        return
-    
-    state, order_data_json = session
-    order_data = order_data_json if order_data_json else {}
-    
-    time_names = {
-        'morning': '🌅 Утро (8:00 - 12:00)',
-        'day': '☀️ День (12:00 - 16:00)',
-        'evening': '🌆 Вечер (16:00 - 20:00)',
-        'night': '🌙 Ночь (20:00 - 23:00)',
-        'asap': '⏰ Как можно скорее'
-    }
+        
+        if not pending_order:
+            send_message(chat_id, "❌ Сессия истекла. Создайте заказ заново.")
+            return
+        
+        order_id, bag_count, address, preferred_time, total_price, payment_url = pending_order
+        is_subscription = False
+    else:
+        order_data = draft[0] if draft[0] else {}
+        
+        time_names = {
+            'morning': '🌅 Утро (8:00 - 12:00)',
+            'day': '☀️ День (12:00 - 16:00)',
+            'evening': '🌆 Вечер (16:00 - 20:00)',
+            'night': '🌙 Ночь (20:00 - 23:00)',
+            'asap': '⏰ Как можно скорее'
+        }
+        
+        preferred_time = time_names.get(time_slot, 'Не указано')
+        
+        address = order_data.get('address', '')
+        bag_count = order_data.get('bag_count', 1)
+        is_subscription = order_data.get('is_subscription', False)
+        total_price = order_data.get('price', get_bag_price(conn) * bag_count)
+        detailed_status = 'searching_courier' if is_subscription else 'waiting_payment'
+        
+        cursor.execute(
+            f"INSERT INTO {SCHEMA}.orders (client_id, address, description, price, status, detailed_status, bag_count, is_subscription_order, payment_status, preferred_time) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id",
+            (telegram_id, address, f"Вывоз мусора ({bag_count} пакетов)", total_price, 'pending', detailed_status, bag_count, is_subscription, 'pending', preferred_time)
+        )
+        order_id = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+        payment_url = None
     
-    preferred_time = time_names.get(time_slot, 'Не указано')
+    if is_subscription:
+        text = (
+            f"✅ <b>Заказ #{order_id} создан!</b>\n\n"
+            f"📦 Количество: {bag_count} пакетов\n"
+            f"📍 Адрес: {address}\n"
+            f"🕐 Время: {preferred_time}\n"
+            f"💰 По подписке: 0 ₽\n\n"
+            "🔍 Курьер скоро увидит ваш заказ"
+        )
+        keyboard = {
+            'inline_keyboard': [
+                [{'text': '📦 Мои заказы', 'callback_data': 'client_active'}],
+                [{'text': '⬅️ Главное меню', 'callback_data': 'client_menu'}]
+            ]
+        }
+        smart_send_message(chat_id, text, keyboard)
+        return
     
-    address = order_data.get('address', '')
-    bag_count = order_data.get('bag_count', 1)
-    is_subscription = order_data.get('is_subscription', False)
-    total_price = order_data.get('price', get_bag_price(conn) * bag_count)
+    if not payment_url:
+        show_payment_progress(chat_id, f"⏳ <b>Заказ #{order_id} создан</b>\n\nСоздаём платёж...")
+        
+        payment = request_payment(total_price, f'Заказ #{order_id}: {bag_count} пакетов', str(order_id))
+        if not payment:
+            keyboard = {
+                'inline_keyboard': [
+                    [{'text': '🔄 Повторить', 'callback_data': f'time_{time_slot}'}],
+                    [{'text': '❌ Отменить заказ', 'callback_data': f'cancel_order_{order_id}'}]
+                ]
+            }
+            smart_send_message(chat_id, "❌ Ошибка создания платежа. Попробуйте позже", keyboard)
+            return
+        
+        payment_url = payment.get('payment_url')
+        cursor = conn.cursor()
+        cursor.execute(
+            f"UPDATE {SCHEMA}.orders SET payment_id = %s, payment_url = %s WHERE id = %s",
+            (payment.get('payment_id'), payment_url, order_id)
+        )
+        conn.commit()
+        cursor.close()
     
-    cursor.execute(
-        f"INSERT INTO {SCHEMA}.orders (client_id, address, description, price, status, detailed_status, bag_count, is_subscription_order, payment_status, preferred_time) "
-        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id",
-        (telegram_id, address, f"Вывоз мусора ({bag_count} пакетов)", total_price, 'pending', 'waiting_payment', bag_count, is_subscription, 'pending', preferred_time)
+    text = (
+        f"✅ <b>Заказ #{order_id} создан!</b>\n\n"
+        f"📦 Количество: {bag_count} пакетов\n"
+        f"📍 Адрес: {address}\n"
+        f"🕐 Время: {preferred_time}\n"
+        f"💰 Стоимость: {total_price} ₽\n\n"
+        "Пожалуйста, оплатите заказ:"
     )
-    order_id = cursor.fetchone()[0]
-    conn.commit()
-    
-    cursor.execute(f"DELETE FROM {SCHEMA}.order_draft WHERE telegram_id = %s", (telegram_id,))
-    conn.commit()
-    cursor.close()
-    
-    try:
-        import requests
-        payment_response = requests.post(
-            'https://functions.poehali.dev/b0e9d993-5a3b-4a63-892c-1148d0d2b71f',
-            json={
-                'order_id': order_id,
-                'amount': total_price,
-                'description': f'Заказ #{order_id}: {bag_count} пакетов'
-            },
-            timeout=10
-        )
-        
-        if payment_response.status_code == 200:
-            payment_data = payment_response.json()
-            payment_url = payment_data.get('payment_url')
-            
-            if is_subscription:
-                text = (
-                    f"✅ <b>Заказ #{order_id} создан!</b>\n\n"
-                    f"📦 Количество: {bag_count} пакетов\n"
-                    f"📍 Адрес: {address}\n"
-                    f"🕐 Время: {preferred_time}\n"
-                    f"💰 По подписке: 0 ₽\n\n"
-                    "🔍 Курьер скоро увидит ваш заказ"
-                )
-                keyboard = {
-                    'inline_keyboard': [
-                        [{'text': '📦 Мои заказы', 'callback_data': 'client_active'}],
-                        [{'text': '⬅️ Главное меню', 'callback_data': 'client_menu'}]
-                    ]
-                }
-                
-                cursor = conn.cursor()
-                cursor.execute(
-                    f"UPDATE {SCHEMA}.orders SET detailed_status = %s WHERE id = %s",
-                    ('searching_courier', order_id)
-                )
-                conn.commit()
-                cursor.close()
-            else:
-                text = (
-                    f"✅ <b>Заказ #{order_id} создан!</b>\n\n"
-                    f"📦 Количество: {bag_count} пакетов\n"
-                    f"📍 Адрес: {address}\n"
-                    f"🕐 Время: {preferred_time}\n"
-                    f"💰 Стоимость: {total_price} ₽\n\n"
-                    "Пожалуйста, оплатите заказ:"
-                )
-                keyboard = {
-                    'inline_keyboard': [
-                        [{'text': '💳 Оплатить', 'url': payment_url}],
-                        [{'text': '❌ Отменить заказ', 'callback_data': f'cancel_order_{order_id}'}]
-                    ]
-                }
-            
-            smart_send_message(chat_id, text, keyboard)
-        else:
-            send_message(chat_id, "❌ Ошибка создания платежа. Попробуйте позже")
-    except Exception as e:
-        print(f"Payment error: {e}")
-        send_message(chat_id, "❌ Ошибка создания платежа")
+    keyboard = {
+        'inline_keyboard': [
+            [{'text': '💳 Оплатить', 'url': payment_url}],
+            [{'text': '❌ Отменить заказ', 'callback_data': f'cancel_order_{order_id}'}]
+        ]
+    }
+    smart_send_message(chat_id, text, keyboard)
 
 def handle_select_bags(chat_id: int, telegram_id: int, bag_count: int, conn) -> None:
     from datetime import timedelta
@@ -847,40 +1029,22 @@ def handle_client_active_orders(chat_id: int, telegram_id: int, conn) -> None:
     smart_send_message(chat_id, text, keyboard)
 
 def handle_cancel_order(chat_id: int, telegram_id: int, order_id: int, conn) -> None:
-    cursor = conn.cursor()
-    
     role = check_user_role(telegram_id, conn)
     
-    cursor.execute(
-        "SELECT client_id, status, detailed_status FROM t_p39739760_garbage_bot_service.orders WHERE id = %s",
-        (order_id,)
-    )
-    order = cursor.fetchone()
-    
-    if not order:
-        cursor.close()
-        send_message(chat_id, "❌ Заказ не найден")
-        return
-    
-    client_id, status, detailed_status = order
+    outcome, order = transition_order(conn, order_id, 'cancel', telegram_id, staff=role in ['admin', 'operator'])
     
-    if client_id != telegram_id and role not in ['admin', 'operator']:
-        cursor.close()
-        send_message(chat_id, "❌ Это не ваш заказ")
-        return
-    
-    if status != 'pending' or detailed_status not in ['waiting_payment', 'searching_courier']:
-        cursor.close()
-        send_message(chat_id, "❌ Заказ уже принят курьером и не может быть отменен")
+    if outcome != 'ok':
+        conn.commit()
+        if outcome == 'not_found':
+            send_message(chat_id, "❌ Заказ не найден")
+        elif outcome == 'forbidden':
+            send_message(chat_id, "❌ Это не ваш заказ")
+        else:
+            send_message(chat_id, "❌ Заказ уже принят курьером и не может быть отменен")
         return
     
-    cursor.execute(
-        "UPDATE t_p39739760_garbage_bot_service.orders SET status = %s, detailed_status = %s WHERE id = %s",
-        ('cancelled', 'cancelled', order_id)
-    )
-    
+    cursor = conn.cursor()
     cursor.execute("DELETE FROM t_p39739760_garbage_bot_service.chat_sessions WHERE order_id = %s", (order_id,))
-    
     conn.commit()
     cursor.close()
     
@@ -951,24 +1115,20 @@ def handle_operator_change_status(chat_id: int, order_id: int, conn) -> None:
     smart_send_message(chat_id, text, keyboard)
 
 def handle_set_order_status(chat_id: int, order_id: int, new_status: str, conn) -> None:
-    cursor = conn.cursor()
-    
-    status_mapping = {
-        'completed': 'completed',
-        'cancelled': 'cancelled',
-        'searching_courier': 'pending',
-        'courier_on_way': 'accepted',
-        'courier_working': 'accepted'
-    }
-    
-    main_status = status_mapping.get(new_status, 'pending')
+    action = f'set_{new_status}'
+    if action not in ORDER_TRANSITIONS:
+        send_message(chat_id, "❌ Неизвестный статус")
+        return
     
-    cursor.execute(
-        "UPDATE t_p39739760_garbage_bot_service.orders SET detailed_status = %s, status = %s WHERE id = %s",
-        (new_status, main_status, order_id)
-    )
+    outcome, order = transition_order(conn, order_id, action, chat_id, staff=True)
     conn.commit()
-    cursor.close()
+    
+    if outcome == 'not_found':
+        send_message(chat_id, "❌ Заказ не найден")
+        return
+    if outcome == 'conflict':
+        send_message(chat_id, "❌ Заказ уже завершён или отменён, статус не изменён")
+        return
     
     status_text = ORDER_STATUSES.get(new_status, new_status)
     text = f"✅ Статус заказа #{order_id} изменён на: {status_text}"
@@ -982,43 +1142,61 @@ def handle_set_order_status(chat_id: int, order_id: int, new_status: str, conn)
     
     smart_send_message(chat_id, text, keyboard)
 
-def handle_admin_subscriptions(chat_id: int, conn) -> None:
-    cursor = conn.cursor()
+def handle_admin_subscriptions(chat_id: int, conn, direction: Optional[str] = None, token: Optional[str] = None) -> None:
+    direction, cursor_values = parse_page(direction, token, (date, int))
+    condition, order = keyset(direction, 's.end_date, s.id', descending=False)
     
-    cursor.execute(f"SELECT COUNT(*) FROM {SCHEMA}.subscriptions WHERE is_active = true AND end_date >= CURRENT_DATE")
-    active_count = cursor.fetchone()[0]
+    cursor = conn.cursor()
+    header = "⭐ <b>Управление подписками</b>\n\n"
     
-    cursor.execute(f"SELECT SUM(price) FROM {SCHEMA}.subscriptions WHERE is_active = true")
-    total_revenue = cursor.fetchone()[0] or 0
+    # Итоги проходят по всей таблице, поэтому считаются только на первой странице, а не при каждом листании
+    if not direction:
+        cursor.execute(
+            "SELECT COUNT(*) FILTER (WHERE end_date >= CURRENT_DATE), COALESCE(SUM(price), 0) "
+            f"FROM {SCHEMA}.subscriptions WHERE is_active = true"
+        )
+        active_count, total_revenue = cursor.fetchone()
+        header += f"📊 Активных: {active_count}\n💰 Доход: {total_revenue}₽\n\n"
     
     cursor.execute(
         f"SELECT s.id, u.first_name, u.telegram_id, s.type, s.end_date, s.bags_used_today "
         f"FROM {SCHEMA}.subscriptions s "
         f"JOIN {SCHEMA}.users u ON s.client_id = u.telegram_id "
-        "WHERE s.is_active = true AND s.end_date >= CURRENT_DATE "
-        "ORDER BY s.end_date ASC LIMIT 20"
+        f"WHERE s.is_active = true AND s.end_date >= CURRENT_DATE AND {condition} "
+        f"ORDER BY {order} LIMIT %s",
+        (*cursor_values, PAGE_SIZE + 1)
     )
-    subscriptions = cursor.fetchall()
+    subscriptions, has_prev, has_next = split_page(cursor.fetchall(), direction)
     cursor.close()
     
-    text = f"⭐ <b>Управление подписками</b>\n\n📊 Активных: {active_count}\n💰 Доход: {total_revenue}₽\n\n"
     keyboard_buttons = []
     
     if subscriptions:
-        text += "<b>Активные подписки:</b>\n\n"
+        entries = []
         for sub in subscriptions:
             sub_id, name, tg_id, sub_type, end_date, bags_used = sub
             sub_name = "Ежедневно" if sub_type == 'daily' else "Через день"
             days_left = (end_date - datetime.now().date()).days
-            text += f"👤 {name} (ID: {tg_id})\n"
-            text += f"📅 {sub_name}, до {end_date.strftime('%d.%m')}, {days_left}д\n"
-            text += f"📦 Использовано: {bags_used}/2\n\n"
-            
+            entry = f"👤 {name} (ID: {tg_id})\n"
+            entry += f"📅 {sub_name}, до {end_date.strftime('%d.%m')}, {days_left}д\n"
+            entry += f"📦 Использовано: {bags_used}/2\n\n"
+            entries.append(entry)
+        
+        text, shown = fit_entries(header + "<b>Активные подписки:</b>\n\n", entries)
+        has_next = has_next or shown < len(subscriptions)
+        subscriptions = subscriptions[:shown]
+        
+        for sub_id, name, *_ in subscriptions:
             keyboard_buttons.append([
                 {'text': f'❌ Отменить {name}', 'callback_data': f'cancel_sub_{sub_id}'}
             ])
+        
+        first, last = subscriptions[0], subscriptions[-1]
+        nav = nav_row('admin_subscriptions', encode_cursor(first[4], first[0]), encode_cursor(last[4], last[0]), has_prev, has_next)
+        if nav:
+            keyboard_buttons.append(nav)
     else:
-        text += "Нет активных подписок"
+        text = header + "Нет активных подписок"
     
     keyboard_buttons.append([{'text': '➕ Выдать подписку', 'callback_data': 'admin_add_subscription'}])
     keyboard_buttons.append([{'text': '⬅️ Назад', 'callback_data': 'admin_panel'}])
@@ -1035,7 +1213,7 @@ def handle_cancel_subscription(chat_id: int, sub_id: int, conn) -> None:
     cursor.close()
     
     if client:
-        send_message(client[0], "❌ Ваша подписка отменена администратором")
+        notify(client[0], "❌ Ваша подписка отменена администратором")
     
     send_message(chat_id, "✅ Подписка отменена")
     handle_admin_subscriptions(chat_id, conn)
@@ -1096,7 +1274,7 @@ def handle_admin_grant_subscription(chat_id: int, client_id: int, sub_type: str,
             [{'text': '⬅️ В меню', 'callback_data': 'client_menu'}]
         ]
     }
-    send_message(client_id, text, keyboard)
+    notify(client_id, text, keyboard)
     send_message(chat_id, f"✅ Подписка '{sub_name}' выдана пользователю {client_id}")
 
 def handle_admin_panel(chat_id: int, conn) -> None:
@@ -1183,12 +1361,16 @@ def handle_update_price(chat_id: int, price_type: str, new_price: int, conn) ->
         send_message(chat_id, "❌ Неверный тип цены")
         return
     
+    # Версия кэша настроек — max(updated_at), поэтому метка всегда сдвигается вперёд
     cursor.execute(
-        f"UPDATE {SCHEMA}.settings SET value = %s, updated_at = CURRENT_TIMESTAMP WHERE key = %s",
+        f"UPDATE {SCHEMA}.settings SET value = %s, "
+        f"updated_at = GREATEST(CURRENT_TIMESTAMP, (SELECT MAX(updated_at) FROM {SCHEMA}.settings) + INTERVAL '1 millisecond') "
+        "WHERE key = %s",
         (str(new_price), key)
     )
     conn.commit()
     cursor.close()
+    _context.settings = None
     
     text = f"✅ {name} изменена на {new_price}₽"
     keyboard = {'inline_keyboard': [[{'text': '⬅️ К настройкам цен', 'callback_data': 'admin_prices'}]]}
@@ -1262,33 +1444,20 @@ def handle_admin_add_operator(chat_id: int) -> None:
 
 def handle_admin_stats(chat_id: int, conn) -> None:
     cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) FROM t_p39739760_garbage_bot_service.users WHERE role = %s", ('client',))
-    total_clients = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM t_p39739760_garbage_bot_service.users WHERE role = %s", ('courier',))
-    total_couriers = cursor.fetchone()[0]
-    
-    cursor.execute(f"SELECT COUNT(*) FROM {SCHEMA}.operator_users")
-    total_operators = cursor.fetchone()[0]
-    
-    cursor.execute(f"SELECT COUNT(*) FROM {SCHEMA}.orders")
-    total_orders = cursor.fetchone()[0]
-    
-    cursor.execute(f"SELECT COUNT(*) FROM {SCHEMA}.orders WHERE status = %s", ('completed',))
-    completed_orders = cursor.fetchone()[0]
-    
-    cursor.execute(f"SELECT SUM(price) FROM {SCHEMA}.orders WHERE status = %s", ('completed',))
-    total_revenue = cursor.fetchone()[0] or 0
-    
     cursor.execute(
-        f"SELECT AVG(price) FROM {SCHEMA}.orders WHERE status = %s",
-        ('completed',)
-    )
-    avg_order = cursor.fetchone()[0] or 0
-    
+        f"SELECT (SELECT COUNT(*) FROM {SCHEMA}.users WHERE role = 'client'), "
+        f"(SELECT COUNT(*) FROM {SCHEMA}.users WHERE role = 'courier'), "
+        f"(SELECT COUNT(*) FROM {SCHEMA}.operator_users), "
+        "COALESCE(SUM(order_count), 0), "
+        "COALESCE(SUM(order_count) FILTER (WHERE status = 'completed'), 0), "
+        "COALESCE(SUM(revenue) FILTER (WHERE status = 'completed'), 0) "
+        f"FROM {SCHEMA}.order_status_counters"
+    )
+    total_clients, total_couriers, total_operators, total_orders, completed_orders, total_revenue = cursor.fetchone()
     cursor.close()
     
+    avg_order = total_revenue / completed_orders if completed_orders else 0
+    
     text = (
         "📊 <b>Статистика сервиса</b>\n\n"
         f"👥 Пользователей:\n"
@@ -1306,58 +1475,83 @@ def handle_admin_stats(chat_id: int, conn) -> None:
     keyboard = {'inline_keyboard': [[{'text': '⬅️ Назад', 'callback_data': 'admin_panel'}]]}
     smart_send_message(chat_id, text, keyboard)
 
-def handle_admin_couriers_list(chat_id: int, conn) -> None:
+def handle_admin_couriers_list(chat_id: int, conn, direction: Optional[str] = None, token: Optional[str] = None) -> None:
+    direction, cursor_values = parse_page(direction, token, (int,))
+    condition, order = keyset(direction, 'u.id', descending=True)
+    
     cursor = conn.cursor()
     cursor.execute(
-        f"SELECT u.telegram_id, u.username, u.first_name, cs.total_orders, cs.total_earnings "
+        f"SELECT u.telegram_id, u.username, u.first_name, cs.total_orders, cs.total_earnings, u.id "
         f"FROM {SCHEMA}.users u "
         f"LEFT JOIN {SCHEMA}.courier_stats cs ON u.telegram_id = cs.courier_id "
-        "WHERE u.role = %s "
-        "ORDER BY cs.total_orders DESC NULLS LAST LIMIT 20",
-        ('courier',)
+        f"WHERE u.role = %s AND {condition} "
+        f"ORDER BY {order} LIMIT %s",
+        ('courier', *cursor_values, PAGE_SIZE + 1)
     )
-    couriers = cursor.fetchall()
+    couriers, has_prev, has_next = split_page(cursor.fetchall(), direction)
     cursor.close()
     
+    keyboard_buttons = []
     if not couriers:
         text = "👔 <b>Список курьеров</b>\n\nНет зарегистрированных курьеров"
     else:
-        text = "👔 <b>Список курьеров</b>\n\n"
+        entries = []
         for courier in couriers:
-            telegram_id, username, first_name, total_orders, total_earnings = courier
+            telegram_id, username, first_name, total_orders, total_earnings, user_id = courier
             orders = total_orders or 0
             earnings = total_earnings or 0
-            text += f"👤 {first_name} (@{username or 'нет'})\n"
-            text += f"ID: {telegram_id}\n"
-            text += f"Заказов: {orders} | Заработано: {earnings} ₽\n\n"
+            entry = f"👤 {first_name} (@{username or 'нет'})\n"
+            entry += f"ID: {telegram_id}\n"
+            entry += f"Заказов: {orders} | Заработано: {earnings} ₽\n\n"
+            entries.append(entry)
+        
+        text, shown = fit_entries("👔 <b>Список курьеров</b>\n\n", entries)
+        has_next = has_next or shown < len(couriers)
+        nav = nav_row('admin_couriers_list', encode_cursor(couriers[0][5]), encode_cursor(couriers[shown - 1][5]), has_prev, has_next)
+        if nav:
+            keyboard_buttons.append(nav)
     
-    keyboard = {'inline_keyboard': [[{'text': '⬅️ Назад', 'callback_data': 'admin_couriers'}]]}
-    smart_send_message(chat_id, text, keyboard)
+    keyboard_buttons.append([{'text': '⬅️ Назад', 'callback_data': 'admin_couriers'}])
+    smart_send_message(chat_id, text, {'inline_keyboard': keyboard_buttons})
 
-def handle_admin_operators_list(chat_id: int, conn) -> None:
+def handle_admin_operators_list(chat_id: int, conn, direction: Optional[str] = None, token: Optional[str] = None) -> None:
+    direction, cursor_values = parse_page(direction, token, (datetime, int))
+    condition, order = keyset(direction, 'ou.created_at, ou.telegram_id', descending=True)
+    
     cursor = conn.cursor()
     cursor.execute(
         f"SELECT u.telegram_id, u.username, u.first_name, ou.created_at "
         f"FROM {SCHEMA}.operator_users ou "
         "JOIN t_p39739760_garbage_bot_service.users u ON ou.telegram_id = u.telegram_id "
-        "ORDER BY ou.created_at DESC"
+        f"WHERE {condition} "
+        f"ORDER BY {order} LIMIT %s",
+        (*cursor_values, PAGE_SIZE + 1)
     )
-    operators = cursor.fetchall()
+    operators, has_prev, has_next = split_page(cursor.fetchall(), direction)
     cursor.close()
     
+    keyboard_buttons = []
     if not operators:
         text = "👥 <b>Список операторов</b>\n\nНет назначенных операторов"
     else:
-        text = "👥 <b>Список операторов</b>\n\n"
+        entries = []
         for operator in operators:
             telegram_id, username, first_name, created_at = operator
             date_str = created_at.strftime("%d.%m.%Y")
-            text += f"👤 {first_name} (@{username or 'нет'})\n"
-            text += f"ID: {telegram_id}\n"
-            text += f"Назначен: {date_str}\n\n"
-    
-    keyboard = {'inline_keyboard': [[{'text': '⬅️ Назад', 'callback_data': 'admin_operators'}]]}
-    smart_send_message(chat_id, text, keyboard)
+            entry = f"👤 {first_name} (@{username or 'нет'})\n"
+            entry += f"ID: {telegram_id}\n"
+            entry += f"Назначен: {date_str}\n\n"
+            entries.append(entry)
+        
+        text, shown = fit_entries("👥 <b>Список операторов</b>\n\n", entries)
+        has_next = has_next or shown < len(operators)
+        first, last = operators[0], operators[shown - 1]
+        nav = nav_row('admin_operators_list', encode_cursor(first[3], first[0]), encode_cursor(last[3], last[0]), has_prev, has_next)
+        if nav:
+            keyboard_buttons.append(nav)
+    
+    keyboard_buttons.append([{'text': '⬅️ Назад', 'callback_data': 'admin_operators'}])
+    smart_send_message(chat_id, text, {'inline_keyboard': keyboard_buttons})
 
 def handle_admin_remove_courier_prompt(chat_id: int) -> None:
     text = (
@@ -1405,8 +1599,9 @@ def handle_remove_courier(chat_id: int, courier_id: int, conn) -> None:
     )
     conn.commit()
     cursor.close()
+    invalidate_role(courier_id)
     
-    send_message(courier_id, "❌ Вы больше не являетесь курьером. Статус изменён на клиента.")
+    notify(courier_id, "❌ Вы больше не являетесь курьером. Статус изменён на клиента.")
     send_message(chat_id, f"✅ Курьер {courier_id} удалён и переведён в статус клиента")
 
 def handle_remove_operator(chat_id: int, operator_id: int, conn) -> None:
@@ -1423,8 +1618,9 @@ def handle_remove_operator(chat_id: int, operator_id: int, conn) -> None:
     cursor.execute("DELETE FROM t_p39739760_garbage_bot_service.operator_users WHERE telegram_id = %s", (operator_id,))
     conn.commit()
     cursor.close()
+    invalidate_role(operator_id)
     
-    send_message(operator_id, "❌ Вы больше не являетесь оператором. Доступ к панели оператора отключён.")
+    notify(operator_id, "❌ Вы больше не являетесь оператором. Доступ к панели оператора отключён.")
     send_message(chat_id, f"✅ Оператор {operator_id} удалён")
 
 def handle_add_operator(chat_id: int, admin_id: int, operator_id: int, conn) -> None:
@@ -1444,64 +1640,88 @@ def handle_add_operator(chat_id: int, admin_id: int, operator_id: int, conn) ->
     )
     conn.commit()
     cursor.close()
+    invalidate_role(operator_id)
     
-    send_message(operator_id, "✅ Вы назначены оператором! Используйте /start для доступа к панели оператора.")
+    notify(operator_id, "✅ Вы назначены оператором! Используйте /start для доступа к панели оператора.")
     send_message(chat_id, f"✅ Пользователь {operator_id} назначен оператором")
 
-def handle_client_history(chat_id: int, telegram_id: int, conn) -> None:
+def handle_client_history(chat_id: int, telegram_id: int, conn, direction: Optional[str] = None, token: Optional[str] = None) -> None:
+    direction, cursor_values = parse_page(direction, token, (datetime, int))
+    condition, order = keyset(direction, 'o.completed_at, o.id', descending=True)
+    
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT o.id, o.address, o.description, o.price, o.detailed_status, u.first_name "
+        "SELECT o.id, o.address, o.description, o.price, o.detailed_status, u.first_name, o.completed_at "
         "FROM t_p39739760_garbage_bot_service.orders o "
         "LEFT JOIN t_p39739760_garbage_bot_service.users u ON o.courier_id = u.telegram_id "
-        "WHERE o.client_id = %s AND o.status = %s "
-        "ORDER BY o.completed_at DESC LIMIT 10",
-        (telegram_id, 'completed')
+        f"WHERE o.client_id = %s AND o.status = %s AND {condition} "
+        f"ORDER BY {order} LIMIT %s",
+        (telegram_id, 'completed', *cursor_values, PAGE_SIZE + 1)
     )
-    orders = cursor.fetchall()
+    orders, has_prev, has_next = split_page(cursor.fetchall(), direction)
     cursor.close()
     
+    keyboard_buttons = []
     if not orders:
         text = "📊 <b>История заказов</b>\n\nНет завершённых заказов"
     else:
-        text = "📊 <b>История заказов</b>\n\n"
+        entries = []
         for order in orders:
-            order_id, address, description, price, detailed_status, courier_name = order
-            text += f"🆔 Заказ #{order_id}\n"
-            text += f"📍 {address}\n"
-            text += f"📝 {description}\n"
-            text += f"💰 {price} ₽\n"
+            order_id, address, description, price, detailed_status, courier_name, completed_at = order
+            entry = f"🆔 Заказ #{order_id}\n"
+            entry += f"📍 {address}\n"
+            entry += f"📝 {description}\n"
+            entry += f"💰 {price} ₽\n"
             if courier_name:
-                text += f"Курьер: {courier_name}\n"
-            text += "\n"
+                entry += f"Курьер: {courier_name}\n"
+            entries.append(entry + "\n")
+        
+        text, shown = fit_entries("📊 <b>История заказов</b>\n\n", entries)
+        has_next = has_next or shown < len(orders)
+        first, last = orders[0], orders[shown - 1]
+        nav = nav_row('client_history', encode_cursor(first[6], first[0]), encode_cursor(last[6], last[0]), has_prev, has_next)
+        if nav:
+            keyboard_buttons.append(nav)
     
-    keyboard = {'inline_keyboard': [[{'text': '⬅️ Назад', 'callback_data': 'client_menu'}]]}
-    smart_send_message(chat_id, text, keyboard)
+    keyboard_buttons.append([{'text': '⬅️ Назад', 'callback_data': 'client_menu'}])
+    smart_send_message(chat_id, text, {'inline_keyboard': keyboard_buttons})
 
-def handle_courier_history(chat_id: int, telegram_id: int, conn) -> None:
+def handle_courier_history(chat_id: int, telegram_id: int, conn, direction: Optional[str] = None, token: Optional[str] = None) -> None:
+    direction, cursor_values = parse_page(direction, token, (datetime, int))
+    condition, order = keyset(direction, 'completed_at, id', descending=True)
+    
     cursor = conn.cursor()
     cursor.execute(
-        f"SELECT id, address, description, price FROM {SCHEMA}.orders "
-        "WHERE courier_id = %s AND status = %s "
-        "ORDER BY completed_at DESC LIMIT 10",
-        (telegram_id, 'completed')
+        f"SELECT id, address, description, price, completed_at FROM {SCHEMA}.orders "
+        f"WHERE courier_id = %s AND status = %s AND {condition} "
+        f"ORDER BY {order} LIMIT %s",
+        (telegram_id, 'completed', *cursor_values, PAGE_SIZE + 1)
     )
-    orders = cursor.fetchall()
+    orders, has_prev, has_next = split_page(cursor.fetchall(), direction)
     cursor.close()
     
+    keyboard_buttons = []
     if not orders:
         text = "📊 <b>История заказов</b>\n\nНет завершённых заказов"
     else:
-        text = "📊 <b>История заказов</b>\n\n"
+        entries = []
         for order in orders:
-            order_id, address, description, price = order
-            text += f"🆔 Заказ #{order_id}\n"
-            text += f"📍 {address}\n"
-            text += f"📝 {description}\n"
-            text += f"💰 {price} ₽\n\n"
+            order_id, address, description, price, completed_at = order
+            entry = f"🆔 Заказ #{order_id}\n"
+            entry += f"📍 {address}\n"
+            entry += f"📝 {description}\n"
+            entry += f"💰 {price} ₽\n\n"
+            entries.append(entry)
+        
+        text, shown = fit_entries("📊 <b>История заказов</b>\n\n", entries)
+        has_next = has_next or shown < len(orders)
+        first, last = orders[0], orders[shown - 1]
+        nav = nav_row('courier_history', encode_cursor(first[4], first[0]), encode_cursor(last[4], last[0]), has_prev, has_next)
+        if nav:
+            keyboard_buttons.append(nav)
     
-    keyboard = {'inline_keyboard': [[{'text': '⬅️ Назад', 'callback_data': 'start'}]]}
-    smart_send_message(chat_id, text, keyboard)
+    keyboard_buttons.append([{'text': '⬅️ Назад', 'callback_data': 'start'}])
+    smart_send_message(chat_id, text, {'inline_keyboard': keyboard_buttons})
 
 def handle_client_payment(chat_id: int) -> None:
     text = (
@@ -1517,7 +1737,6 @@ def handle_client_payment(chat_id: int) -> None:
 
 def handle_buy_subscription(chat_id: int, telegram_id: int, sub_type: str, conn) -> None:
     from datetime import timedelta
-    import requests
     
     daily_price, alternate_price = get_subscription_prices(conn)
     price = daily_price if sub_type == 'daily' else alternate_price
@@ -1525,76 +1744,72 @@ def handle_buy_subscription(chat_id: int, telegram_id: int, sub_type: str, conn)
     
     cursor = conn.cursor()
     
-    start_date = datetime.now().date()
-    end_date = start_date + timedelta(days=30)
-    
+    # Повторное нажатие: свежая неоплаченная подписка того же типа переиспользуется вместе с её платежом
     cursor.execute(
-        f"INSERT INTO {SCHEMA}.subscriptions (client_id, type, price, start_date, end_date, is_active, payment_status) "
-        "VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id",
-        (telegram_id, sub_type, price, start_date, end_date, False, 'pending')
+        f"SELECT id, price, payment_url FROM {SCHEMA}.subscriptions "
+        "WHERE client_id = %s AND type = %s AND is_active = false AND payment_status = %s "
+        "AND created_at > LOCALTIMESTAMP - make_interval(mins => %s) "
+        "ORDER BY created_at DESC LIMIT 1",
+        (telegram_id, sub_type, 'pending', PAYMENT_REUSE_MINUTES)
     )
-    subscription_id = cursor.fetchone()[0]
-    conn.commit()
+    pending_subscription = cursor.fetchone()
     
-    text = (
-        f"⭐ <b>Оформление подписки '{sub_name}'</b>\n\n"
-        f"💰 Стоимость: {price}₽ в месяц\n\n"
-        "📋 Что входит:\n"
-        "• Вывоз до 2 пакетов в день\n"
-        "• Без дополнительных платежей\n\n"
-        "Создаём платёж..."
-    )
-    smart_send_message(chat_id, text)
+    if pending_subscription:
+        subscription_id, price, payment_url = pending_subscription
+    else:
+        start_date = datetime.now().date()
+        end_date = start_date + timedelta(days=30)
+        
+        cursor.execute(
+            f"INSERT INTO {SCHEMA}.subscriptions (client_id, type, price, start_date, end_date, is_active, payment_status) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id",
+            (telegram_id, sub_type, price, start_date, end_date, False, 'pending')
+        )
+        subscription_id = cursor.fetchone()[0]
+        conn.commit()
+        payment_url = None
     
-    try:
-        payment_response = requests.post(
-            'https://functions.poehali.dev/b0e9d993-5a3b-4a63-892c-1148d0d2b71f',
-            json={
-                'amount': price,
-                'description': f"Подписка #{subscription_id}: {sub_name} (30 дней)",
-                'order_id': f"sub_{subscription_id}"
-            },
-            timeout=10
+    if not payment_url:
+        text = (
+            f"⭐ <b>Оформление подписки '{sub_name}'</b>\n\n"
+            f"💰 Стоимость: {price}₽ в месяц\n\n"
+            "📋 Что входит:\n"
+            "• Вывоз до 2 пакетов в день\n"
+            "• Без дополнительных платежей\n\n"
+            "Создаём платёж..."
         )
+        show_payment_progress(chat_id, text)
         
-        if payment_response.status_code == 200:
-            payment_data = payment_response.json()
-            payment_url = payment_data.get('payment_url')
-            payment_id = payment_data.get('payment_id')
-            
-            cursor.execute(
-                f"UPDATE {SCHEMA}.subscriptions SET payment_id = %s, payment_url = %s WHERE id = %s",
-                (payment_id, payment_url, subscription_id)
-            )
-            conn.commit()
-            
-            text = (
-                f"💳 <b>Оплата подписки '{sub_name}'</b>\n\n"
-                f"💰 Сумма: {price}₽\n"
-                f"📅 Срок: 30 дней\n\n"
-                "Нажмите кнопку ниже для оплаты:"
-            )
-            keyboard = {
-                'inline_keyboard': [
-                    [{'text': '💳 Оплатить подписку', 'url': payment_url}],
-                    [{'text': '❌ Отменить', 'callback_data': 'client_subscription'}]
-                ]
-            }
-            smart_send_message(chat_id, text, keyboard)
-        else:
-            cursor.execute(f"DELETE FROM {SCHEMA}.subscriptions WHERE id = %s", (subscription_id,))
-            conn.commit()
+        payment = request_payment(price, f"Подписка #{subscription_id}: {sub_name} (30 дней)", f"sub_{subscription_id}")
+        if not payment:
+            cursor.close()
             text = "❌ Ошибка при создании платежа. Попробуйте позже."
             keyboard = {'inline_keyboard': [[{'text': '⬅️ Назад', 'callback_data': 'client_subscription'}]]}
             smart_send_message(chat_id, text, keyboard)
-    except Exception as e:
-        cursor.execute(f"DELETE FROM {SCHEMA}.subscriptions WHERE id = %s", (subscription_id,))
+            return
+        
+        payment_url = payment.get('payment_url')
+        cursor.execute(
+            f"UPDATE {SCHEMA}.subscriptions SET payment_id = %s, payment_url = %s WHERE id = %s",
+            (payment.get('payment_id'), payment_url, subscription_id)
+        )
         conn.commit()
-        text = "❌ Ошибка при создании платежа. Попробуйте позже."
-        keyboard = {'inline_keyboard': [[{'text': '⬅️ Назад', 'callback_data': 'client_subscription'}]]}
-        smart_send_message(chat_id, text, keyboard)
     
     cursor.close()
+    
+    text = (
+        f"💳 <b>Оплата подписки '{sub_name}'</b>\n\n"
+        f"💰 Сумма: {price}₽\n"
+        f"📅 Срок: 30 дней\n\n"
+        "Нажмите кнопку ниже для оплаты:"
+    )
+    keyboard = {
+        'inline_keyboard': [
+            [{'text': '💳 Оплатить подписку', 'url': payment_url}],
+            [{'text': '❌ Отменить', 'callback_data': 'client_subscription'}]
+        ]
+    }
+    smart_send_message(chat_id, text, keyboard)
 
 def handle_client_subscription(chat_id: int, telegram_id: int, conn) -> None:
     cursor = conn.cursor()
@@ -1671,19 +1886,13 @@ def handle_courier_withdraw(chat_id: int, telegram_id: int, conn) -> None:
 
 def handle_operator_stats(chat_id: int, conn) -> None:
     cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) FROM t_p39739760_garbage_bot_service.orders WHERE status = %s", ('pending',))
-    pending = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM t_p39739760_garbage_bot_service.orders WHERE status = %s", ('accepted',))
-    active = cursor.fetchone()[0]
-    
     cursor.execute(
-        "SELECT COUNT(*) FROM t_p39739760_garbage_bot_service.orders WHERE status = %s AND DATE(completed_at) = CURRENT_DATE",
-        ('completed',)
+        "SELECT COALESCE(SUM(order_count) FILTER (WHERE status = 'pending'), 0), "
+        "COALESCE(SUM(order_count) FILTER (WHERE status = 'accepted'), 0), "
+        f"COALESCE((SELECT completed_count FROM {SCHEMA}.order_daily_counters WHERE day = CURRENT_DATE), 0) "
+        f"FROM {SCHEMA}.order_status_counters"
     )
-    today_completed = cursor.fetchone()[0]
-    
+    pending, active, today_completed = cursor.fetchone()
     cursor.close()
     
     text = (
@@ -1696,16 +1905,30 @@ def handle_operator_stats(chat_id: int, conn) -> None:
     keyboard = {'inline_keyboard': [[{'text': '⬅️ Назад', 'callback_data': 'start'}]]}
     smart_send_message(chat_id, text, keyboard)
 
+def mark_chat_read(cursor, order_id: int, telegram_id: int, last_message_id: Optional[int], message_count: int) -> None:
+    '''Отметка прочтения переписки до показанного сообщения; без коммита, в транзакции вызывающего'''
+    cursor.execute(
+        f"INSERT INTO {SCHEMA}.chat_read_markers AS m (order_id, telegram_id, last_read_message_id, last_read_count) "
+        "VALUES (%s, %s, %s, %s) "
+        "ON CONFLICT (order_id, telegram_id) DO UPDATE "
+        "SET last_read_message_id = GREATEST(m.last_read_message_id, EXCLUDED.last_read_message_id), "
+        "last_read_count = GREATEST(m.last_read_count, EXCLUDED.last_read_count), updated_at = CURRENT_TIMESTAMP",
+        (order_id, telegram_id, last_message_id or 0, message_count)
+    )
+
 def handle_operator_chats(chat_id: int, conn) -> None:
     cursor = conn.cursor()
     cursor.execute(
         "SELECT o.id, o.address, u1.first_name as client_name, u2.first_name as courier_name, "
-        "(SELECT COUNT(*) FROM t_p39739760_garbage_bot_service.order_chat WHERE order_id = o.id AND is_archived = FALSE) as message_count, o.created_at, o.detailed_status "
+        "o.chat_message_count, o.created_at, o.detailed_status, "
+        "o.chat_message_count - COALESCE(m.last_read_count, 0) as unread_count "
         "FROM t_p39739760_garbage_bot_service.orders o "
         "JOIN t_p39739760_garbage_bot_service.users u1 ON o.client_id = u1.telegram_id "
         "LEFT JOIN t_p39739760_garbage_bot_service.users u2 ON o.courier_id = u2.telegram_id "
-        "WHERE o.status NOT IN ('completed', 'cancelled') "
-        "ORDER BY o.created_at DESC LIMIT 20"
+        "LEFT JOIN t_p39739760_garbage_bot_service.chat_read_markers m ON m.order_id = o.id AND m.telegram_id = %s "
+        "WHERE o.status IN ('pending', 'accepted') "
+        "ORDER BY COALESCE(o.last_message_at, o.created_at) DESC, o.id DESC LIMIT 20",
+        (chat_id,)
     )
     orders = cursor.fetchall()
     cursor.close()
@@ -1721,14 +1944,16 @@ def handle_operator_chats(chat_id: int, conn) -> None:
         keyboard_buttons = []
         
         for order in orders:
-            order_id, address, client_name, courier_name, msg_count, created_at, detailed_status = order
+            order_id, address, client_name, courier_name, msg_count, created_at, detailed_status, unread_count = order
             status_emoji = ORDER_STATUSES.get(detailed_status, '📦')
+            unread_badge = f" 🔴 {unread_count}" if unread_count > 0 else ""
             text += f"🆔 Заказ #{order_id} {status_emoji}\n"
             text += f"👤 Клиент: {client_name}\n"
             text += f"👔 Курьер: {courier_name or 'не назначен'}\n"
-            text += f"💬 Сообщений: {msg_count}\n\n"
+            text += f"💬 Сообщений: {msg_count}"
+            text += f" (новых: {unread_count})\n\n" if unread_count > 0 else "\n\n"
             
-            keyboard_buttons.append([{'text': f'💬 Чат #{order_id} - {client_name}', 'callback_data': f'view_chat_{order_id}'}])
+            keyboard_buttons.append([{'text': f'💬 Чат #{order_id} - {client_name}{unread_badge}', 'callback_data': f'view_chat_{order_id}'}])
         
         keyboard_buttons.append([{'text': '🔍 Найти чат по номеру', 'callback_data': 'search_chat'}])
         keyboard_buttons.append([{'text': '⬅️ Назад', 'callback_data': 'start'}])
@@ -1741,12 +1966,20 @@ def handle_search_chat_prompt(chat_id: int) -> None:
     keyboard = {'inline_keyboard': [[{'text': '❌ Отмена', 'callback_data': 'operator_chats'}]]}
     send_message(chat_id, text, keyboard)
 
-def handle_view_chat(chat_id: int, order_id: int, conn) -> None:
+def handle_view_chat(chat_id: int, order_id: int, conn, direction: Optional[str] = None, token: Optional[str] = None) -> None:
+    '''
+    Переписка заказа для оператора: живые и архивные сообщения одним потоком по ключу
+    (created_at, id). Без курсора показываются последние сообщения, ◀️ листает к более ранним.
+    '''
+    direction, cursor_values = parse_page(direction, token, (datetime, int))
+    condition, order = keyset(direction, 'created_at, id', descending=True)
+    _, merged_order = keyset(direction, 'm.created_at, m.id', descending=True)
+    
     cursor = conn.cursor()
     
     cursor.execute(
         "SELECT o.id, u1.first_name as client_name, u1.telegram_id as client_id, "
-        "u2.first_name as courier_name, u2.telegram_id as courier_id "
+        "u2.first_name as courier_name, u2.telegram_id as courier_id, o.last_message_id, o.chat_message_count "
         "FROM t_p39739760_garbage_bot_service.orders o "
         "JOIN t_p39739760_garbage_bot_service.users u1 ON o.client_id = u1.telegram_id "
         "LEFT JOIN t_p39739760_garbage_bot_service.users u2 ON o.courier_id = u2.telegram_id "
@@ -1760,63 +1993,40 @@ def handle_view_chat(chat_id: int, order_id: int, conn) -> None:
         send_message(chat_id, "❌ Заказ не найден")
         return
     
-    order_id, client_name, client_id, courier_name, courier_id = order_info
+    order_id, client_name, client_id, courier_name, courier_id, last_message_id, message_count = order_info
     
+    # Каждая ветка отдаёт не больше страницы + 1 строку по индексу (order_id, created_at, id)
     cursor.execute(
-        "SELECT oc.message, oc.created_at, u.first_name, oc.sender_id "
-        "FROM t_p39739760_garbage_bot_service.order_chat oc "
-        "JOIN t_p39739760_garbage_bot_service.users u ON oc.sender_id = u.telegram_id "
-        "WHERE oc.order_id = %s AND oc.is_archived = FALSE "
-        "ORDER BY oc.created_at ASC LIMIT 50",
-        (order_id,)
-    )
-    messages = cursor.fetchall()
-    
-    cursor.execute(
-        f"SELECT oca.message, oca.created_at, u.first_name, oca.sender_id "
-        f"FROM {SCHEMA}.order_chat_archive oca "
-        f"JOIN {SCHEMA}.users u ON oca.sender_id = u.telegram_id "
-        "WHERE oca.order_id = %s "
-        "ORDER BY oca.created_at ASC",
-        (order_id,)
-    )
-    archived_messages = cursor.fetchall()
+        "SELECT m.id, m.message, m.created_at, u.first_name, m.sender_id FROM ("
+        f"    (SELECT id, sender_id, message, created_at FROM {SCHEMA}.order_chat "
+        f"     WHERE order_id = %s AND is_archived = FALSE AND {condition} ORDER BY {order} LIMIT %s) "
+        "    UNION ALL "
+        f"    (SELECT id, sender_id, message, created_at FROM {SCHEMA}.order_chat_archive "
+        f"     WHERE order_id = %s AND {condition} ORDER BY {order} LIMIT %s)"
+        ") m "
+        f"JOIN {SCHEMA}.users u ON u.telegram_id = m.sender_id "
+        f"ORDER BY {merged_order} LIMIT %s",
+        (order_id, *cursor_values, CHAT_PAGE_SIZE + 1, order_id, *cursor_values, CHAT_PAGE_SIZE + 1, CHAT_PAGE_SIZE + 1)
+    )
+    messages, has_newer, has_older = split_page(cursor.fetchall(), direction, CHAT_PAGE_SIZE)
     cursor.close()
     
-    text = f"💬 <b>Чат заказа #{order_id}</b>\n\n"
-    text += f"👤 Клиент: {client_name} (ID: {client_id})\n"
-    text += f"👔 Курьер: {courier_name or 'не назначен'}"
+    header = f"💬 <b>Чат заказа #{order_id}</b>\n\n"
+    header += f"👤 Клиент: {client_name} (ID: {client_id})\n"
+    header += f"👔 Курьер: {courier_name or 'не назначен'}"
     if courier_id:
-        text += f" (ID: {courier_id})"
-    text += "\n\n━━━━━━━━━━━━━━━━━━\n\n"
-    
-    if archived_messages:
-        text += "📁 <b>Архивные сообщения:</b>\n\n"
-        for msg in archived_messages:
-            message_text, created_at, sender_name, sender_id = msg
-            date_str = created_at.strftime("%d.%m %H:%M")
-            
-            if sender_id == client_id:
-                icon = "👤"
-            elif sender_id == courier_id:
-                icon = "👔"
-            else:
-                icon = "⚙️"
-            
-            text += f"{icon} <b>{sender_name}</b> ({date_str}):\n{message_text}\n\n"
-        
-        text += "━━━━━━━━━━━━━━━━━━\n\n"
+        header += f" (ID: {courier_id})"
+    header += "\n\n━━━━━━━━━━━━━━━━━━\n\n"
+    footer = "\n━━━━━━━━━━━━━━━━━━\n\n💬 Отправьте сообщение чтобы ответить"
     
+    nav = []
     if not messages:
-        if not archived_messages:
-            text += "Сообщений пока нет"
-        else:
-            text += "Новых сообщений нет"
+        text = header + ("Сообщений пока нет" if not direction else "Сообщений больше нет") + footer
     else:
-        text += "💬 <b>Текущие сообщения:</b>\n\n"
+        entries = []
         for msg in messages:
-            message_text, created_at, sender_name, sender_id = msg
-            time_str = created_at.strftime("%H:%M")
+            message_id, message_text, created_at, sender_name, sender_id = msg
+            date_str = created_at.strftime("%d.%m %H:%M")
             
             if sender_id == client_id:
                 icon = "👤"
@@ -1825,12 +2035,27 @@ def handle_view_chat(chat_id: int, order_id: int, conn) -> None:
             else:
                 icon = "⚙️"
             
-            text += f"{icon} <b>{sender_name}</b> ({time_str}):\n{message_text}\n\n"
-    
-    text += "\n━━━━━━━━━━━━━━━━━━\n\n💬 Отправьте сообщение чтобы ответить"
+            entries.append(f"{icon} <b>{sender_name}</b> ({date_str}):\n{message_text}\n\n")
+        
+        # Если страница не влезает в лимит, отбрасываются сообщения, дальние от точки входа
+        if direction == PREV:
+            messages.reverse()
+            entries.reverse()
+            text, shown = fit_entries(header, entries, footer)
+            has_newer = has_newer or shown < len(messages)
+            oldest, newest = messages[0], messages[shown - 1]
+        else:
+            text, shown = fit_entries(header, entries, footer, reverse=True)
+            has_older = has_older or shown < len(messages)
+            oldest, newest = messages[shown - 1], messages[0]
+        
+        if has_older:
+            nav.append({'text': '◀️', 'callback_data': f'chat_page_{order_id}_{NEXT}_{encode_cursor(oldest[2], oldest[0])}'})
+        if has_newer:
+            nav.append({'text': '▶️', 'callback_data': f'chat_page_{order_id}_{PREV}_{encode_cursor(newest[2], newest[0])}'})
     
     keyboard = {
-        'inline_keyboard': [
+        'inline_keyboard': ([nav] if nav else []) + [
             [{'text': '🔄 Обновить', 'callback_data': f'view_chat_{order_id}'}],
             [{'text': '❌ Закрыть чат', 'callback_data': 'close_chat'}],
             [{'text': '⬅️ Назад', 'callback_data': 'operator_chats'}]
@@ -1844,52 +2069,66 @@ def handle_view_chat(chat_id: int, order_id: int, conn) -> None:
         "ON CONFLICT (telegram_id) DO UPDATE SET order_id = %s, updated_at = %s",
         (chat_id, order_id, datetime.now(), order_id, datetime.now())
     )
+    mark_chat_read(cursor, order_id, chat_id, last_message_id, message_count)
     conn.commit()
     cursor.close()
     
     smart_send_message(chat_id, text, keyboard)
 
 def handle_send_chat_message(chat_id: int, telegram_id: int, order_id: int, message_text: str, conn) -> None:
-    cursor = conn.cursor()
-    
     if len(message_text) > 4000:
-        cursor.close()
         send_message(chat_id, "❌ Сообщение слишком длинное (макс 4000 символов)")
         return
     
+    # Проверка участника, вставка, счётчики заказа и отметка прочтения отправителя - один запрос.
+    # Сообщение вставляется только если отправитель - клиент, курьер заказа или оператор/админ.
+    cursor = conn.cursor()
     cursor.execute(
-        "SELECT client_id, courier_id FROM t_p39739760_garbage_bot_service.orders WHERE id = %s",
-        (order_id,)
+        "WITH sender AS ("
+        "    SELECT (a.telegram_id IS NOT NULL OR op.telegram_id IS NOT NULL "
+        "        OR COALESCE(u.role, 'client') IN ('operator', 'admin')) AS is_operator "
+        "    FROM (SELECT %(sender)s::bigint AS telegram_id) me "
+        f"    LEFT JOIN {SCHEMA}.admin_users a ON a.telegram_id = me.telegram_id "
+        f"    LEFT JOIN {SCHEMA}.operator_users op ON op.telegram_id = me.telegram_id "
+        f"    LEFT JOIN {SCHEMA}.users u ON u.telegram_id = me.telegram_id"
+        "), target AS ("
+        "    SELECT o.id, o.client_id, o.courier_id, sender.is_operator "
+        f"    FROM {SCHEMA}.orders o, sender "
+        "    WHERE o.id = %(order_id)s"
+        "), msg AS ("
+        f"    INSERT INTO {SCHEMA}.order_chat (order_id, sender_id, message) "
+        "    SELECT id, %(sender)s, %(text)s FROM target "
+        "    WHERE is_operator OR %(sender)s IN (client_id, courier_id) "
+        "    RETURNING id, created_at"
+        "), bump AS ("
+        f"    UPDATE {SCHEMA}.orders o "
+        "    SET chat_message_count = o.chat_message_count + 1, last_message_at = msg.created_at, last_message_id = msg.id "
+        "    FROM msg WHERE o.id = %(order_id)s "
+        "    RETURNING o.chat_message_count"
+        "), marker AS ("
+        f"    INSERT INTO {SCHEMA}.chat_read_markers AS m (order_id, telegram_id, last_read_message_id, last_read_count) "
+        "    SELECT %(order_id)s, %(sender)s, msg.id, bump.chat_message_count FROM msg, bump "
+        "    ON CONFLICT (order_id, telegram_id) DO UPDATE "
+        "    SET last_read_message_id = GREATEST(m.last_read_message_id, EXCLUDED.last_read_message_id), "
+        "    last_read_count = GREATEST(m.last_read_count, EXCLUDED.last_read_count), updated_at = CURRENT_TIMESTAMP"
+        ") "
+        "SELECT client_id, courier_id, is_operator, (SELECT id FROM msg) FROM target",
+        {'sender': telegram_id, 'order_id': order_id, 'text': message_text}
     )
-    order = cursor.fetchone()
+    result = cursor.fetchone()
+    conn.commit()
+    cursor.close()
     
-    if not order:
-        cursor.close()
+    if not result:
         send_message(chat_id, "❌ Заказ не найден")
         return
     
-    client_id, courier_id = order
-    
-    role = check_user_role(telegram_id, conn)
-    is_operator = role in ['operator', 'admin']
+    client_id, courier_id, is_operator, message_id = result
     
-    if not is_operator and telegram_id != client_id and telegram_id != courier_id:
-        cursor.close()
+    if message_id is None:
         send_message(chat_id, "❌ Вы не участник этого заказа")
         return
     
-    cursor.execute(
-        "INSERT INTO t_p39739760_garbage_bot_service.order_chat (order_id, sender_id, message) VALUES (%s, %s, %s)",
-        (order_id, telegram_id, message_text)
-    )
-    conn.commit()
-    
-    cursor.execute("SELECT first_name FROM t_p39739760_garbage_bot_service.users WHERE telegram_id = %s", (telegram_id,))
-    sender = cursor.fetchone()
-    sender_name = sender[0] if sender else "Пользователь"
-    
-    cursor.close()
-    
     if is_operator:
         if client_id:
             keyboard = {
@@ -1897,7 +2136,7 @@ def handle_send_chat_message(chat_id: int, telegram_id: int, order_id: int, mess
                     [{'text': '💬 Ответить', 'callback_data': f'client_chat_{order_id}'}]
                 ]
             }
-            send_message(client_id, f"⚙️ <b>Оператор</b>: {message_text}", keyboard)
+            notify(client_id, f"⚙️ <b>Оператор</b>: {message_text}", keyboard)
         
         if courier_id:
             keyboard = {
@@ -1905,7 +2144,7 @@ def handle_send_chat_message(chat_id: int, telegram_id: int, order_id: int, mess
                     [{'text': '💬 Ответить', 'callback_data': f'courier_chat_{order_id}'}]
                 ]
             }
-            send_message(courier_id, f"⚙️ <b>Оператор</b>: {message_text}", keyboard)
+            notify(courier_id, f"⚙️ <b>Оператор</b>: {message_text}", keyboard)
     else:
         recipient_id = courier_id if telegram_id == client_id else client_id
         
@@ -1917,13 +2156,13 @@ def handle_send_chat_message(chat_id: int, telegram_id: int, order_id: int, mess
                     [{'text': '💬 Ответить', 'callback_data': f'{recipient_type}_chat_{order_id}'}]
                 ]
             }
-            send_message(recipient_id, f"<b>{role_text}</b>: {message_text}", keyboard)
+            notify(recipient_id, f"<b>{role_text}</b>: {message_text}", keyboard)
 
 def handle_open_chat(chat_id: int, telegram_id: int, order_id: int, user_type: str, conn) -> None:
     cursor = conn.cursor()
     
     cursor.execute(
-        "SELECT o.id, u1.first_name as client_name, u2.first_name as courier_name "
+        "SELECT o.id, u1.first_name as client_name, u2.first_name as courier_name, o.last_message_id, o.chat_message_count "
         "FROM t_p39739760_garbage_bot_service.orders o "
         "JOIN t_p39739760_garbage_bot_service.users u1 ON o.client_id = u1.telegram_id "
         "LEFT JOIN t_p39739760_garbage_bot_service.users u2 ON o.courier_id = u2.telegram_id "
@@ -1937,7 +2176,7 @@ def handle_open_chat(chat_id: int, telegram_id: int, order_id: int, user_type: s
         send_message(chat_id, "❌ Заказ не найден")
         return
     
-    order_id, client_name, courier_name = order_info
+    order_id, client_name, courier_name, last_message_id, message_count = order_info
     
     cursor.execute(
         "SELECT oc.message, oc.created_at, u.first_name, oc.sender_id "
@@ -1989,6 +2228,7 @@ def handle_open_chat(chat_id: int, telegram_id: int, order_id: int, user_type: s
         "ON CONFLICT (telegram_id) DO UPDATE SET order_id = %s, updated_at = %s",
         (telegram_id, order_id, datetime.now(), order_id, datetime.now())
     )
+    mark_chat_read(cursor, order_id, telegram_id, last_message_id, message_count)
     conn.commit()
     cursor.close()
     
@@ -2044,8 +2284,9 @@ def handle_approve_courier(chat_id: int, admin_id: int, courier_id: int, conn) -
     
     conn.commit()
     cursor.close()
+    invalidate_role(courier_id)
     
-    send_message(courier_id, "✅ Поздравляем! Ваша заявка на роль курьера одобрена.\n\nИспользуйте /start для доступа к меню курьера.")
+    notify(courier_id, "✅ Поздравляем! Ваша заявка на роль курьера одобрена.\n\nИспользуйте /start для доступа к меню курьера.")
     send_message(chat_id, "✅ Курьер одобрен")
 
 def handle_reject_courier(chat_id: int, admin_id: int, courier_id: int, conn) -> None:
@@ -2059,32 +2300,19 @@ def handle_reject_courier(chat_id: int, admin_id: int, courier_id: int, conn) ->
     conn.commit()
     cursor.close()
     
-    send_message(courier_id, "❌ К сожалению, ваша заявка на роль курьера отклонена.")
+    notify(courier_id, "❌ К сожалению, ваша заявка на роль курьера отклонена.")
     send_message(chat_id, "❌ Заявка отклонена")
 
 def handle_admin_all_orders(chat_id: int, conn) -> None:
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT COUNT(*) FROM t_p39739760_garbage_bot_service.orders WHERE status = %s",
-        ('pending',)
+        "SELECT COALESCE(SUM(order_count) FILTER (WHERE status = 'pending'), 0), "
+        "COALESCE(SUM(order_count) FILTER (WHERE status = 'accepted'), 0), "
+        "COALESCE(SUM(order_count) FILTER (WHERE status = 'completed'), 0), "
+        "COALESCE(SUM(revenue) FILTER (WHERE status = 'completed'), 0) "
+        f"FROM {SCHEMA}.order_status_counters"
     )
-    pending = cursor.fetchone()[0]
-    
-    cursor.execute(
-        "SELECT COUNT(*) FROM t_p39739760_garbage_bot_service.orders WHERE status = %s",
-        ('accepted',)
-    )
-    active = cursor.fetchone()[0]
-    
-    cursor.execute(
-        "SELECT COUNT(*) FROM t_p39739760_garbage_bot_service.orders WHERE status = %s",
-        ('completed',)
-    )
-    completed = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT SUM(price) FROM t_p39739760_garbage_bot_service.orders WHERE status = %s", ('completed',))
-    total_revenue = cursor.fetchone()[0] or 0
-    
+    pending, active, completed, total_revenue = cursor.fetchone()
     cursor.close()
     
     text = (
@@ -2127,6 +2355,7 @@ def handle_admin_clear_data(chat_id: int, conn) -> None:
     
     try:
         cursor.execute(f"DELETE FROM {SCHEMA}.order_chat")
+        cursor.execute(f"DELETE FROM {SCHEMA}.chat_read_markers")
         cursor.execute(f"DELETE FROM {SCHEMA}.order_chat_archive")
         cursor.execute(f"DELETE FROM {SCHEMA}.chat_sessions")
         cursor.execute(f"DELETE FROM {SCHEMA}.order_draft")
@@ -2156,247 +2385,177 @@ def handle_admin_clear_data(chat_id: int, conn) -> None:
         keyboard = {'inline_keyboard': [[{'text': '⬅️ Назад', 'callback_data': 'admin_panel'}]]}
         smart_send_message(chat_id, text, keyboard)
 
-def handle_callback_query(callback_query: Dict, conn) -> None:
+def handle_close_chat(chat_id: int, telegram_id: int, username: str, first_name: str, conn) -> None:
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM t_p39739760_garbage_bot_service.chat_sessions WHERE telegram_id = %s", (telegram_id,))
+    conn.commit()
+    cursor.close()
+    send_message(chat_id, "✅ Чат закрыт. Теперь вы можете создать новый заказ или вернуться в меню.")
+    handle_start(chat_id, telegram_id, username, first_name, conn)
+
+def handle_switch_to_operator(chat_id: int) -> None:
+    text = "📞 <b>Панель оператора</b>\n\nВыберите действие:"
+    smart_send_message(chat_id, text, {
+        'inline_keyboard': [
+            [{'text': '📞 Активные заказы', 'callback_data': 'operator_active_orders'}],
+            [{'text': '💬 Чаты заказов', 'callback_data': 'operator_chats'}],
+            [{'text': '📊 Статистика', 'callback_data': 'operator_stats'}],
+            [{'text': '⬅️ Назад в админку', 'callback_data': 'admin_panel'}]
+        ]
+    })
+
+def handle_switch_to_courier(chat_id: int) -> None:
+    text = "👔 <b>Режим курьера</b>\n\nВыберите действие:"
+    smart_send_message(chat_id, text, {
+        'inline_keyboard': [
+            [{'text': '📦 Доступные заказы', 'callback_data': 'courier_available'}],
+            [{'text': '🚚 Текущие заказы', 'callback_data': 'courier_current'}],
+            [{'text': '📊 История заказов', 'callback_data': 'courier_history'}],
+            [{'text': '💰 Статистика', 'callback_data': 'courier_stats'}],
+            [{'text': '⬅️ Назад в админку', 'callback_data': 'admin_panel'}]
+        ]
+    })
+
+def handle_courier_menu(chat_id: int) -> None:
+    from keyboards import get_courier_menu_keyboard
+    smart_send_message(chat_id, "👔 <b>Меню курьера</b>\n\nВыберите действие:", get_courier_menu_keyboard())
+
+@dataclass
+class CallbackRequest:
+    chat_id: int
+    telegram_id: int
+    username: str
+    first_name: str
+    conn: Any
+
+ADMIN = ('admin',)
+STAFF = ('operator', 'admin')
+COURIER = ('courier',)
+
+callbacks = Router()
+route = callbacks.add
+
+route('start', lambda r: handle_start(r.chat_id, r.telegram_id, r.username, r.first_name, r.conn))
+route('apply_courier', lambda r: handle_apply_courier(r.chat_id, r.telegram_id, r.conn))
+route('client_menu', lambda r: handle_client_menu(r.chat_id))
+route('close_chat', lambda r: handle_close_chat(r.chat_id, r.telegram_id, r.username, r.first_name, r.conn))
+
+route('client_new_order', lambda r: handle_client_new_order(r.chat_id, r.conn))
+route('client_active', lambda r: handle_client_active_orders(r.chat_id, r.telegram_id, r.conn))
+route('client_history', lambda r: handle_client_history(r.chat_id, r.telegram_id, r.conn))
+route('client_history_', lambda r, direction, token: handle_client_history(r.chat_id, r.telegram_id, r.conn, direction, token), args=(str, str))
+route('client_payment', lambda r: handle_client_payment(r.chat_id))
+route('client_subscription', lambda r: handle_client_subscription(r.chat_id, r.telegram_id, r.conn))
+route('custom_bags', lambda r: handle_custom_bags_prompt(r.chat_id, r.telegram_id, r.conn))
+route('buy_sub_alternate', lambda r: handle_buy_subscription(r.chat_id, r.telegram_id, 'alternate_day', r.conn))
+route('buy_sub_daily', lambda r: handle_buy_subscription(r.chat_id, r.telegram_id, 'daily', r.conn))
+route('select_bags_', lambda r, bag_count: handle_select_bags(r.chat_id, r.telegram_id, bag_count, r.conn), args=(int,))
+route('time_', lambda r, time_slot: handle_time_selection(r.chat_id, r.telegram_id, time_slot, r.conn), args=(str,))
+route('cancel_order_', lambda r, order_id: handle_cancel_order(r.chat_id, r.telegram_id, order_id, r.conn), args=(int,))
+route('client_chat_', lambda r, order_id: handle_open_chat(r.chat_id, r.telegram_id, order_id, 'client', r.conn), args=(int,))
+
+route('courier_menu', lambda r: handle_courier_menu(r.chat_id), roles=COURIER)
+route('courier_available', lambda r: handle_courier_available_orders(r.chat_id, r.telegram_id, r.conn))
+route('courier_current', lambda r: handle_courier_current_orders(r.chat_id, r.telegram_id, r.conn))
+route('courier_history', lambda r: handle_courier_history(r.chat_id, r.telegram_id, r.conn))
+route('courier_history_', lambda r, direction, token: handle_courier_history(r.chat_id, r.telegram_id, r.conn, direction, token), args=(str, str))
+route('courier_stats', lambda r: handle_courier_stats(r.chat_id, r.telegram_id, r.conn))
+route('courier_withdraw', lambda r: handle_courier_withdraw(r.chat_id, r.telegram_id, r.conn))
+route('accept_order_', lambda r, order_id: handle_accept_order(r.chat_id, r.telegram_id, order_id, r.conn), args=(int,))
+route('start_work_', lambda r, order_id: handle_start_work(r.chat_id, r.telegram_id, order_id, r.conn), args=(int,))
+route('complete_order_', lambda r, order_id: handle_complete_order(r.chat_id, r.telegram_id, order_id, r.conn), args=(int,))
+route('courier_chat_', lambda r, order_id: handle_open_chat(r.chat_id, r.telegram_id, order_id, 'courier', r.conn), args=(int,))
+
+route('operator_active_orders', lambda r: handle_operator_active_orders(r.chat_id, r.conn), roles=STAFF)
+route('operator_stats', lambda r: handle_operator_stats(r.chat_id, r.conn), roles=STAFF)
+route('operator_chats', lambda r: handle_operator_chats(r.chat_id, r.conn), roles=STAFF)
+route('search_chat', lambda r: handle_search_chat_prompt(r.chat_id), roles=STAFF)
+route('view_chat_', lambda r, order_id: handle_view_chat(r.chat_id, order_id, r.conn), args=(int,), roles=STAFF)
+route('chat_page_', lambda r, order_id, direction, token: handle_view_chat(r.chat_id, order_id, r.conn, direction, token), args=(int, str, str), roles=STAFF)
+route('operator_status_', lambda r, order_id: handle_operator_change_status(r.chat_id, order_id, r.conn), args=(int,), roles=STAFF)
+route('set_status_', lambda r, order_id, status: handle_set_order_status(r.chat_id, order_id, status, r.conn), args=(int, str), roles=STAFF)
+
+route('admin_panel', lambda r: handle_admin_panel(r.chat_id, r.conn), roles=ADMIN)
+route('switch_to_operator', lambda r: handle_switch_to_operator(r.chat_id), roles=ADMIN)
+route('switch_to_courier', lambda r: handle_switch_to_courier(r.chat_id), roles=ADMIN)
+route('admin_stats', lambda r: handle_admin_stats(r.chat_id, r.conn), roles=ADMIN)
+route('admin_all_orders', lambda r: handle_admin_all_orders(r.chat_id, r.conn), roles=ADMIN)
+route('admin_couriers', lambda r: handle_admin_couriers_menu(r.chat_id, r.conn), roles=ADMIN)
+route('admin_courier_applications', lambda r: handle_admin_courier_applications(r.chat_id, r.conn), roles=ADMIN)
+route('admin_couriers_list', lambda r: handle_admin_couriers_list(r.chat_id, r.conn), roles=ADMIN)
+route('admin_couriers_list_', lambda r, direction, token: handle_admin_couriers_list(r.chat_id, r.conn, direction, token), args=(str, str), roles=ADMIN)
+route('admin_remove_courier', lambda r: handle_admin_remove_courier_prompt(r.chat_id), roles=ADMIN)
+route('approve_courier_', lambda r, courier_id: handle_approve_courier(r.chat_id, r.telegram_id, courier_id, r.conn), args=(int,), roles=ADMIN)
+route('reject_courier_', lambda r, courier_id: handle_reject_courier(r.chat_id, r.telegram_id, courier_id, r.conn), args=(int,), roles=ADMIN)
+route('admin_operators', lambda r: handle_admin_operators_menu(r.chat_id, r.conn), roles=ADMIN)
+route('admin_operators_list', lambda r: handle_admin_operators_list(r.chat_id, r.conn), roles=ADMIN)
+route('admin_operators_list_', lambda r, direction, token: handle_admin_operators_list(r.chat_id, r.conn, direction, token), args=(str, str), roles=ADMIN)
+route('admin_add_operator', lambda r: handle_admin_add_operator(r.chat_id), roles=ADMIN)
+route('admin_remove_operator', lambda r: handle_admin_remove_operator_prompt(r.chat_id), roles=ADMIN)
+route('admin_subscriptions', lambda r: handle_admin_subscriptions(r.chat_id, r.conn), roles=ADMIN)
+route('admin_subscriptions_', lambda r, direction, token: handle_admin_subscriptions(r.chat_id, r.conn, direction, token), args=(str, str), roles=ADMIN)
+route('admin_add_subscription', lambda r: handle_admin_add_subscription_prompt(r.chat_id), roles=ADMIN)
+route('cancel_sub_', lambda r, sub_id: handle_cancel_subscription(r.chat_id, sub_id, r.conn), args=(int,), roles=ADMIN)
+route('admin_prices', lambda r: handle_admin_prices(r.chat_id, r.conn), roles=ADMIN)
+route('change_bag_price', lambda r: handle_change_price_prompt(r.chat_id, 'bag', r.conn), roles=ADMIN)
+route('change_daily_price', lambda r: handle_change_price_prompt(r.chat_id, 'daily', r.conn), roles=ADMIN)
+route('change_alternate_price', lambda r: handle_change_price_prompt(r.chat_id, 'alternate', r.conn), roles=ADMIN)
+route('admin_clear_data', lambda r: handle_admin_clear_data_confirm(r.chat_id), roles=ADMIN)
+route('admin_clear_data_yes', lambda r: handle_admin_clear_data(r.chat_id, r.conn), roles=ADMIN)
+
+def handle_callback_query(callback_query: Dict, conn) -> Optional[str]:
     chat_id = callback_query['message']['chat']['id']
     message_id = callback_query['message']['message_id']
     telegram_id = callback_query['from']['id']
     username = callback_query['from'].get('username', '')
     first_name = callback_query['from'].get('first_name', '')
     data = callback_query['data']
-    
+
     _context.message_id = message_id
-    
-    role = check_user_role(telegram_id, conn)
-    
-    if data == 'start':
-        handle_start(chat_id, telegram_id, username, first_name, conn)
-    elif data == 'apply_courier':
-        handle_apply_courier(chat_id, telegram_id, conn)
-    elif data == 'client_menu':
-        handle_client_menu(chat_id)
-    elif data == 'courier_available':
-        handle_courier_available_orders(chat_id, telegram_id, conn)
-    elif data == 'courier_current':
-        handle_courier_current_orders(chat_id, telegram_id, conn)
-    elif data == 'courier_stats':
-        handle_courier_stats(chat_id, telegram_id, conn)
-    elif data == 'courier_menu':
-        if role == 'courier':
-            from keyboards import get_courier_menu_keyboard
-            smart_send_message(chat_id, "👔 <b>Меню курьера</b>\n\nВыберите действие:", get_courier_menu_keyboard())
-
-    elif data == 'client_new_order':
-        handle_client_new_order(chat_id, conn)
-    elif data == 'client_active':
-        handle_client_active_orders(chat_id, telegram_id, conn)
-    elif data == 'operator_active_orders':
-        if role in ['operator', 'admin']:
-            handle_operator_active_orders(chat_id, conn)
-    elif data == 'admin_panel':
-        if role == 'admin':
-            handle_admin_panel(chat_id, conn)
-    elif data == 'admin_couriers':
-        if role == 'admin':
-            handle_admin_couriers_menu(chat_id, conn)
-    elif data == 'admin_operators':
-        if role == 'admin':
-            handle_admin_operators_menu(chat_id, conn)
-    elif data == 'admin_courier_applications':
-        if role == 'admin':
-            handle_admin_courier_applications(chat_id, conn)
-    elif data == 'admin_couriers_list':
-        if role == 'admin':
-            handle_admin_couriers_list(chat_id, conn)
-    elif data == 'admin_operators_list':
-        if role == 'admin':
-            handle_admin_operators_list(chat_id, conn)
-    elif data == 'admin_remove_courier':
-        if role == 'admin':
-            handle_admin_remove_courier_prompt(chat_id)
-    elif data == 'admin_remove_operator':
-        if role == 'admin':
-            handle_admin_remove_operator_prompt(chat_id)
-    elif data == 'admin_all_orders':
-        if role == 'admin':
-            handle_admin_all_orders(chat_id, conn)
-    elif data == 'admin_clear_data':
-        if role == 'admin':
-            handle_admin_clear_data_confirm(chat_id)
-    elif data == 'admin_clear_data_yes':
-        if role == 'admin':
-            handle_admin_clear_data(chat_id, conn)
-    elif data == 'admin_subscriptions':
-        if role == 'admin':
-            handle_admin_subscriptions(chat_id, conn)
-    elif data == 'admin_add_subscription':
-        if role == 'admin':
-            handle_admin_add_subscription_prompt(chat_id)
-    elif data.startswith('cancel_sub_'):
-        if role == 'admin':
-            sub_id = int(data.split('_')[2])
-            handle_cancel_subscription(chat_id, sub_id, conn)
-    elif data == 'switch_to_operator':
-        if role == 'admin':
-            text = "📞 <b>Панель оператора</b>\n\nВыберите действие:"
-            smart_send_message(chat_id, text, {
-                'inline_keyboard': [
-                    [{'text': '📞 Активные заказы', 'callback_data': 'operator_active_orders'}],
-                    [{'text': '💬 Чаты заказов', 'callback_data': 'operator_chats'}],
-                    [{'text': '📊 Статистика', 'callback_data': 'operator_stats'}],
-                    [{'text': '⬅️ Назад в админку', 'callback_data': 'admin_panel'}]
-                ]
-            })
-    elif data == 'switch_to_courier':
-        if role == 'admin':
-            text = "👔 <b>Режим курьера</b>\n\nВыберите действие:"
-            smart_send_message(chat_id, text, {
-                'inline_keyboard': [
-                    [{'text': '📦 Доступные заказы', 'callback_data': 'courier_available'}],
-                    [{'text': '🚚 Текущие заказы', 'callback_data': 'courier_current'}],
-                    [{'text': '📊 История заказов', 'callback_data': 'courier_history'}],
-                    [{'text': '💰 Статистика', 'callback_data': 'courier_stats'}],
-                    [{'text': '⬅️ Назад в админку', 'callback_data': 'admin_panel'}]
-                ]
-            })
-    elif data == 'admin_add_operator':
-        if role == 'admin':
-            handle_admin_add_operator(chat_id)
-    elif data == 'admin_stats':
-        if role == 'admin':
-            handle_admin_stats(chat_id, conn)
-    elif data == 'client_history':
-        handle_client_history(chat_id, telegram_id, conn)
-    elif data == 'courier_history':
-        handle_courier_history(chat_id, telegram_id, conn)
-    elif data == 'client_payment':
-        handle_client_payment(chat_id)
-    elif data == 'client_subscription':
-        handle_client_subscription(chat_id, telegram_id, conn)
-    elif data == 'courier_withdraw':
-        handle_courier_withdraw(chat_id, telegram_id, conn)
-    elif data == 'operator_stats':
-        if role in ['operator', 'admin']:
-            handle_operator_stats(chat_id, conn)
-    elif data == 'operator_chats':
-        if role in ['operator', 'admin']:
-            handle_operator_chats(chat_id, conn)
-    elif data == 'search_chat':
-        if role in ['operator', 'admin']:
-            handle_search_chat_prompt(chat_id)
-    elif data.startswith('view_chat_'):
-        if role in ['operator', 'admin']:
-            order_id = int(data.split('_')[2])
-            handle_view_chat(chat_id, order_id, conn)
-    elif data.startswith('accept_order_'):
-        order_id = int(data.split('_')[2])
-        handle_accept_order(chat_id, telegram_id, order_id, conn)
-    elif data.startswith('start_work_'):
-        order_id = int(data.split('_')[2])
-        handle_start_work(chat_id, telegram_id, order_id, conn)
-    elif data.startswith('complete_order_'):
-        order_id = int(data.split('_')[2])
-        handle_complete_order(chat_id, telegram_id, order_id, conn)
-    elif data.startswith('operator_status_'):
-        if role in ['operator', 'admin']:
-            order_id = int(data.split('_')[2])
-            handle_operator_change_status(chat_id, order_id, conn)
-    elif data.startswith('set_status_'):
-        if role in ['operator', 'admin']:
-            parts = data.split('_')
-            order_id = int(parts[2])
-            new_status = '_'.join(parts[3:])
-            handle_set_order_status(chat_id, order_id, new_status, conn)
-    elif data.startswith('approve_courier_'):
-        if role == 'admin':
-            courier_id = int(data.split('_')[2])
-            handle_approve_courier(chat_id, telegram_id, courier_id, conn)
-    elif data.startswith('reject_courier_'):
-        if role == 'admin':
-            courier_id = int(data.split('_')[2])
-            handle_reject_courier(chat_id, telegram_id, courier_id, conn)
-    elif data == 'close_chat':
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM t_p39739760_garbage_bot_service.chat_sessions WHERE telegram_id = %s", (telegram_id,))
-        conn.commit()
-        cursor.close()
-        send_message(chat_id, "✅ Чат закрыт. Теперь вы можете создать новый заказ или вернуться в меню.")
-        handle_start(chat_id, telegram_id, username, first_name, conn)
-    elif data.startswith('client_chat_'):
-        order_id = int(data.split('_')[2])
-        handle_open_chat(chat_id, telegram_id, order_id, 'client', conn)
-    elif data.startswith('courier_chat_'):
-        order_id = int(data.split('_')[2])
-        handle_open_chat(chat_id, telegram_id, order_id, 'courier', conn)
-    elif data.startswith('cancel_order_'):
-        order_id = int(data.split('_')[2])
-        handle_cancel_order(chat_id, telegram_id, order_id, conn)
-    elif data.startswith('select_bags_'):
-        bag_count = int(data.split('_')[2])
-        handle_select_bags(chat_id, telegram_id, bag_count, conn)
-    elif data == 'custom_bags':
-        handle_custom_bags_prompt(chat_id, telegram_id, conn)
-    elif data == 'buy_sub_alternate':
-        handle_buy_subscription(chat_id, telegram_id, 'alternate_day', conn)
-    elif data == 'buy_sub_daily':
-        handle_buy_subscription(chat_id, telegram_id, 'daily', conn)
-    elif data == 'admin_prices':
-        if role == 'admin':
-            handle_admin_prices(chat_id, conn)
-    elif data == 'change_bag_price':
-        if role == 'admin':
-            handle_change_price_prompt(chat_id, 'bag', conn)
-    elif data == 'change_daily_price':
-        if role == 'admin':
-            handle_change_price_prompt(chat_id, 'daily', conn)
-    elif data == 'change_alternate_price':
-        if role == 'admin':
-            handle_change_price_prompt(chat_id, 'alternate', conn)
-    elif data.startswith('time_'):
-        time_slot = data.replace('time_', '')
-        handle_time_selection(chat_id, telegram_id, time_slot, conn)
-    
+    begin_reply(chat_id)
+
+    request = CallbackRequest(chat_id, telegram_id, username, first_name, conn)
+    route_name = callbacks.dispatch(data, request, lambda: check_user_role(telegram_id, conn))
+    _context.route = route_name or 'unresolved'
+
     _context.message_id = None
+    return route_name
 
 def handle_message(message: Dict, conn) -> None:
     _context.message_id = None
     chat_id = message['chat']['id']
+    begin_reply(chat_id)
     telegram_id = message['from']['id']
     username = message['from'].get('username', '')
     first_name = message['from'].get('first_name', '')
     text = message.get('text', '')
+    _context.route = 'message:other'
     
     if text == '/start':
+        _context.route = 'message:/start'
         handle_start(chat_id, telegram_id, username, first_name, conn)
         return
     
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT order_id FROM {SCHEMA}.chat_sessions WHERE telegram_id = %s", (telegram_id,))
-    active_chat = cursor.fetchone()
-    cursor.close()
+    user = load_user_context(telegram_id, conn)
     
-    if active_chat and text and not text.startswith('/') and not text.startswith('operator_') and not text.startswith('courier_') and not text.startswith('chat_'):
-        order_id = active_chat[0]
+    if user.chat_order_id and text and not text.startswith('/') and not text.startswith('operator_') and not text.startswith('courier_') and not text.startswith('chat_'):
+        order_id = user.chat_order_id
         
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT client_id, courier_id, status FROM {SCHEMA}.orders WHERE id = %s", (order_id,))
-        order_info = cursor.fetchone()
-        cursor.close()
-        
-        if order_info:
-            client_id, courier_id, order_status = order_info
-            
-            if order_status == 'completed':
+        if user.chat_order_status is not None:
+            if user.chat_order_status == 'completed':
                 cursor = conn.cursor()
                 cursor.execute(f"DELETE FROM {SCHEMA}.chat_sessions WHERE telegram_id = %s", (telegram_id,))
                 conn.commit()
                 cursor.close()
-            elif telegram_id == client_id or telegram_id == courier_id:
+            elif telegram_id == user.chat_client_id or telegram_id == user.chat_courier_id:
+                _context.route = 'message:chat_relay'
                 handle_send_chat_message(chat_id, telegram_id, order_id, text, conn)
                 return
     
-    role = check_user_role(telegram_id, conn)
+    role = user.role
     
     if text.startswith('operator_add '):
+        _context.route = 'message:operator_add'
         if role == 'admin':
             try:
                 operator_id = int(text.split(' ')[1])
@@ -2408,6 +2567,7 @@ def handle_message(message: Dict, conn) -> None:
         return
     
     if text.startswith('operator_remove '):
+        _context.route = 'message:operator_remove'
         if role == 'admin':
             try:
                 operator_id = int(text.split(' ')[1])
@@ -2419,6 +2579,7 @@ def handle_message(message: Dict, conn) -> None:
         return
     
     if text.startswith('courier_remove '):
+        _context.route = 'message:courier_remove'
         if role == 'admin':
             try:
                 courier_id = int(text.split(' ')[1])
@@ -2430,6 +2591,7 @@ def handle_message(message: Dict, conn) -> None:
         return
     
     if text.startswith('sub_add '):
+        _context.route = 'message:sub_add'
         if role == 'admin':
             try:
                 parts = text.split(' ')
@@ -2456,6 +2618,7 @@ def handle_message(message: Dict, conn) -> None:
         return
     
     if text.startswith('price_'):
+        _context.route = 'message:price_'
         if role == 'admin':
             try:
                 parts = text.split('_')
@@ -2482,6 +2645,7 @@ def handle_message(message: Dict, conn) -> None:
         return
     
     if text.startswith('chat_'):
+        _context.route = 'message:chat_'
         if role in ['operator', 'admin']:
             try:
                 order_id = int(text.replace('chat_', ''))
@@ -2514,12 +2678,10 @@ def handle_message(message: Dict, conn) -> None:
                 send_message(chat_id, "❌ Неверный формат чата. Используйте: chat_ID текст")
                 return
     
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT state, order_data FROM {SCHEMA}.order_draft WHERE telegram_id = %s", (telegram_id,))
-    session = cursor.fetchone()
-    
-    if session:
-        state, order_data_json = session
+    if user.draft_state is not None:
+        state, order_data_json = user.draft_state, user.draft_data
+        _context.route = f'message:draft_{state}'
+        cursor = conn.cursor()
         
         if state == 'waiting_custom_bags':
             try:
@@ -2576,69 +2738,130 @@ def handle_message(message: Dict, conn) -> None:
             cursor.close()
             send_message(chat_id, "⚠️ Пожалуйста, используйте кнопки для выбора времени")
             return
-            
-            try:
-                import requests
-                payment_response = requests.post(
-                    'https://functions.poehali.dev/b4b440af-a2f4-4b49-86be-5c7dafb0762d',
-                    json={
-                        'amount': total_price,
-                        'description': f"Заказ #{order_id}: Вывоз мусора ({bag_count} мешков)",
-                        'order_id': order_id
-                    },
-                    timeout=10
-                )
-                
-                if payment_response.status_code == 200:
-                    payment_data = payment_response.json()
-                    payment_url = payment_data.get('payment_url')
-                    payment_id = payment_data.get('payment_id')
-                    
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        f"UPDATE {SCHEMA}.orders SET payment_id = %s, payment_url = %s WHERE id = %s",
-                        (payment_id, payment_url, order_id)
-                    )
-                    conn.commit()
-                    cursor.close()
-                    
-                    keyboard = {
-                        'inline_keyboard': [
-                            [{'text': '💳 Оплатить', 'url': payment_url}],
-                            [{'text': '📦 Мои заказы', 'callback_data': 'client_active'}],
-                            [{'text': '⬅️ В меню', 'callback_data': 'start'}]
-                        ]
-                    }
-                    smart_send_message(chat_id, 
-                        f"✅ Заказ #{order_id} создан!\n\n"
-                        f"💰 Сумма: {total_price} ₽\n"
-                        f"📦 Мешков: {bag_count}\n"
-                        f"📍 Адрес: {address}\n\n"
-                        f"Для подтверждения заказа нажмите кнопку «Оплатить»", 
-                        keyboard
-                    )
-                else:
-                    keyboard = {
-                        'inline_keyboard': [
-                            [{'text': '📦 Мои заказы', 'callback_data': 'client_active'}],
-                            [{'text': '⬅️ В меню', 'callback_data': 'start'}]
-                        ]
-                    }
-                    smart_send_message(chat_id, "❌ Ошибка создания платежа. Попробуйте позже.", keyboard)
-            except Exception as e:
-                keyboard = {
-                    'inline_keyboard': [
-                        [{'text': '📦 Мои заказы', 'callback_data': 'client_active'}],
-                        [{'text': '⬅️ В меню', 'callback_data': 'start'}]
-                    ]
-                }
-                smart_send_message(chat_id, f"❌ Ошибка: {str(e)}", keyboard)
-            
-            return
+        
+        cursor.close()
     
-    cursor.close()
     send_message(chat_id, "Используйте /start для начала работы")
 
+def _remember_update(update_id: int) -> None:
+    with _seen_updates_lock:
+        _seen_updates[update_id] = None
+        _seen_updates.move_to_end(update_id)
+        while len(_seen_updates) > SEEN_UPDATES_SIZE:
+            _seen_updates.popitem(last=False)
+
+def is_seen_update(update_id: int) -> bool:
+    '''Быстрый фильтр повторов в памяти тёплого инстанса, без похода в базу'''
+    with _seen_updates_lock:
+        return update_id in _seen_updates
+
+def claim_update(update_id: int, conn) -> str:
+    '''
+    Захват апдейта в processed_updates: 'claimed' - обрабатываем мы, 'done' - уже обработан,
+    'in_flight' - его сейчас обрабатывает другой вызов. Незавершённый захват старше
+    UPDATE_LEASE_SECONDS считается брошенным и перехватывается.
+    '''
+    cursor = conn.cursor()
+    cursor.execute(
+        "WITH claim AS ("
+        f"    INSERT INTO {SCHEMA}.processed_updates AS p (update_id) VALUES (%s) "
+        "    ON CONFLICT (update_id) DO UPDATE SET received_at = LOCALTIMESTAMP "
+        "    WHERE p.completed_at IS NULL AND p.received_at < LOCALTIMESTAMP - make_interval(secs => %s) "
+        "    RETURNING update_id"
+        ") "
+        "SELECT EXISTS (SELECT 1 FROM claim), "
+        f"(SELECT completed_at IS NOT NULL FROM {SCHEMA}.processed_updates WHERE update_id = %s)",
+        (update_id, UPDATE_LEASE_SECONDS, update_id)
+    )
+    claimed, done = cursor.fetchone()
+    conn.commit()
+    cursor.close()
+    
+    if claimed:
+        return 'claimed'
+    if done:
+        _remember_update(update_id)
+        return 'done'
+    return 'in_flight'
+
+def complete_update(update_id: int, conn) -> None:
+    '''Апдейт обработан: только теперь повторная доставка считается дублем'''
+    cursor = conn.cursor()
+    cursor.execute(
+        f"UPDATE {SCHEMA}.processed_updates SET completed_at = LOCALTIMESTAMP WHERE update_id = %s",
+        (update_id,)
+    )
+    conn.commit()
+    cursor.close()
+    
+    _remember_update(update_id)
+
+def release_update(update_id: int, committed: bool) -> None:
+    '''
+    Апдейт упал с ошибкой. Если обработка ничего не зафиксировала, снимаем отметку, и повторная
+    доставка Telegram обработает его заново. Если изменения уже в базе (например, заказ создан,
+    а отправка упала), повтор их задвоит: захват остаётся и помечается failed_at.
+    '''
+    if not committed:
+        with _seen_updates_lock:
+            _seen_updates.pop(update_id, None)
+    
+    try:
+        with connection() as conn:
+            cursor = conn.cursor()
+            if committed:
+                cursor.execute(
+                    f"UPDATE {SCHEMA}.processed_updates SET completed_at = LOCALTIMESTAMP, failed_at = LOCALTIMESTAMP "
+                    "WHERE update_id = %s",
+                    (update_id,)
+                )
+            else:
+                cursor.execute(f"DELETE FROM {SCHEMA}.processed_updates WHERE update_id = %s", (update_id,))
+            conn.commit()
+            cursor.close()
+    except Exception as e:
+        print(f"Failed to release update {update_id}: {e}")
+        return
+    
+    if committed:
+        _remember_update(update_id)
+
+_logged_updates = count(1)
+
+def log_update(update_id: Optional[int], body: Dict, outcome: str, started: float, response: Optional[Dict]) -> None:
+    '''
+    Одна JSON-строка на апдейт с разбивкой времени: база, Telegram, остальное - код бота.
+    Набор ключей постоянный, по логам функции считаются p50/p95/p99 в разрезе route.
+    Раз в ROUTE_STATS_EVERY апдейтов добавляется сводка маршрутов роутера с начала жизни инстанса.
+    '''
+    db_stats = db.stats()
+    telegram_stats = telegram_api.stats()
+    methods = {
+        name: {'calls': entry['calls'], 'ms': round(entry['seconds'] * 1000, 1)}
+        for name, entry in sorted(telegram_stats['methods'].items())
+    }
+    kind = 'message' if 'message' in body else 'callback_query' if 'callback_query' in body else 'other'
+    
+    print(json.dumps({
+        'event': 'update',
+        'update_id': update_id,
+        'kind': kind,
+        'route': getattr(_context, 'route', None),
+        'outcome': outcome,
+        'wall_ms': round((time.perf_counter() - started) * 1000, 1),
+        'db_ms': round(db_stats['seconds'] * 1000, 1),
+        'db_statements': db_stats['statements'],
+        'db_reused': db_stats['reused'],
+        'tg_ms': round(sum(entry['ms'] for entry in methods.values()), 1),
+        'tg_calls': sum(entry['calls'] for entry in methods.values()),
+        'tg_methods': methods,
+        'tg_bytes_sent': telegram_stats['bytes_sent'],
+        'reply_bytes': len(response['body'].encode('utf-8')) if response else 0
+    }, ensure_ascii=False, separators=(',', ':')))
+    
+    if next(_logged_updates) % ROUTE_STATS_EVERY == 0:
+        print(json.dumps({'event': 'route_stats', 'routes': callbacks.stats()}, ensure_ascii=False, separators=(',', ':')))
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
     
@@ -2656,26 +2879,74 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     if method == 'POST':
-        body = json.loads(event.get('body', '{}'))
-        
-        conn = get_db_connection()
+        started = time.perf_counter()
+        db.reset_stats()
+        telegram_api.reset_stats()
+        begin_update()
         
-        if 'message' in body:
-            handle_message(body['message'], conn)
-        elif 'callback_query' in body:
-            handle_callback_query(body['callback_query'], conn)
-        
-        conn.close()
+        body = json.loads(event.get('body', '{}'))
+        update_id = body.get('update_id')
+        outcome = 'error'
+        response = None
         
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'ok': True}),
-            'isBase64Encoded': False
-        }
+        try:
+            if update_id is not None and is_seen_update(update_id):
+                outcome = 'duplicate'
+                response = {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json'},
+                    'body': json.dumps({'ok': True}),
+                    'isBase64Encoded': False
+                }
+                return response
+            
+            state = 'claimed' if update_id is None else None
+            writes_before = 0
+            
+            try:
+                with connection() as conn:
+                    if update_id is not None:
+                        state = claim_update(update_id, conn)
+                        writes_before = db.stats()['writes']
+                    if state == 'claimed':
+                        if 'message' in body:
+                            handle_message(body['message'], conn)
+                        elif 'callback_query' in body:
+                            handle_callback_query(body['callback_query'], conn)
+                        if update_id is not None:
+                            complete_update(update_id, conn)
+            except Exception:
+                if state == 'claimed' and update_id is not None:
+                    release_update(update_id, committed=db.stats()['writes'] > writes_before)
+                raise
+            
+            if state == 'in_flight':
+                # Не 200: Telegram доставит апдейт ещё раз - к тому времени он либо обработан, либо захват брошен
+                outcome = 'in_flight'
+                response = {
+                    'statusCode': 503,
+                    'headers': {'Content-Type': 'application/json'},
+                    'body': json.dumps({'error': 'Update is being processed'}),
+                    'isBase64Encoded': False
+                }
+                return response
+            
+            outcome = 'processed' if state == 'claimed' else 'duplicate'
+            reply = take_reply()
+            notifier.dispatch(_context.deadline)
+            
+            response = {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps(reply if reply else {'ok': True}),
+                'isBase64Encoded': False
+            }
+            return response
+        finally:
+            log_update(update_id, body, outcome, started, response)
     
     return {
         'statusCode': 405,
@@ -0,0 +1,41 @@
+from threading import local
+from typing import Dict, List, Optional
+
+import telegram_api
+from telegram_api import message_payload
+
+_pending = local()
+
+def _queue() -> List[Dict]:
+    queue = getattr(_pending, 'queue', None)
+    if queue is None:
+        queue = _pending.queue = []
+    return queue
+
+def notify(chat_id: int, text: str, reply_markup: Optional[Dict] = None) -> None:
+    '''Уведомление второй стороны заказа: копится за апдейт и уходит одной пачкой в dispatch'''
+    _queue().append(message_payload(chat_id, text, reply_markup))
+
+def dispatch(deadline: Optional[float] = None) -> List[Dict]:
+    '''
+    Отправка накопленных за апдейт уведомлений до ответа на webhook: после ответа инстанс
+    функции могут заморозить, и фоновая отправка пропала бы без следа. Ждёт не дольше deadline.
+    '''
+    queue = _queue()
+    _pending.queue = []
+    if not queue:
+        return []
+
+    try:
+        outcomes = telegram_api.send_many(queue, deadline=deadline)
+    except Exception as e:
+        print(f"Delivery of {len(queue)} notifications failed: {e}")
+        return []
+    for outcome in outcomes:
+        if outcome['status'] != 'delivered':
+            print(f"Notification to {outcome['chat_id']} {outcome['status']}: {outcome.get('description')}")
+    return outcomes
+
+def discard() -> None:
+    '''Сброс очереди, оставшейся от прерванного апдейта'''
+    _pending.queue = []
@@ -0,0 +1,121 @@
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+PAGE_SIZE = 10
+TEXT_LIMIT = 4096
+TRUNCATION_MARK = '…'
+
+NEXT = 'n'
+PREV = 'p'
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+def text_length(text: str) -> int:
+    '''Длина в UTF-16 code units - так Telegram считает лимит сообщения'''
+    return len(text.encode('utf-16-le')) // 2
+
+def truncate_text(text: str, limit: int) -> str:
+    if text_length(text) <= limit:
+        return text
+    keep = limit - text_length(TRUNCATION_MARK)
+    kept = []
+    for char in text:
+        keep -= 2 if ord(char) > 0xFFFF else 1
+        if keep < 0:
+            break
+        kept.append(char)
+    return ''.join(kept) + TRUNCATION_MARK
+
+def encode_cursor(*values: Any) -> str:
+    '''Ключ строки для callback_data: значения через точку, timestamp - в микросекундах, дата - ординалом'''
+    parts = []
+    for value in values:
+        if isinstance(value, datetime):
+            value = (value - _EPOCH) // _MICROSECOND
+        elif isinstance(value, date):
+            value = value.toordinal()
+        parts.append(str(int(value)))
+    return '.'.join(parts)
+
+def decode_cursor(token: str, kinds: Sequence[type]) -> Optional[Tuple]:
+    '''Обратное преобразование encode_cursor; None, если курсор повреждён'''
+    parts = token.split('.')
+    if len(parts) != len(kinds):
+        return None
+    values = []
+    try:
+        for kind, part in zip(kinds, parts):
+            value = int(part)
+            if kind is datetime:
+                value = _EPOCH + value * _MICROSECOND
+            elif kind is date:
+                value = date.fromordinal(value)
+            values.append(value)
+    except (ValueError, OverflowError):
+        return None
+    return tuple(values)
+
+def parse_page(direction: Optional[str], token: Optional[str], kinds: Sequence[type]) -> Tuple[Optional[str], Tuple]:
+    '''Направление и значения курсора из callback_data; при любой ошибке - первая страница'''
+    if direction not in (NEXT, PREV) or not token:
+        return None, ()
+    cursor = decode_cursor(token, kinds)
+    if cursor is None:
+        return None, ()
+    return direction, cursor
+
+def keyset(direction: Optional[str], key: str, descending: bool) -> Tuple[str, str]:
+    '''
+    Условие и сортировка для страницы по ключу key (например "o.completed_at, o.id").
+    NEXT идёт дальше по основному порядку списка, PREV - назад, в обратной сортировке;
+    без direction - первая страница. Параметры условия - значения курсора.
+    '''
+    columns = [column.strip() for column in key.split(',')]
+    backwards = direction == PREV
+    order = 'DESC' if descending != backwards else 'ASC'
+    condition = 'TRUE'
+    if direction:
+        placeholders = ', '.join(['%s'] * len(columns))
+        condition = f"({key}) {'<' if order == 'DESC' else '>'} ({placeholders})"
+    return condition, ', '.join(f"{column} {order}" for column in columns)
+
+def split_page(rows: List, direction: Optional[str], size: int = PAGE_SIZE) -> Tuple[List, bool, bool]:
+    '''Страница из size + 1 выбранных строк: (строки в порядке списка, есть_предыдущая, есть_следующая)'''
+    more = len(rows) > size
+    rows = rows[:size]
+    if direction == PREV:
+        rows.reverse()
+        return rows, more, True
+    return rows, direction == NEXT, more
+
+def fit_entries(header: str, entries: Sequence[str], footer: str = '', limit: int = TEXT_LIMIT, reverse: bool = False) -> Tuple[str, int]:
+    '''
+    Склейка записей страницы в пределах лимита сообщения. Возвращает текст и число
+    вошедших записей; первая запись при необходимости обрезается, чтобы страница не была пустой.
+    reverse - записи отбираются в порядке entries, а выводятся в обратном.
+    '''
+    budget = limit - text_length(header) - text_length(footer)
+    body = []
+    used = 0
+    for entry in entries:
+        size = text_length(entry)
+        if used + size > budget:
+            if not body:
+                body.append(truncate_text(entry, budget))
+            break
+        body.append(entry)
+        used += size
+    shown = len(body)
+    if reverse:
+        body.reverse()
+    return header + ''.join(body) + footer, shown
+
+def nav_row(route: str, first_cursor: str, last_cursor: str, has_prev: bool, has_next: bool) -> List[Dict]:
+    '''Кнопки ◀️/▶️; курсор - ключ первой или последней показанной строки'''
+    row = []
+    if has_prev:
+        row.append({'text': '◀️', 'callback_data': f'{route}_{PREV}_{first_cursor}'})
+    if has_next:
+        row.append({'text': '▶️', 'callback_data': f'{route}_{NEXT}_{last_cursor}'})
+    return row
@@ -0,0 +1,96 @@
+import time
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+class Route:
+    __slots__ = ('pattern', 'handler', 'args', 'roles', 'hits', 'denied', 'total_time', 'max_time')
+
+    def __init__(self, pattern: str, handler: Callable, args: Sequence[Callable], roles: Optional[Sequence[str]]):
+        self.pattern = pattern
+        self.handler = handler
+        self.args = tuple(args)
+        self.roles = tuple(roles) if roles else None
+        self.hits = 0
+        self.denied = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def parse(self, rest: str) -> Optional[Tuple]:
+        '''Разбор параметров из хвоста callback_data: последний аргумент забирает остаток строки'''
+        if not self.args:
+            return () if not rest else None
+
+        parts = rest.split('_', len(self.args) - 1)
+        if len(parts) != len(self.args):
+            return None
+
+        try:
+            return tuple(convert(part) for convert, part in zip(self.args, parts))
+        except ValueError:
+            return None
+
+class Router:
+    '''
+    Маршрутизация callback_data: точные совпадения через dict, параметризованные
+    маршруты - по самому длинному префиксу, оканчивающемуся на "_".
+    '''
+
+    def __init__(self):
+        self.exact: Dict[str, Route] = {}
+        self.prefixes: Dict[str, Route] = {}
+
+    def add(self, pattern: str, handler: Callable, args: Sequence[Callable] = (), roles: Optional[Sequence[str]] = None) -> None:
+        route = Route(pattern, handler, args, roles)
+        if args:
+            self.prefixes[pattern] = route
+        else:
+            self.exact[pattern] = route
+
+    def resolve(self, data: str) -> Optional[Tuple[Route, Tuple]]:
+        route = self.exact.get(data)
+        if route:
+            return route, ()
+
+        end = data.rfind('_')
+        while end > 0:
+            route = self.prefixes.get(data[:end + 1])
+            if route:
+                args = route.parse(data[end + 1:])
+                return (route, args) if args is not None else None
+            end = data.rfind('_', 0, end)
+
+        return None
+
+    def dispatch(self, data: str, request: Any, get_role: Callable[[], str]) -> Optional[str]:
+        '''Вызов обработчика маршрута; возвращает шаблон маршрута или None, если маршрут не найден'''
+        resolved = self.resolve(data)
+        if not resolved:
+            return None
+
+        route, args = resolved
+        started = time.perf_counter()
+        try:
+            if route.roles and get_role() not in route.roles:
+                route.denied += 1
+                return route.pattern
+            route.handler(request, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            route.hits += 1
+            route.total_time += elapsed
+            route.max_time = max(route.max_time, elapsed)
+
+        return route.pattern
+
+    def stats(self) -> Dict[str, Dict]:
+        routes = list(self.exact.values()) + list(self.prefixes.values())
+        return {
+            route.pattern: {
+                'hits': route.hits,
+                'denied': route.denied,
+                'total_ms': round(route.total_time * 1000, 1),
+                'avg_ms': round(route.total_time * 1000 / route.hits, 1) if route.hits else 0,
+                'max_ms': round(route.max_time * 1000, 1)
+            }
+            for route in sorted(routes, key=lambda r: r.total_time, reverse=True)
+            if route.hits
+        }
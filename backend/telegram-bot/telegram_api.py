@@ -1,55 +1,376 @@
 import json
 import os
-import urllib.request
-from typing import Dict, Optional
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
 
 TELEGRAM_API = "https://api.telegram.org/bot{token}/{method}"
 
-def _make_request(method: str, payload: Dict) -> None:
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+POOL_MAXSIZE = 20
+
+CALL_BUDGET_SECONDS = 15
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 2.0
+
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+
+BROADCAST_WORKERS = 8
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+MAX_RATE_LIMIT_RETRIES = 3
+
+# Классы исхода вызова Bot API
+OK = 'ok'
+NOT_MODIFIED = 'not_modified'
+BLOCKED = 'blocked'
+RATE_LIMITED = 'rate_limited'
+SERVER_ERROR = 'server_error'
+NETWORK_ERROR = 'network_error'
+CLIENT_ERROR = 'client_error'
+CIRCUIT_OPEN = 'circuit_open'
+
+RETRYABLE = (RATE_LIMITED, SERVER_ERROR, NETWORK_ERROR)
+
+_session: Optional[requests.Session] = None
+
+def _get_session() -> requests.Session:
+    '''Keep-alive сессия с пулом соединений, живёт между тёплыми вызовами функции'''
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+        session.mount('https://', adapter)
+        _session = session
+    return _session
+
+class CircuitBreaker:
+    '''
+    После threshold подряд сетевых ошибок и 5xx вызовы не уходят в сеть cooldown секунд,
+    затем пропускается одна пробная попытка. Ответы Telegram 4xx сбоем транспорта не считаются.
+    '''
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.failures < self.threshold:
+                return True
+            if time.monotonic() < self.open_until or self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, healthy: bool) -> None:
+        with self.lock:
+            self.probing = False
+            if healthy:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.open_until = time.monotonic() + self.cooldown
+
+_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+def classify(result: Optional[Dict], status_code: Optional[int] = None) -> str:
+    '''Класс исхода по ответу Telegram и HTTP-статусу; result None - ответа не было или он не разобрался'''
+    if status_code == 429 or (result and result.get('error_code') == 429):
+        return RATE_LIMITED
+    if result is None:
+        return SERVER_ERROR if status_code and status_code >= 500 else NETWORK_ERROR
+    if result.get('ok'):
+        return OK
+
+    error_code = result.get('error_code') or status_code or 0
+    description = result.get('description') or ''
+    if error_code >= 500:
+        return SERVER_ERROR
+    if error_code == 400 and 'message is not modified' in description:
+        return NOT_MODIFIED
+    if error_code == 403:
+        return BLOCKED
+    return CLIENT_ERROR
+
+def _backoff(attempt: int) -> float:
+    '''Экспоненциальная пауза с полным джиттером'''
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+_stats = local()
+_stats_lock = Lock()
+
+def reset_stats() -> None:
+    '''Обнуление счётчиков HTTP-запросов к Bot API текущего потока'''
+    _stats.current = {'methods': {}, 'bytes_sent': 0}
+
+def stats() -> Dict:
+    '''
+    Запросы потока с последнего reset_stats: по методам {'calls', 'seconds'} и отправленные байты тела.
+    Отправки send_many из его рабочих потоков засчитываются вызвавшему потоку.
+    '''
+    current = getattr(_stats, 'current', None) or {'methods': {}, 'bytes_sent': 0}
+    return {
+        'methods': current['methods'],
+        'bytes_sent': current['bytes_sent']
+    }
+
+def _record(method: str, started: float, size: int) -> None:
+    current = getattr(_stats, 'current', None)
+    if current is None:
+        current = _stats.current = {'methods': {}, 'bytes_sent': 0}
+    with _stats_lock:
+        entry = current['methods'].setdefault(method, {'calls': 0, 'seconds': 0.0})
+        entry['calls'] += 1
+        entry['seconds'] += time.perf_counter() - started
+        current['bytes_sent'] += size
+
+def _post(url: str, method: str, payload: Dict, deadline: float) -> Tuple[Optional[Dict], Optional[int]]:
+    read_timeout = min(READ_TIMEOUT, max(deadline - time.monotonic(), 0.1))
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    started = time.perf_counter()
+    try:
+        response = _get_session().post(
+            url,
+            data=body,
+            headers={'Content-Type': 'application/json'},
+            timeout=(CONNECT_TIMEOUT, read_timeout)
+        )
+    except requests.RequestException:
+        return None, None
+    finally:
+        _record(method, started, len(body))
+    try:
+        return response.json(), response.status_code
+    except ValueError:
+        return None, response.status_code
+
+def call(method: str, payload: Dict, deadline: Optional[float] = None, retry_rate_limit: bool = True) -> Optional[Dict]:
+    '''
+    Вызов метода Bot API, возвращает разобранный ответ Telegram или None, если ответа нет
+    (сеть, 5xx, открыт предохранитель). Сетевые ошибки, 5xx и 429 повторяются с паузой,
+    пока не кончится deadline (по умолчанию CALL_BUDGET_SECONDS от начала вызова);
+    retry_rate_limit=False возвращает 429 вызывающему - так send_many ставит сообщение в очередь.
+    '''
     token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not token:
+        return None
+
     url = TELEGRAM_API.format(token=token, method=method)
-    
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(payload).encode('utf-8'),
-        headers={'Content-Type': 'application/json'}
-    )
-    
-    try:
-        urllib.request.urlopen(req)
-    except Exception as e:
-        if method == 'sendMessage':
-            print(f"Error in {method}: {e}")
+    if deadline is None:
+        deadline = time.monotonic() + CALL_BUDGET_SECONDS
 
-def send_message(chat_id: int, text: str, reply_markup: Optional[Dict] = None) -> None:
-    payload = {
-        'chat_id': chat_id,
-        'text': text,
-        'parse_mode': 'HTML'
-    }
-    
-    if reply_markup:
-        payload['reply_markup'] = reply_markup
-    
-    _make_request('sendMessage', payload)
+    outcome = NETWORK_ERROR
+    result = None
+    for attempt in range(MAX_ATTEMPTS):
+        if not _breaker.allow():
+            outcome, result = CIRCUIT_OPEN, None
+            break
+
+        result, status_code = _post(url, method, payload, deadline)
+        outcome = classify(result, status_code)
+        _breaker.record(outcome not in (SERVER_ERROR, NETWORK_ERROR))
+        if outcome == RATE_LIMITED:
+            result = _rate_limited(result)
+
+        if outcome not in RETRYABLE or (outcome == RATE_LIMITED and not retry_rate_limit):
+            break
 
-def edit_message(chat_id: int, message_id: int, text: str, reply_markup: Optional[Dict] = None) -> None:
+        if outcome == RATE_LIMITED:
+            pause = _retry_after(result, attempt)
+        else:
+            pause = _backoff(attempt)
+        if attempt + 1 == MAX_ATTEMPTS or time.monotonic() + pause >= deadline:
+            break
+        time.sleep(pause)
+
+    # Неизменённое сообщение и заблокировавший бота пользователь - штатные исходы, без лога
+    if outcome in (OK, NOT_MODIFIED, BLOCKED) or (outcome == RATE_LIMITED and not retry_rate_limit):
+        return result
+
+    description = result.get('description') if result else None
+    print(f"Telegram {method} to {payload.get('chat_id')} failed: {outcome} {description or ''}".rstrip())
+    return result if outcome in (RATE_LIMITED, CLIENT_ERROR) else None
+
+def message_payload(chat_id: int, text: str, reply_markup: Optional[Dict] = None, message_id: Optional[int] = None) -> Dict:
     payload = {
         'chat_id': chat_id,
-        'message_id': message_id,
         'text': text,
         'parse_mode': 'HTML'
     }
-    
+
+    if message_id:
+        payload['message_id'] = message_id
+
     if reply_markup:
         payload['reply_markup'] = reply_markup
-    
-    _make_request('editMessageText', payload)
 
-def delete_message(chat_id: int, message_id: int) -> None:
+    return payload
+
+def send_message(chat_id: int, text: str, reply_markup: Optional[Dict] = None) -> Optional[Dict]:
+    return call('sendMessage', message_payload(chat_id, text, reply_markup))
+
+def edit_message(chat_id: int, message_id: int, text: str, reply_markup: Optional[Dict] = None) -> Optional[Dict]:
+    return call('editMessageText', message_payload(chat_id, text, reply_markup, message_id))
+
+def delete_message(chat_id: int, message_id: int) -> Optional[Dict]:
     payload = {
         'chat_id': chat_id,
         'message_id': message_id
     }
-    
-    _make_request('deleteMessage', payload)
+
+    return call('deleteMessage', payload)
+
+class TokenBucket:
+    '''Ограничитель скорости: rate токенов в секунду, запас не больше capacity'''
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = Lock()
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def acquire(self, deadline: Optional[float] = None) -> bool:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - max(self.updated, self.paused_until)) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+class ChatLimiter:
+    '''Не чаще одного сообщения в interval секунд в один чат'''
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_allowed: Dict[int, float] = {}
+        self.lock = Lock()
+
+    def acquire(self, chat_id: int, deadline: Optional[float] = None) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_allowed.get(chat_id, 0.0))
+            if deadline is not None and slot > deadline:
+                return False
+            self.next_allowed[chat_id] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+        return True
+
+def _rate_limited(result: Optional[Dict]) -> Dict:
+    '''Ответ 429 в форме Bot API, даже если пришёл только HTTP-статус без разбираемого тела'''
+    result = result or {}
+    return {
+        'ok': False,
+        'error_code': 429,
+        'description': result.get('description') or 'Too Many Requests',
+        'parameters': result.get('parameters') or {}
+    }
+
+def _retry_after(result: Optional[Dict], attempt: int) -> Optional[float]:
+    '''Пауза после 429: retry_after из ответа, без него - экспоненциальная с джиттером; None - не 429'''
+    if not result or result.get('error_code') != 429:
+        return None
+    retry_after = (result.get('parameters') or {}).get('retry_after')
+    if retry_after is None:
+        return _backoff(attempt)
+    return float(retry_after)
+
+def _outcome(payload: Dict, result: Optional[Dict], status: Optional[str] = None) -> Dict:
+    outcome = {'chat_id': payload.get('chat_id')}
+    if status is None:
+        status = 'delivered' if result and result.get('ok') else 'failed'
+    outcome['status'] = status
+    if status == 'delivered':
+        outcome['message_id'] = (result.get('result') or {}).get('message_id')
+    elif result:
+        outcome['error_code'] = result.get('error_code')
+        outcome['description'] = result.get('description')
+    return outcome
+
+def send_many(messages: List[Dict], deadline: Optional[float] = None, method: str = 'sendMessage') -> List[Dict]:
+    '''
+    Параллельная отправка с глобальным и початовым лимитом Telegram. Ответ 429 ставит сообщение
+    в конец очереди и приостанавливает общий лимит на retry_after, а не держит поток на одном чате.
+    deadline - момент time.monotonic(), после которого неотправленные сообщения пропускаются.
+    Результат по каждому сообщению в порядке messages:
+    {'chat_id', 'status': delivered/failed/skipped, 'message_id' или 'error_code' и 'description'}.
+    '''
+    bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+    chats = ChatLimiter(PER_CHAT_INTERVAL)
+    results: List[Optional[Dict]] = [None] * len(messages)
+    queue = deque((index, 0) for index in range(len(messages)))
+    queue_lock = Lock()
+    caller_stats = getattr(_stats, 'current', None)
+
+    def worker() -> None:
+        if caller_stats is not None:
+            _stats.current = caller_stats
+        while True:
+            with queue_lock:
+                if not queue:
+                    return
+                index, attempt = queue.popleft()
+
+            payload = messages[index]
+            if payload.get('chat_id') is None:
+                results[index] = _outcome(payload, None, 'skipped')
+                continue
+            if not chats.acquire(payload['chat_id'], deadline) or not bucket.acquire(deadline):
+                results[index] = _outcome(payload, None, 'skipped')
+                continue
+
+            result = call(method, payload, deadline, retry_rate_limit=False)
+            retry_after = _retry_after(result, attempt)
+            if retry_after is not None and attempt < MAX_RATE_LIMIT_RETRIES:
+                bucket.pause(retry_after)
+                with queue_lock:
+                    queue.append((index, attempt + 1))
+                continue
+
+            results[index] = _outcome(payload, result)
+
+    workers = min(BROADCAST_WORKERS, len(messages))
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in range(workers):
+                executor.submit(worker)
+
+    return results
+
+def broadcast(messages: List[Dict], deadline: Optional[float] = None) -> Dict[str, int]:
+    '''Рассылка через send_many со сводкой: счётчики delivered/failed/skipped'''
+    counters = {'delivered': 0, 'failed': 0, 'skipped': 0}
+    for outcome in send_many(messages, deadline):
+        counters[outcome['status']] += 1
+    return counters
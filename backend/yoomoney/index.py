@@ -1,37 +1,17 @@
 import json
 import os
-import base64
-import psycopg2
+import time
 from typing import Dict, Any
-from decimal import Decimal
+
+import yookassa
+from db import connection
+from telegram_api import message_payload, send_many
 
 SCHEMA = 't_p39739760_garbage_bot_service'
 
-def send_telegram_message(chat_id: int, text: str, reply_markup: str = None):
-    import requests
-    
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        return
-    
-    url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
-    data = {
-        'chat_id': chat_id,
-        'text': text,
-        'parse_mode': 'HTML'
-    }
-    
-    if reply_markup:
-        data['reply_markup'] = reply_markup
-    
-    try:
-        requests.post(url, json=data, timeout=5)
-    except Exception:
-        pass
+COURIER_BROADCAST_BUDGET = 20
 
 def create_payment(body_data: Dict, context: Any) -> Dict[str, Any]:
-    import requests
-    
     amount = body_data.get('amount')
     description = body_data.get('description', 'Оплата заказа')
     order_id = body_data.get('order_id')
@@ -44,76 +24,27 @@ def create_payment(body_data: Dict, context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    shop_id = os.environ.get('YOOMONEY_SHOP_ID')
-    secret_key = os.environ.get('YOOMONEY_SECRET_KEY')
-    
-    if not shop_id or not secret_key:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Payment credentials not configured'}),
-            'isBase64Encoded': False
-        }
-    
-    auth_string = f"{shop_id}:{secret_key}"
-    auth_b64 = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
-    
-    payment_data = {
-        'amount': {
-            'value': f"{Decimal(str(amount)):.2f}",
-            'currency': 'RUB'
-        },
-        'capture': True,
-        'confirmation': {
-            'type': 'redirect',
-            'return_url': 'https://t.me/garbagetakeoutbot'
-        },
-        'description': description,
-        'metadata': {
-            'order_id': str(order_id)
-        }
-    }
-    
-    headers = {
-        'Authorization': f'Basic {auth_b64}',
-        'Content-Type': 'application/json',
-        'Idempotence-Key': f'order_{order_id}_{context.request_id}'
-    }
-    
-    response = requests.post(
-        'https://api.yookassa.ru/v3/payments',
-        json=payment_data,
-        headers=headers,
-        timeout=10
-    )
-    
-    if response.status_code != 200:
+    try:
+        payment = yookassa.create_payment(amount, description, str(order_id))
+    except yookassa.PaymentError as e:
+        error = {'error': str(e)}
+        if e.details:
+            error['details'] = e.details
         return {
-            'statusCode': response.status_code,
+            'statusCode': e.status_code,
             'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({
-                'error': 'Payment creation failed',
-                'details': response.text
-            }),
+            'body': json.dumps(error),
             'isBase64Encoded': False
         }
     
-    payment_response = response.json()
-    
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json'},
-        'body': json.dumps({
-            'payment_id': payment_response['id'],
-            'payment_url': payment_response['confirmation']['confirmation_url'],
-            'status': payment_response['status']
-        }),
+        'body': json.dumps(payment),
         'isBase64Encoded': False
     }
 
 def process_webhook(body_data: Dict) -> Dict[str, Any]:
-    import requests
-    
     event_type = body_data.get('event')
     payment_object = body_data.get('object', {})
     
@@ -147,99 +78,121 @@ def process_webhook(body_data: Dict) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(dsn)
-    cursor = conn.cursor()
+    client_notification = None
+    courier_messages = []
     
-    if order_id.startswith('sub_'):
-        subscription_id = int(order_id.replace('sub_', ''))
+    with connection() as conn:
+        cursor = conn.cursor()
         
+        # Ретраи ЮKassa: событие уже в журнале - заказ обновлён и уведомления разосланы первой доставкой
         cursor.execute(
-            f"UPDATE {SCHEMA}.subscriptions SET payment_status = %s, paid_at = NOW(), is_active = %s "
-            f"WHERE id = %s RETURNING client_id, type, end_date",
-            (payment_status, True, subscription_id)
+            f"INSERT INTO {SCHEMA}.payment_events (payment_id, event_type, order_ref, payment_status) "
+            "VALUES (%s, %s, %s, %s) ON CONFLICT (payment_id, event_type) DO NOTHING RETURNING payment_id",
+            (payment_id, event_type, order_id, payment_status)
         )
-        sub_result = cursor.fetchone()
+        if cursor.fetchone() is None:
+            cursor.close()
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps({'status': 'duplicate'}),
+                'isBase64Encoded': False
+            }
         
-        if sub_result:
-            client_id, sub_type, end_date = sub_result
-            sub_name = "Ежедневно" if sub_type == 'daily' else "Через день"
+        if order_id.startswith('sub_'):
+            subscription_id = int(order_id.replace('sub_', ''))
             
-            message = (
-                f"✅ <b>Подписка активирована!</b>\n\n"
-                f"⭐ Тип: {sub_name}\n"
-                f"📅 Действует до: {end_date.strftime('%d.%m.%Y')}\n\n"
-                "Теперь вы можете заказывать вывоз до 2 пакетов без доплаты!"
+            cursor.execute(
+                f"UPDATE {SCHEMA}.subscriptions SET payment_status = %s, paid_at = NOW(), is_active = %s "
+                f"WHERE id = %s RETURNING client_id, type, end_date",
+                (payment_status, True, subscription_id)
             )
+            sub_result = cursor.fetchone()
             
-            keyboard = json.dumps({
-                'inline_keyboard': [
-                    [{'text': '➕ Новый заказ', 'callback_data': 'client_new_order'}],
-                    [{'text': '⬅️ Главное меню', 'callback_data': 'client_menu'}]
-                ]
-            })
-            
-            send_telegram_message(client_id, message, keyboard)
-    else:
-        cursor.execute(
-            f"UPDATE {SCHEMA}.orders SET payment_status = %s, paid_at = NOW(), detailed_status = %s WHERE id = %s RETURNING client_id, address, bag_count, price",
-            (payment_status, 'searching_courier', order_id)
-        )
-        result = cursor.fetchone()
-        
-        if result:
-            client_id, address, bag_count, price = result
-            
-            message = f"✅ <b>Оплата прошла успешно!</b>\n\n"
-            message += f"📦 Заказ #{order_id}\n"
-            message += f"🗑 Мешков: {bag_count}\n"
-            message += f"📍 Адрес: {address}\n\n"
-            message += "Курьер скоро свяжется с вами для согласования времени вывоза."
-            
-            keyboard = json.dumps({
-                'inline_keyboard': [
-                    [{'text': '📦 Мои заказы', 'callback_data': 'client_active_orders'}],
-                    [{'text': '⬅️ Главное меню', 'callback_data': 'client_menu'}]
-                ]
-            })
-            
-            send_telegram_message(client_id, message, keyboard)
-            
+            if sub_result:
+                client_id, sub_type, end_date = sub_result
+                sub_name = "Ежедневно" if sub_type == 'daily' else "Через день"
+                
+                message = (
+                    f"✅ <b>Подписка активирована!</b>\n\n"
+                    f"⭐ Тип: {sub_name}\n"
+                    f"📅 Действует до: {end_date.strftime('%d.%m.%Y')}\n\n"
+                    "Теперь вы можете заказывать вывоз до 2 пакетов без доплаты!"
+                )
+                
+                keyboard = {
+                    'inline_keyboard': [
+                        [{'text': '➕ Новый заказ', 'callback_data': 'client_new_order'}],
+                        [{'text': '⬅️ Главное меню', 'callback_data': 'client_menu'}]
+                    ]
+                }
+                
+                client_notification = (client_id, message, keyboard)
+        else:
             cursor.execute(
-                f"SELECT telegram_id FROM {SCHEMA}.users WHERE role = %s",
-                ('courier',)
+                f"UPDATE {SCHEMA}.orders SET payment_status = %s, paid_at = NOW(), detailed_status = %s WHERE id = %s RETURNING client_id, address, bag_count, price",
+                (payment_status, 'searching_courier', order_id)
             )
-            couriers = cursor.fetchall()
-            
-            notification_keyboard_json = json.dumps({
-                'inline_keyboard': [
-                    [{'text': '✅ Принять', 'callback_data': f'accept_order_{order_id}'}]
-                ]
-            })
+            result = cursor.fetchone()
             
-            for courier in couriers:
-                courier_id = courier[0]
+            if result:
+                client_id, address, bag_count, price = result
+                
+                message = f"✅ <b>Оплата прошла успешно!</b>\n\n"
+                message += f"📦 Заказ #{order_id}\n"
+                message += f"🗑 Мешков: {bag_count}\n"
+                message += f"📍 Адрес: {address}\n\n"
+                message += "Курьер скоро свяжется с вами для согласования времени вывоза."
+                
+                keyboard = {
+                    'inline_keyboard': [
+                        [{'text': '📦 Мои заказы', 'callback_data': 'client_active_orders'}],
+                        [{'text': '⬅️ Главное меню', 'callback_data': 'client_menu'}]
+                    ]
+                }
+                
+                client_notification = (client_id, message, keyboard)
+                
+                cursor.execute(
+                    f"SELECT telegram_id FROM {SCHEMA}.users WHERE role = %s",
+                    ('courier',)
+                )
+                couriers = cursor.fetchall()
                 
-                bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-                if bot_token:
-                    url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
-                    data = {
-                        'chat_id': courier_id,
+                notification_keyboard = {
+                    'inline_keyboard': [
+                        [{'text': '✅ Принять', 'callback_data': f'accept_order_{order_id}'}]
+                    ]
+                }
+                
+                courier_messages = [
+                    {
+                        'chat_id': courier[0],
                         'text': f"🆕 Новый заказ #{order_id}\n📍 {address}\n📦 {bag_count} мешков\n💰 {price} ₽",
-                        'reply_markup': notification_keyboard_json
+                        'reply_markup': notification_keyboard
                     }
-                    try:
-                        requests.post(url, json=data, timeout=5)
-                    except Exception:
-                        pass
+                    for courier in couriers
+                ]
+        
+        conn.commit()
+        cursor.close()
     
-    conn.commit()
-    cursor.close()
-    conn.close()
+    # Клиент и курьеры - одной пачкой под общим лимитом; клиент первым в очереди
+    messages = [message_payload(*client_notification)] if client_notification else []
+    outcomes = send_many(messages + courier_messages, deadline=time.monotonic() + COURIER_BROADCAST_BUDGET)
+    
+    couriers_result = {'delivered': 0, 'failed': 0, 'skipped': 0}
+    for outcome in outcomes[len(messages):]:
+        couriers_result[outcome['status']] += 1
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json'},
-        'body': json.dumps({'status': 'processed'}),
+        'body': json.dumps({
+            'status': 'processed',
+            'client': outcomes[0]['status'] if messages else None,
+            'couriers': couriers_result
+        }),
         'isBase64Encoded': False
     }
 
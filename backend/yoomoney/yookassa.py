@@ -0,0 +1,112 @@
+import base64
+import os
+from decimal import Decimal
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Переопределяется для проверки против локального фейкового сервера
+YOOKASSA_API_URL = os.environ.get('YOOKASSA_API_URL', "https://api.yookassa.ru/v3/payments")
+RETURN_URL = "https://t.me/garbagetakeoutbot"
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+POOL_MAXSIZE = 10
+
+_session: Optional[requests.Session] = None
+
+class PaymentError(Exception):
+    '''Платёж не создан; status_code - что отдать клиенту функции'''
+
+    def __init__(self, message: str, status_code: int = 502, details: str = ''):
+        super().__init__(message)
+        self.status_code = status_code
+        self.details = details
+
+def session() -> requests.Session:
+    '''Keep-alive сессия с пулом соединений, живёт между тёплыми вызовами функции'''
+    global _session
+    if _session is None:
+        new_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+        new_session.mount('https://', adapter)
+        _session = new_session
+    return _session
+
+def is_configured() -> bool:
+    return bool(os.environ.get('YOOMONEY_SHOP_ID') and os.environ.get('YOOMONEY_SECRET_KEY'))
+
+def _auth_header() -> str:
+    shop_id = os.environ.get('YOOMONEY_SHOP_ID')
+    secret_key = os.environ.get('YOOMONEY_SECRET_KEY')
+    if not shop_id or not secret_key:
+        raise PaymentError('Payment credentials not configured', status_code=500)
+
+    auth_string = f"{shop_id}:{secret_key}"
+    return 'Basic ' + base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
+
+def create_payment(amount, description: str, reference: str) -> Dict:
+    '''
+    Платёж в ЮKassa. reference - order_id из metadata ("123" или "sub_45"); ключ идемпотентности
+    строится только из него, поэтому повторный запрос по тому же заказу возвращает тот же платёж.
+    '''
+    payment_data = {
+        'amount': {
+            'value': f"{Decimal(str(amount)):.2f}",
+            'currency': 'RUB'
+        },
+        'capture': True,
+        'confirmation': {
+            'type': 'redirect',
+            'return_url': RETURN_URL
+        },
+        'description': description,
+        'metadata': {
+            'order_id': str(reference)
+        }
+    }
+
+    headers = {
+        'Authorization': _auth_header(),
+        'Content-Type': 'application/json',
+        'Idempotence-Key': f'order_{reference}'
+    }
+
+    response = session().post(
+        YOOKASSA_API_URL,
+        json=payment_data,
+        headers=headers,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+    )
+
+    if response.status_code != 200:
+        raise PaymentError('Payment creation failed', status_code=response.status_code, details=response.text)
+
+    payment_response = response.json()
+
+    return {
+        'payment_id': payment_response['id'],
+        'payment_url': payment_response['confirmation']['confirmation_url'],
+        'status': payment_response['status']
+    }
+
+def get_payment(payment_id: str) -> Dict:
+    '''Текущее состояние платежа: {'payment_id', 'status', 'paid', 'order_ref'}'''
+    response = session().get(
+        f"{YOOKASSA_API_URL}/{payment_id}",
+        headers={'Authorization': _auth_header()},
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+    )
+
+    if response.status_code != 200:
+        raise PaymentError('Payment lookup failed', status_code=response.status_code, details=response.text)
+
+    payment_response = response.json()
+
+    return {
+        'payment_id': payment_response['id'],
+        'status': payment_response['status'],
+        'paid': payment_response.get('paid', False),
+        'order_ref': payment_response.get('metadata', {}).get('order_id')
+    }
@@ -0,0 +1,7 @@
+-- Архивация переписки выполняется плановой функцией maintenance:
+-- строки переносятся из order_chat в order_chat_archive через DELETE ... RETURNING
+-- с сохранением исходного id, поэтому живые и архивные сообщения имеют общий ключ (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_chat_archive_order_created
+    ON t_p39739760_garbage_bot_service.order_chat_archive (order_id, created_at, id);
+
+DROP INDEX IF EXISTS t_p39739760_garbage_bot_service.idx_chat_archive_order_id;
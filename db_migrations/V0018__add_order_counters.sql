@@ -0,0 +1,139 @@
+-- Счётчики заказов для дашбордов админа и оператора.
+-- Ведутся триггерами на orders при вставке, удалении и смене статуса, оплаты, цены или даты завершения,
+-- поэтому дашборды читают несколько строк вместо полного прохода по orders.
+CREATE TABLE IF NOT EXISTS t_p39739760_garbage_bot_service.order_status_counters (
+    status VARCHAR(50) NOT NULL,
+    payment_status VARCHAR(50) NOT NULL,
+    order_count BIGINT NOT NULL DEFAULT 0,
+    revenue BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (status, payment_status)
+);
+
+-- Завершённые заказы по дню completed_at
+CREATE TABLE IF NOT EXISTS t_p39739760_garbage_bot_service.order_daily_counters (
+    day DATE PRIMARY KEY,
+    completed_count BIGINT NOT NULL DEFAULT 0,
+    revenue BIGINT NOT NULL DEFAULT 0
+);
+
+-- Триггеры уровня оператора на INSERT/DELETE: изменения всех строк одного запроса сворачиваются
+-- в одну дельту на строку счётчика, так что массовые вставки и удаления не обновляют её тысячи раз
+CREATE OR REPLACE FUNCTION t_p39739760_garbage_bot_service.update_order_counters()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        WITH delta AS (
+            SELECT status, payment_status, CASE WHEN status = 'completed' THEN completed_at::date END AS completed_day,
+                1 AS order_count, COALESCE(price, 0) AS revenue
+            FROM new_rows
+        ), status_delta AS (
+            INSERT INTO t_p39739760_garbage_bot_service.order_status_counters AS c (status, payment_status, order_count, revenue)
+            SELECT COALESCE(status, ''), COALESCE(payment_status, ''), SUM(order_count), SUM(revenue)
+            FROM delta
+            GROUP BY 1, 2
+            HAVING SUM(order_count) <> 0 OR SUM(revenue) <> 0
+            ON CONFLICT (status, payment_status) DO UPDATE
+            SET order_count = c.order_count + EXCLUDED.order_count, revenue = c.revenue + EXCLUDED.revenue
+        )
+        INSERT INTO t_p39739760_garbage_bot_service.order_daily_counters AS d (day, completed_count, revenue)
+        SELECT completed_day, SUM(order_count), SUM(revenue)
+        FROM delta
+        WHERE completed_day IS NOT NULL
+        GROUP BY 1
+        HAVING SUM(order_count) <> 0 OR SUM(revenue) <> 0
+        ON CONFLICT (day) DO UPDATE
+        SET completed_count = d.completed_count + EXCLUDED.completed_count, revenue = d.revenue + EXCLUDED.revenue;
+    ELSIF TG_OP = 'DELETE' THEN
+        WITH delta AS (
+            SELECT status, payment_status, CASE WHEN status = 'completed' THEN completed_at::date END AS completed_day,
+                -1 AS order_count, -COALESCE(price, 0) AS revenue
+            FROM old_rows
+        ), status_delta AS (
+            INSERT INTO t_p39739760_garbage_bot_service.order_status_counters AS c (status, payment_status, order_count, revenue)
+            SELECT COALESCE(status, ''), COALESCE(payment_status, ''), SUM(order_count), SUM(revenue)
+            FROM delta
+            GROUP BY 1, 2
+            HAVING SUM(order_count) <> 0 OR SUM(revenue) <> 0
+            ON CONFLICT (status, payment_status) DO UPDATE
+            SET order_count = c.order_count + EXCLUDED.order_count, revenue = c.revenue + EXCLUDED.revenue
+        )
+        INSERT INTO t_p39739760_garbage_bot_service.order_daily_counters AS d (day, completed_count, revenue)
+        SELECT completed_day, SUM(order_count), SUM(revenue)
+        FROM delta
+        WHERE completed_day IS NOT NULL
+        GROUP BY 1
+        HAVING SUM(order_count) <> 0 OR SUM(revenue) <> 0
+        ON CONFLICT (day) DO UPDATE
+        SET completed_count = d.completed_count + EXCLUDED.completed_count, revenue = d.revenue + EXCLUDED.revenue;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- UPDATE - построчно: только так триггер ограничивается списком столбцов и условием WHEN
+-- (переходные таблицы со списком столбцов запрещены). Обновления, не меняющие учитываемые
+-- столбцы (счётчики переписки, назначение курьера, адрес), счётчики не трогают и не ждут их блокировку.
+CREATE OR REPLACE FUNCTION t_p39739760_garbage_bot_service.update_order_counters_row()
+RETURNS TRIGGER AS $$
+BEGIN
+    WITH delta AS (
+        SELECT NEW.status AS status, NEW.payment_status AS payment_status,
+            CASE WHEN NEW.status = 'completed' THEN NEW.completed_at::date END AS completed_day,
+            1 AS order_count, COALESCE(NEW.price, 0) AS revenue
+        UNION ALL
+        SELECT OLD.status, OLD.payment_status,
+            CASE WHEN OLD.status = 'completed' THEN OLD.completed_at::date END,
+            -1, -COALESCE(OLD.price, 0)
+    ), status_delta AS (
+        INSERT INTO t_p39739760_garbage_bot_service.order_status_counters AS c (status, payment_status, order_count, revenue)
+        SELECT COALESCE(status, ''), COALESCE(payment_status, ''), SUM(order_count), SUM(revenue)
+        FROM delta
+        GROUP BY 1, 2
+        HAVING SUM(order_count) <> 0 OR SUM(revenue) <> 0
+        ON CONFLICT (status, payment_status) DO UPDATE
+        SET order_count = c.order_count + EXCLUDED.order_count, revenue = c.revenue + EXCLUDED.revenue
+    )
+    INSERT INTO t_p39739760_garbage_bot_service.order_daily_counters AS d (day, completed_count, revenue)
+    SELECT completed_day, SUM(order_count), SUM(revenue)
+    FROM delta
+    WHERE completed_day IS NOT NULL
+    GROUP BY 1
+    HAVING SUM(order_count) <> 0 OR SUM(revenue) <> 0
+    ON CONFLICT (day) DO UPDATE
+    SET completed_count = d.completed_count + EXCLUDED.completed_count, revenue = d.revenue + EXCLUDED.revenue;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_orders_counters_insert
+    AFTER INSERT ON t_p39739760_garbage_bot_service.orders
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p39739760_garbage_bot_service.update_order_counters();
+
+CREATE TRIGGER trg_orders_counters_update
+    AFTER UPDATE OF status, payment_status, price, completed_at ON t_p39739760_garbage_bot_service.orders
+    FOR EACH ROW
+    WHEN (OLD.status IS DISTINCT FROM NEW.status
+        OR OLD.payment_status IS DISTINCT FROM NEW.payment_status
+        OR OLD.price IS DISTINCT FROM NEW.price
+        OR OLD.completed_at IS DISTINCT FROM NEW.completed_at)
+    EXECUTE FUNCTION t_p39739760_garbage_bot_service.update_order_counters_row();
+
+CREATE TRIGGER trg_orders_counters_delete
+    AFTER DELETE ON t_p39739760_garbage_bot_service.orders
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p39739760_garbage_bot_service.update_order_counters();
+
+-- Заполнение по существующим заказам
+INSERT INTO t_p39739760_garbage_bot_service.order_status_counters (status, payment_status, order_count, revenue)
+SELECT COALESCE(status, ''), COALESCE(payment_status, ''), COUNT(*), COALESCE(SUM(price), 0)
+FROM t_p39739760_garbage_bot_service.orders
+GROUP BY 1, 2;
+
+INSERT INTO t_p39739760_garbage_bot_service.order_daily_counters (day, completed_count, revenue)
+SELECT completed_at::date, COUNT(*), COALESCE(SUM(price), 0)
+FROM t_p39739760_garbage_bot_service.orders
+WHERE status = 'completed' AND completed_at IS NOT NULL
+GROUP BY 1;
@@ -0,0 +1,40 @@
+-- Составные и частичные индексы под фактические запросы экранов бота и плановых функций.
+-- Одиночные индексы из V0001 на client_id / courier_id покрываются префиксами новых составных.
+
+-- Доступные заказы курьера и активные заказы оператора: status = 'pending' / IN ('pending', 'accepted') ORDER BY created_at DESC.
+-- Ключ без status: при IN по двум статусам индекс (status, created_at) не отдаёт строки в порядке created_at
+CREATE INDEX IF NOT EXISTS idx_orders_open_created
+    ON t_p39739760_garbage_bot_service.orders (created_at DESC)
+    WHERE status IN ('pending', 'accepted');
+
+-- Активные заказы клиента: client_id = ? AND status IN (...) ORDER BY created_at DESC
+CREATE INDEX IF NOT EXISTS idx_orders_client_status_created
+    ON t_p39739760_garbage_bot_service.orders (client_id, status, created_at DESC);
+
+-- История клиента: client_id = ? AND status = 'completed' ORDER BY completed_at DESC
+CREATE INDEX IF NOT EXISTS idx_orders_client_completed
+    ON t_p39739760_garbage_bot_service.orders (client_id, completed_at DESC, id DESC)
+    WHERE status = 'completed';
+
+-- Текущие заказы и история курьера: courier_id = ? AND status = ? ORDER BY accepted_at / completed_at DESC
+CREATE INDEX IF NOT EXISTS idx_orders_courier_status_completed
+    ON t_p39739760_garbage_bot_service.orders (courier_id, status, completed_at DESC, id DESC);
+
+-- Отмена неоплаченных заказов: только ожидающие оплату, по возрасту
+CREATE INDEX IF NOT EXISTS idx_orders_awaiting_payment_created
+    ON t_p39739760_garbage_bot_service.orders (created_at)
+    WHERE status = 'pending' AND payment_status = 'pending' AND detailed_status = 'waiting_payment';
+
+-- Действующая подписка клиента: client_id = ? AND is_active AND end_date >= CURRENT_DATE ORDER BY end_date DESC
+CREATE INDEX IF NOT EXISTS idx_subscriptions_client_active_end
+    ON t_p39739760_garbage_bot_service.subscriptions (client_id, end_date DESC)
+    WHERE is_active = true;
+
+-- Список подписок админа: is_active AND end_date >= CURRENT_DATE ORDER BY end_date, id
+CREATE INDEX IF NOT EXISTS idx_subscriptions_active_end_id
+    ON t_p39739760_garbage_bot_service.subscriptions (end_date, id)
+    WHERE is_active = true;
+
+DROP INDEX IF EXISTS t_p39739760_garbage_bot_service.idx_orders_client_id;
+DROP INDEX IF EXISTS t_p39739760_garbage_bot_service.idx_orders_courier_id;
+DROP INDEX IF EXISTS t_p39739760_garbage_bot_service.idx_subscriptions_is_active;
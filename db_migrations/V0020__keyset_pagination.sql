@@ -0,0 +1,16 @@
+-- Постраничные списки истории и справочников листаются по ключу (keyset), а не через OFFSET.
+
+-- Завершённые оператором заказы раньше не получали completed_at; ключ истории не допускает NULL
+UPDATE t_p39739760_garbage_bot_service.orders
+SET completed_at = COALESCE(accepted_at, created_at)
+WHERE status = 'completed' AND completed_at IS NULL;
+
+-- Список курьеров: role = 'courier' ORDER BY id DESC
+CREATE INDEX IF NOT EXISTS idx_users_role_id
+    ON t_p39739760_garbage_bot_service.users (role, id);
+
+DROP INDEX IF EXISTS t_p39739760_garbage_bot_service.idx_users_role;
+
+-- Список операторов: ORDER BY created_at DESC, telegram_id DESC
+CREATE INDEX IF NOT EXISTS idx_operator_users_created
+    ON t_p39739760_garbage_bot_service.operator_users (created_at, telegram_id);
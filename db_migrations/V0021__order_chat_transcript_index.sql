@@ -0,0 +1,5 @@
+-- Переписка заказа читается страницами по ключу (created_at, id), как и архив (V0017)
+CREATE INDEX IF NOT EXISTS idx_order_chat_order_created
+    ON t_p39739760_garbage_bot_service.order_chat (order_id, created_at, id);
+
+DROP INDEX IF EXISTS t_p39739760_garbage_bot_service.idx_order_chat_order_id;
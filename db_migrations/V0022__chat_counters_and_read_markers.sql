@@ -0,0 +1,34 @@
+-- Счётчики переписки на заказе: ведутся при отправке сообщения, архивация их не меняет
+ALTER TABLE t_p39739760_garbage_bot_service.orders
+ADD COLUMN IF NOT EXISTS chat_message_count INTEGER NOT NULL DEFAULT 0,
+ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP,
+ADD COLUMN IF NOT EXISTS last_message_id BIGINT;
+
+-- Докуда участник (клиент, курьер, оператор) прочитал переписку заказа
+CREATE TABLE IF NOT EXISTS t_p39739760_garbage_bot_service.chat_read_markers (
+    order_id BIGINT NOT NULL REFERENCES t_p39739760_garbage_bot_service.orders(id),
+    telegram_id BIGINT NOT NULL,
+    last_read_message_id BIGINT NOT NULL DEFAULT 0,
+    last_read_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (order_id, telegram_id)
+);
+
+UPDATE t_p39739760_garbage_bot_service.orders o
+SET chat_message_count = c.message_count, last_message_at = c.last_at, last_message_id = c.last_id
+FROM (
+    SELECT order_id, COUNT(*) AS message_count, MAX(created_at) AS last_at,
+        (ARRAY_AGG(id ORDER BY created_at DESC, id DESC))[1] AS last_id
+    FROM (
+        SELECT order_id, id, created_at FROM t_p39739760_garbage_bot_service.order_chat WHERE is_archived = FALSE
+        UNION ALL
+        SELECT order_id, id, created_at FROM t_p39739760_garbage_bot_service.order_chat_archive
+    ) m
+    GROUP BY order_id
+) c
+WHERE o.id = c.order_id;
+
+-- Список чатов оператора: открытые заказы по последней активности
+CREATE INDEX IF NOT EXISTS idx_orders_open_activity
+    ON t_p39739760_garbage_bot_service.orders ((COALESCE(last_message_at, created_at)) DESC, id DESC)
+    WHERE status IN ('pending', 'accepted');
@@ -0,0 +1,15 @@
+-- Апдейты Telegram, принятые в обработку: повторная доставка того же update_id не обрабатывается второй раз.
+-- completed_at ставится только после успешной обработки; захват без него старше срока аренды
+-- считается брошенным (вызов убит по таймауту), и повторная доставка обрабатывает апдейт заново.
+-- failed_at - обработка упала после того, как успела зафиксировать изменения: захват остаётся
+-- (completed_at тоже ставится), чтобы повтор не создал, например, второй заказ.
+-- Telegram хранит неподтверждённые апдейты не дольше суток, старые строки чистит функция maintenance.
+CREATE TABLE IF NOT EXISTS t_p39739760_garbage_bot_service.processed_updates (
+    update_id BIGINT PRIMARY KEY,
+    received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP,
+    failed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_processed_updates_received
+    ON t_p39739760_garbage_bot_service.processed_updates (received_at);
@@ -0,0 +1,10 @@
+-- Журнал обработанных уведомлений ЮKassa: повторная доставка того же события
+-- (payment_id, event) не меняет заказ и не рассылает уведомления второй раз
+CREATE TABLE IF NOT EXISTS t_p39739760_garbage_bot_service.payment_events (
+    payment_id VARCHAR(255) NOT NULL,
+    event_type VARCHAR(64) NOT NULL,
+    order_ref VARCHAR(64) NOT NULL,
+    payment_status VARCHAR(50),
+    received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (payment_id, event_type)
+);
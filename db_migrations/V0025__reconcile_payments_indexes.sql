@@ -0,0 +1,9 @@
+-- Сверка платежей с ЮKassa: заказы и подписки с созданным, но не подтверждённым платежом.
+-- Частичные индексы держат в себе только такие строки, поэтому проход не зависит от объёма истории.
+CREATE INDEX IF NOT EXISTS idx_orders_payment_pending
+    ON t_p39739760_garbage_bot_service.orders (id)
+    WHERE payment_status = 'pending' AND payment_id IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_payment_pending
+    ON t_p39739760_garbage_bot_service.subscriptions (id)
+    WHERE payment_status = 'pending' AND payment_id IS NOT NULL;
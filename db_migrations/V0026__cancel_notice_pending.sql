@@ -0,0 +1,9 @@
+-- Заказ отменён по таймауту оплаты, а клиент ещё не получил уведомление.
+-- Флаг снимается только после ответа Telegram, поэтому не уложившиеся в бюджет рассылки
+-- уведомления уходят следующим запуском cancel-unpaid-orders.
+ALTER TABLE t_p39739760_garbage_bot_service.orders
+ADD COLUMN IF NOT EXISTS cancel_notice_pending BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_orders_cancel_notice_pending
+    ON t_p39739760_garbage_bot_service.orders (id)
+    WHERE cancel_notice_pending;
@@ -0,0 +1,49 @@
+'''
+Общие модули облачных функций. Каждая функция деплоится из своей папки backend/<функция>
+и не видит соседние, поэтому общий код лежит копиями рядом с index.py. Эталон - копия
+в backend/telegram-bot; остальные должны совпадать с ним побайтно.
+
+python scripts/sync_shared_modules.py          - переписать копии по эталону
+python scripts/sync_shared_modules.py --check  - только проверить, код возврата 1 при расхождении
+'''
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+BACKEND = Path(__file__).resolve().parent.parent / 'backend'
+SOURCE = BACKEND / 'telegram-bot'
+SHARED_MODULES = ('db.py', 'telegram_api.py', 'yookassa.py')
+
+def copies() -> Dict[Path, List[Path]]:
+    '''Эталон -> его копии в остальных функциях'''
+    return {
+        SOURCE / module: sorted(
+            path for path in BACKEND.glob(f'*/{module}')
+            if path.parent != SOURCE
+        )
+        for module in SHARED_MODULES
+    }
+
+def stale_copies() -> List[Path]:
+    return [
+        copy
+        for source, targets in copies().items()
+        for copy in targets
+        if copy.read_bytes() != source.read_bytes()
+    ]
+
+def main(argv: List[str]) -> int:
+    stale = stale_copies()
+
+    if '--check' in argv:
+        for path in stale:
+            print(f'{path.relative_to(BACKEND.parent)} differs from {SOURCE.name}/{path.name}')
+        return 1 if stale else 0
+
+    for path in stale:
+        path.write_bytes((SOURCE / path.name).read_bytes())
+        print(f'updated {path.relative_to(BACKEND.parent)}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
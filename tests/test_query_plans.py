@@ -0,0 +1,151 @@
+'''
+Планы горячих запросов бота и плановых функций: ни один не должен читать orders последовательным сканом.
+
+Тест применяет все миграции к чистой схеме, заполняет её объёмом, на котором планировщик
+уже предпочитает индексы, и проверяет EXPLAIN каждого запроса. Нужна отдельная пустая база:
+PLAN_TEST_DATABASE_URL=postgresql://... python -m pytest tests/test_query_plans.py
+Схема t_p39739760_garbage_bot_service в ней пересоздаётся.
+'''
+import os
+from pathlib import Path
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+DATABASE_URL = os.environ.get('PLAN_TEST_DATABASE_URL')
+MIGRATIONS = Path(__file__).resolve().parent.parent / 'db_migrations'
+SCHEMA = 't_p39739760_garbage_bot_service'
+
+# Админ из V0003/V0006 должен существовать до вставки в admin_users
+SEED_BEFORE = {
+    'V0006': "INSERT INTO users (telegram_id, first_name) VALUES (8225051851, 'Admin') ON CONFLICT DO NOTHING",
+}
+
+SEED = [
+    "INSERT INTO users (telegram_id, first_name, role) "
+    "SELECT g, 'u', CASE WHEN g < 1050 THEN 'courier' ELSE 'client' END FROM generate_series(1000, 3000) g "
+    "ON CONFLICT DO NOTHING",
+    "INSERT INTO orders (client_id, courier_id, description, address, bag_count, price, status, payment_status, "
+    "    detailed_status, payment_id, created_at, accepted_at, completed_at) "
+    "SELECT 1000 + g % 2000, 1000 + g % 50, 'd', 'a', 1, 100, "
+    "    CASE WHEN g % 100 = 0 THEN 'pending' WHEN g % 100 = 1 THEN 'accepted' WHEN g % 10 = 5 THEN 'cancelled' ELSE 'completed' END, "
+    "    CASE WHEN g % 200 = 0 THEN 'pending' ELSE 'succeeded' END, "
+    "    CASE WHEN g % 200 = 0 THEN 'waiting_payment' ELSE 'completed' END, "
+    "    'p' || g, LOCALTIMESTAMP - g * interval '1 minute', LOCALTIMESTAMP - g * interval '1 minute', "
+    "    LOCALTIMESTAMP - g * interval '1 minute' "
+    "FROM generate_series(1, 200000) g",
+    "INSERT INTO order_chat (order_id, sender_id, message) "
+    "SELECT id, client_id, 'm' FROM orders WHERE status IN ('pending', 'accepted')",
+    "INSERT INTO subscriptions (client_id, type, price, start_date, end_date, is_active) "
+    "SELECT 1000 + g % 2000, 'daily', 1, CURRENT_DATE, CURRENT_DATE + g % 60 - 30, g % 3 = 0 "
+    "FROM generate_series(1, 20000) g",
+    "ANALYZE",
+]
+
+# Запросы в том виде, в каком их выполняют функции; keyset-страницы - со следующей страницы
+QUERIES = {
+    'courier_available':
+        "SELECT id, address, description, price, detailed_status FROM orders "
+        "WHERE status = 'pending' ORDER BY created_at DESC LIMIT 10",
+    'operator_active':
+        "SELECT o.id, o.address, u1.first_name, u2.first_name FROM orders o "
+        "JOIN users u1 ON o.client_id = u1.telegram_id "
+        "LEFT JOIN users u2 ON o.courier_id = u2.telegram_id "
+        "WHERE o.status IN ('pending', 'accepted') ORDER BY o.created_at DESC LIMIT 20",
+    'client_active':
+        "SELECT o.id FROM orders o LEFT JOIN users u ON o.courier_id = u.telegram_id "
+        "WHERE o.client_id = 1500 AND o.status IN ('pending', 'accepted') ORDER BY o.created_at DESC",
+    'client_history':
+        "SELECT o.id FROM orders o LEFT JOIN users u ON o.courier_id = u.telegram_id "
+        "WHERE o.client_id = 1500 AND o.status = 'completed' "
+        "AND (o.completed_at, o.id) < (LOCALTIMESTAMP - interval '1 day', 150000) "
+        "ORDER BY o.completed_at DESC, o.id DESC LIMIT 6",
+    'courier_current':
+        "SELECT id FROM orders WHERE courier_id = 1010 AND status = 'accepted' ORDER BY accepted_at DESC",
+    'courier_history':
+        "SELECT id FROM orders WHERE courier_id = 1010 AND status = 'completed' "
+        "AND (completed_at, id) < (LOCALTIMESTAMP - interval '1 day', 150000) "
+        "ORDER BY completed_at DESC, id DESC LIMIT 6",
+    'cancel_unpaid':
+        "SELECT id FROM orders WHERE status = 'pending' AND payment_status = 'pending' "
+        "AND detailed_status = 'waiting_payment' AND created_at < LOCALTIMESTAMP - make_interval(mins => 30) "
+        "ORDER BY created_at LIMIT 500 FOR UPDATE SKIP LOCKED",
+    'cancel_notices':
+        "SELECT id, client_id FROM orders WHERE cancel_notice_pending AND status = 'cancelled' ORDER BY id LIMIT 600",
+    'reconcile_pending':
+        "SELECT id, payment_id, status FROM orders "
+        "WHERE payment_status = 'pending' AND payment_id IS NOT NULL AND id > 0 "
+        "AND created_at < LOCALTIMESTAMP - make_interval(mins => 5) "
+        "AND created_at > LOCALTIMESTAMP - make_interval(days => 3) ORDER BY id LIMIT 200",
+    'archive_chat_scan':
+        "WITH RECURSIVE chats (order_id, depth) AS ("
+        "    (SELECT order_id, 1 FROM order_chat WHERE order_id > 0 ORDER BY order_id LIMIT 1) "
+        "    UNION ALL "
+        "    SELECT (SELECT oc.order_id FROM order_chat oc "
+        "            WHERE oc.order_id > c.order_id ORDER BY oc.order_id LIMIT 1), c.depth + 1 "
+        "    FROM chats c WHERE c.order_id IS NOT NULL AND c.depth < 500"
+        ") "
+        "SELECT c.order_id, COALESCE(o.status IN ('completed', 'cancelled') "
+        "    AND COALESCE(o.completed_at, o.created_at) < LOCALTIMESTAMP - make_interval(days => 7), FALSE) "
+        "FROM chats c LEFT JOIN orders o ON o.id = c.order_id "
+        "WHERE c.order_id IS NOT NULL ORDER BY c.order_id",
+    'client_subscription':
+        "SELECT id FROM subscriptions WHERE client_id = 1500 AND is_active = true "
+        "AND end_date >= CURRENT_DATE ORDER BY end_date DESC LIMIT 1",
+    'admin_subscriptions':
+        "SELECT s.id FROM subscriptions s WHERE s.is_active = true AND s.end_date >= CURRENT_DATE "
+        "AND (s.end_date, s.id) > (CURRENT_DATE, 100) ORDER BY s.end_date, s.id LIMIT 6",
+}
+
+# Индексы, которые существуют только ради этих запросов: если планировщик их не берёт, индекс - лишняя запись
+EXPECTED_INDEXES = {
+    'courier_available': 'idx_orders_open_created',
+    'operator_active': 'idx_orders_open_created',
+    'cancel_unpaid': 'idx_orders_awaiting_payment_created',
+    'cancel_notices': 'idx_orders_cancel_notice_pending',
+    'admin_subscriptions': 'idx_subscriptions_active_end_id',
+    'archive_chat_scan': 'idx_order_chat_order_created',
+}
+
+@pytest.fixture(scope='module')
+def cursor():
+    if not DATABASE_URL:
+        pytest.skip('PLAN_TEST_DATABASE_URL is not set')
+
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"SET search_path = {SCHEMA}")
+
+    for migration in sorted(MIGRATIONS.glob('V*.sql')):
+        seed = SEED_BEFORE.get(migration.name.split('__')[0])
+        if seed:
+            cur.execute(seed)
+        cur.execute(migration.read_text(encoding='utf-8'))
+
+    for statement in SEED:
+        cur.execute(statement)
+
+    yield cur
+
+    cur.close()
+    conn.close()
+
+@pytest.mark.parametrize('name', sorted(QUERIES))
+def test_no_sequential_scan_of_orders(cursor, name):
+    plan = explain(cursor, QUERIES[name])
+
+    assert 'Seq Scan on orders' not in plan, plan
+
+@pytest.mark.parametrize('name', sorted(EXPECTED_INDEXES))
+def test_dedicated_index_is_used(cursor, name):
+    plan = explain(cursor, QUERIES[name])
+
+    assert EXPECTED_INDEXES[name] in plan, plan
+
+def explain(cursor, query: str) -> str:
+    cursor.execute('EXPLAIN ' + query)
+    return '\n'.join(row[0] for row in cursor.fetchall())
@@ -0,0 +1,17 @@
+'''Копии общих модулей в функциях совпадают с эталоном в backend/telegram-bot'''
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+import sync_shared_modules
+
+@pytest.mark.parametrize('source', sorted(sync_shared_modules.copies()), ids=lambda path: path.name)
+def test_copies_match_source(source):
+    targets = sync_shared_modules.copies()[source]
+    stale = [str(path.relative_to(sync_shared_modules.BACKEND)) for path in targets if path.read_bytes() != source.read_bytes()]
+
+    assert targets, f'{source.name} has no copies'
+    assert not stale, f'run scripts/sync_shared_modules.py: {stale}'